@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from retriever import BM25
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Serves POST /_msearch like an ElasticSearch node, with made up hits, after a latency with a slow tail: a request
+    is stalled for slow_latency seconds with probability slow_rate, as if one of its shards was slow.
+    '''
+
+    latency: float = 0.005
+    latency_per_query: float = 0.001
+    slow_rate: float = 0.02
+    slow_latency: float = 1.0
+    rng: random.Random = None
+    lock: threading.Lock = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # The transport drops the connection of a request once another copy answered, possibly between two requests
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        # Checked by the clients from 7.14 on
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+
+        # The transport drops the connection of a request once its hedge answered
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self._send_json(200, {"version": {"number": "7.10.2", "build_flavor": "default"}, "tagline": "You Know, for Search"})
+
+    def do_POST(self):
+
+        lines = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode('utf-8').splitlines()
+
+        if "_msearch" not in self.path:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        bodies = [json.loads(line) for line in lines[1::2]]
+
+        with self.lock:
+            slow = self.rng.random() < self.slow_rate
+
+        time.sleep(self.slow_latency if slow else self.latency + self.latency_per_query * len(bodies))
+
+        responses = []
+        for body in bodies:
+            query = body["query"]["multi_match"]["query"]
+            digest = hashlib.sha256(query.encode('utf-8')).hexdigest()
+            hits = []
+            for j in range(body["size"]):
+                hit = {"_id": f"{int(digest[:8], 16) % 21015324 + j}", "_score": 10.0 - j}
+                if body.get("_source") is not False:
+                    hit["_source"] = {"txt": f"Passage {j} for {query}"}
+                hits.append(hit)
+            responses.append({"took": 1, "hits": {"hits": hits}})
+
+        self._send_json(200, {"responses": responses})
+
+def serve_nodes(num_nodes, seed, **latency):
+    '''Starts stand-in ElasticSearch nodes in background threads
+
+    Args:
+        num_nodes (int): The number of nodes
+        seed (int): The seed of the slow requests
+        latency: The latency settings of StandInHandler
+
+    Returns:
+        hosts (List[str]): The host:port of every node
+    '''
+
+    hosts = []
+
+    for node in range(num_nodes):
+        handler = type("Handler", (StandInHandler,), {"rng": random.Random(seed + node), "lock": threading.Lock(), **latency})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        hosts.append(f"127.0.0.1:{server.server_port}")
+
+    return hosts
+
+def bench(retriever, num_batches, batch_size, topk, tag):
+    '''Times BM25.retrieve over batches of new queries (missing from the retrieval cache)
+
+    Args:
+        retriever (BM25): The retriever
+        num_batches (int): The number of retrieve calls
+        batch_size (int): The number of queries per call
+        topk (int): The number of documents per query
+        tag (str): Makes the queries of this run unique
+
+    Returns:
+        latencies (List[float]): The seconds of every retrieve call
+    '''
+
+    latencies = []
+
+    for b in range(num_batches):
+        queries = [f"who played character {i} in film {b} ({tag})" for i in range(batch_size)]
+
+        start = time.perf_counter()
+        docids, docs = retriever.retrieve(queries, topk=topk)
+        latencies.append(time.perf_counter() - start)
+
+        assert len(docids) == batch_size and all(len(ids) == topk for ids in docids)
+
+    return latencies
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the retrieve latency of the beir client and the pooled, pipelined and hedged transport against stand-in ElasticSearch nodes")
+    parser.add_argument("--nodes", type=int, default=4, help="Number of stand-in nodes, hedges go to the next nodes")
+    parser.add_argument("-n", "--num_batches", type=int, default=100, help="Number of retrieve calls per client")
+    parser.add_argument("-b", "--batch_size", type=int, default=20, help="Number of queries per retrieve call")
+    parser.add_argument("-k", "--topk", type=int, default=3, help="Number of documents retrieved per query")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds per msearch request of a node")
+    parser.add_argument("--latency_per_query", type=float, default=0.001, help="Additional seconds per query of the request")
+    parser.add_argument("--slow_rate", type=float, default=0.02, help="Probability of a request stalling")
+    parser.add_argument("--slow_latency", type=float, default=1.0, help="Seconds a stalled request takes")
+    parser.add_argument("--sub_batch_size", type=int, default=5, help="Queries per sub-request of the transport")
+    parser.add_argument("--hedge_percentile", type=float, default=95, help="Latency percentile after which a sub-request is hedged")
+    parser.add_argument("--hedge_max_delay", type=float, default=0.1, help="Maximum seconds before a sub-request is hedged")
+    parser.add_argument("--max_hedges", type=int, default=None, help="Maximum hedges per sub-request, one per other node if None")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the stalled requests")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Path to save the results as json")
+    args = parser.parse_args()
+
+    hosts = serve_nodes(
+        args.nodes,
+        args.seed,
+        latency=args.latency,
+        latency_per_query=args.latency_per_query,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+    )
+
+    retrievers = {
+        "beir client": BM25(hostname=hosts[0]),
+        "transport": BM25(hostname=hosts[0], transport_kwargs={
+            "hosts": hosts,
+            "sub_batch_size": args.sub_batch_size,
+            "hedge_percentile": args.hedge_percentile,
+            "hedge_after": 4 * (args.latency + args.latency_per_query * args.sub_batch_size),
+            "hedge_max_delay": args.hedge_max_delay,
+            "max_hedges": args.max_hedges if args.max_hedges is not None else args.nodes - 1,
+        }),
+    }
+
+    results = {}
+
+    for name, retriever in retrievers.items():
+
+        # Warm up the connections
+        bench(retriever, 2, args.batch_size, args.topk, f"{name} warm up")
+
+        latencies = 1000 * np.array(bench(retriever, args.num_batches, args.batch_size, args.topk, name))
+
+        results[name] = {
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(np.max(latencies)),
+        }
+
+        if retriever.transport is not None:
+            results[name]["transport"] = retriever.transport.stats
+            retriever.transport.close()
+
+        print(f"{name:>11}: p50 {results[name]['p50_ms']:.1f}ms, p95 {results[name]['p95_ms']:.1f}ms, p99 {results[name]['p99_ms']:.1f}ms, max {results[name]['max_ms']:.1f}ms per retrieve call")
+
+        if retriever.transport is not None:
+            stats = results[name]["transport"]
+            print(f"{'':>11}  sub-requests: {stats['sub_requests']}, hedged: {stats['hedged']} (answered first: {stats['hedge_wins']}), retried: {stats['retries']}, failed: {stats['failures']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import time
+import uuid
+import resource
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from openai_api import QueryAgent
+from scheduler import ContinuousBatcher
+from mock_server import MockLM, MockCompletion
+from state import RetrievalResult
+
+class FakeRetriever(object):
+    '''
+    A deterministic stand-in for BM25.retrieve, returning made up passages after a configurable latency.
+
+    Args:
+        latency (float): The seconds a retrieve call takes
+        latency_per_query (float): The additional seconds per query of the batch
+        passage_words (int): The number of words of every passage
+
+    Attributes:
+        calls (int): The number of retrieve calls
+        queries (int): The number of queries retrieved for
+
+    '''
+    def __init__(
+        self,
+        latency: float = 0,
+        latency_per_query: float = 0,
+        passage_words: int = 100,
+    ):
+
+        self.latency = latency
+        self.latency_per_query = latency_per_query
+        self.passage_words = passage_words
+
+        self.calls = 0
+        self.queries = 0
+
+    def retrieve(self, queries, topk=1):
+
+        time.sleep(self.latency + self.latency_per_query * len(queries))
+
+        self.calls += 1
+        self.queries += len(queries)
+
+        docids = []
+        docs = []
+
+        for query in queries:
+            seed = uuid.uuid5(uuid.NAMESPACE_OID, query).int
+            docids.append([str((seed + j) % 21015324) for j in range(topk)])
+            docs.append([" ".join(["passage"] * self.passage_words) + f" {seed % 1000} {j}" for j in range(topk)])
+
+        return RetrievalResult(docids, docs)
+
+def make_agent(config, args):
+    '''Builds a QueryAgent over the fake backends for one benchmark configuration
+
+    Args:
+        config (Dict[str, Any]): The retrieval kwargs of the configuration
+        args (argparse.Namespace): The benchmark arguments
+
+    Returns:
+        qa (QueryAgent): The agent
+        retriever (FakeRetriever): The fake retriever of the agent
+    '''
+
+    retriever = FakeRetriever(latency=args.retrieval_latency, latency_per_query=args.retrieval_latency_per_query)
+
+    if args.local_model:
+        from local_lm import LocalLM
+        lm = LocalLM(args.local_model, seed=args.seed)
+    elif args.api_base:
+        lm = None
+    else:
+        lm = MockCompletion(MockLM(
+            seed=args.seed,
+            prob_alpha=args.prob_alpha,
+            prob_beta=args.prob_beta,
+            latency=args.lm_latency,
+            latency_per_token=args.lm_latency_per_token,
+        ))
+
+    qa = QueryAgent(
+        model=args.model,
+        retrieval_kwargs=config,
+        api_key=os.getenv("OPENAI_API_KEY", "mock"),
+        retriever=retriever,
+        max_concurrency=max(args.concurrency, 1),
+        stream=args.stream,
+        api_base=args.api_base,
+        rate_limits={"max_batch_size": config["batch_size"]},
+        lm=lm,
+    )
+
+    return qa, retriever
+
+def answer(qa, questions, batch_size, mode, concurrency):
+    '''Answers the questions, timing every question from when it is picked up until it is answered
+
+    Args:
+        qa (QueryAgent): The agent
+        questions (List[str]): The questions to answer
+        batch_size (int): The number of questions answered at the same time
+        mode (str): 'respond' for fixed batches, 'batcher' for the ContinuousBatcher, 'async' for arespond_as_completed
+        concurrency (int): The max in-flight API requests of the async mode
+
+    Returns:
+        latencies (List[float]): The seconds taken by every question
+    '''
+
+    latencies = []
+
+    if mode == "respond":
+
+        for start in range(0, len(questions), batch_size):
+            batch_start = time.perf_counter()
+            qa.respond(questions[start:start+batch_size])
+            latencies += [time.perf_counter() - batch_start] * len(questions[start:start+batch_size])
+
+    elif mode == "batcher":
+
+        picked = {}
+
+        def pick():
+            for i, question in enumerate(questions):
+                picked[i] = time.perf_counter()
+                yield i, question
+
+        for i, _ in ContinuousBatcher(qa, num_slots=batch_size).run(pick()):
+            latencies.append(time.perf_counter() - picked[i])
+
+    elif mode == "async":
+
+        import asyncio
+
+        async def run():
+            start = time.perf_counter()
+            async for i, _ in qa.arespond_as_completed(list(enumerate(questions))):
+                latencies.append(time.perf_counter() - start)
+
+        asyncio.run(run())
+
+    else:
+        raise Exception(f"Invalid mode {mode}! Acceptable modes: 'respond', 'batcher', 'async'")
+
+    return latencies
+
+def bench(config, questions, args):
+    '''Runs one configuration of the sweep
+
+    Args:
+        config (Dict[str, Any]): The retrieval kwargs of the configuration, along with its batch_size
+        questions (List[str]): The questions to answer
+        args (argparse.Namespace): The benchmark arguments
+
+    Returns:
+        result (Dict[str, Any]): The configuration and its metrics
+    '''
+
+    qa, retriever = make_agent(config, args)
+
+    start = time.perf_counter()
+    latencies = answer(qa, questions, config["batch_size"], args.mode, args.concurrency)
+    wall_time = time.perf_counter() - start
+
+    num_qs = len(questions)
+
+    return {
+        "config": config,
+        "questions": num_qs,
+        "seconds": wall_time,
+        "questions_per_second": num_qs / wall_time,
+        "api_calls_per_question": qa._total_api_calls / num_qs,
+        "api_requests_per_question": qa.rate_limiter.stats["requests"] / num_qs,
+        "retrievals_per_question": qa._total_retrieval_calls / num_qs,
+        "retrieve_calls_per_question": retriever.calls / num_qs,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p95": float(np.percentile(latencies, 95)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def bench_isolated(config, questions, args):
+    '''Runs bench in a fresh process, so the peak RSS is the one of this configuration alone'''
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(bench, (config, questions, args))
+
+def sweep(base_config, args):
+    '''The configurations of the sweep, every combination of the swept values over the base configuration
+
+    Args:
+        base_config (Dict[str, Any]): The retrieval kwargs from configs/asqa.json
+        args (argparse.Namespace): The benchmark arguments
+
+    Returns:
+        configs (List[Dict[str, Any]]): The configurations
+    '''
+
+    axes = {
+        "batch_size": args.batch_sizes,
+        "topk_retriever": args.topks or [base_config.get("topk_retriever", 1)],
+        "look_ahead_filter_prob": args.filter_probs or [base_config.get("look_ahead_filter_prob", 0)],
+        "look_ahead_mask_prob": args.mask_probs or [base_config.get("look_ahead_mask_prob", 0)],
+    }
+
+    configs = []
+
+    for values in itertools.product(*axes.values()):
+        config = dict(base_config)
+        config.update(zip(axes.keys(), values))
+        configs.append(config)
+
+    return configs
+
+def git_commit():
+    '''The commit benchmarked, None outside of a git checkout'''
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    '''Prints the change of the metrics against the results of another run, matching the configurations
+
+    Args:
+        results (List[Dict[str, Any]]): The results of this run
+        baseline_path (str): The json written by a previous run
+
+    Returns:
+        None
+    '''
+
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+
+    previous = {json.dumps(result["config"], sort_keys=True): result for result in baseline["results"]}
+
+    print(f"Compared to {baseline_path} (commit {baseline.get('commit')})")
+
+    for result in results:
+
+        old = previous.get(json.dumps(result["config"], sort_keys=True))
+        if old is None:
+            continue
+
+        changes = ", ".join(
+            f"{metric} {100 * (result[metric] / old[metric] - 1):+.1f}%"
+            for metric in ["questions_per_second", "api_calls_per_question", "latency_p95", "peak_rss_mb"] if old[metric]
+        )
+        print(f"  batch_size={result['config']['batch_size']} topk={result['config']['topk_retriever']} theta={result['config']['look_ahead_filter_prob']} beta={result['config']['look_ahead_mask_prob']}: {changes}")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the throughput of the FLARE pipeline with fake LM and retriever backends")
+    parser.add_argument("-d", "--dataset", type=str, default="ASQA_mini", help="Name of ASQA dev dataset to take questions from")
+    parser.add_argument("-q", "--num_questions", type=int, default=None, help="Number of questions to answer, all if None")
+    parser.add_argument("--mode", type=str, default="respond", choices=["respond", "batcher", "async"], help="respond in fixed batches, the ContinuousBatcher, or arespond_as_completed")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Max in-flight API requests of the async mode")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[20], help="Batch sizes to sweep")
+    parser.add_argument("--topks", type=int, nargs="+", default=None, help="Number of retrieved documents to sweep, configs/asqa.json if None")
+    parser.add_argument("--filter_probs", type=float, nargs="+", default=None, help="Retrieval thresholds (theta) to sweep, configs/asqa.json if None")
+    parser.add_argument("--mask_probs", type=float, nargs="+", default=None, help="Masking thresholds (beta) to sweep, configs/asqa.json if None")
+    parser.add_argument("--model", type=str, default="gpt-3.5-turbo-instruct", help="Model name sent to the LM backend")
+    parser.add_argument("--api_base", type=str, default=None, help="Completion API to benchmark against (e.g. model/mock_server.py), an in-process mock if None")
+    parser.add_argument("--local_model", type=str, default=None, help="Hugging Face causal LM to benchmark on CPU (e.g. gpt2) instead of the mock LM")
+    parser.add_argument("--stream", action="store_true", help="Stream the generation calls")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the in-process mock LM")
+    parser.add_argument("--prob_alpha", type=float, default=5, help="Alpha of the Beta distribution of the mock token probabilities")
+    parser.add_argument("--prob_beta", type=float, default=1, help="Beta of the Beta distribution of the mock token probabilities")
+    parser.add_argument("--lm_latency", type=float, default=0.2, help="Seconds before the first token of a mock LM request")
+    parser.add_argument("--lm_latency_per_token", type=float, default=0.01, help="Seconds per token of a mock LM request")
+    parser.add_argument("--retrieval_latency", type=float, default=0.02, help="Seconds per fake retrieve call")
+    parser.add_argument("--retrieval_latency_per_query", type=float, default=0.005, help="Seconds per query of a fake retrieve call")
+    parser.add_argument("--in_process", action="store_true", help="Run every configuration in this process, the peak RSS then accumulates")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Path to save the results as json")
+    parser.add_argument("--compare", type=str, default=None, help="Results json of a previous run to compare with")
+    args = parser.parse_args()
+
+    cur_path = os.path.abspath(os.curdir)
+
+    with open(cur_path + "/configs/asqa.json", 'r') as f:
+        base_config = json.load(f)
+
+    with open(cur_path + f"/dataset/{args.dataset}.json", 'r') as f:
+        questions = [v['ambiguous_question'] for v in json.load(f)['dev'].values()][:args.num_questions]
+
+    results = []
+
+    for config in sweep(base_config, args):
+
+        result = bench(config, questions, args) if args.in_process else bench_isolated(config, questions, args)
+        results.append(result)
+
+        print(
+            f"batch_size={config['batch_size']} topk={config['topk_retriever']} theta={config['look_ahead_filter_prob']} beta={config['look_ahead_mask_prob']}: "
+            f"{result['questions_per_second']:.2f} q/s, {result['api_calls_per_question']:.2f} API calls/q, "
+            f"{result['retrievals_per_question']:.2f} retrievals/q, latency p50 {result['latency_p50']:.2f}s "
+            f"p95 {result['latency_p95']:.2f}s p99 {result['latency_p99']:.2f}s, peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"commit": git_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args), "results": results}, f, indent=4)
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.request
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from retriever import BM25, MULTISEARCH_FILTER_PATH
+
+def msearch(url, request, filter_path=None):
+    '''Sends a raw msearch request, so the bytes on the wire can be measured
+
+    Args:
+        url (str): The ElasticSearch url
+        request (List[Dict[str, object]]): The alternating header and body lines of the msearch request
+        filter_path (List[str]): The response filter, no filtering if None
+
+    Returns:
+        latency (float): The seconds until the whole response was read
+        num_bytes (int): The size of the response body
+    '''
+
+    body = "".join(json.dumps(line) + "\n" for line in request).encode('utf-8')
+    endpoint = f"{url}/_msearch"
+
+    if filter_path:
+        endpoint += "?filter_path=" + ",".join(filter_path)
+
+    req = urllib.request.Request(endpoint, data=body, headers={'Content-Type': 'application/x-ndjson'})
+
+    start = time.perf_counter()
+    with urllib.request.urlopen(req) as resp:
+        payload = resp.read()
+    latency = time.perf_counter() - start
+
+    return latency, len(payload)
+
+def run(es, url, queries, batch_size, configs):
+    '''Runs every configuration over the queries in batches
+
+    Args:
+        es (ElasticSearch): The (patched) beir ElasticSearch wrapper building the requests
+        url (str): The ElasticSearch url
+        queries (List[str]): The queries to search for
+        batch_size (int): The number of queries per msearch request
+        configs (Dict[str, Dict[str, object]]): The request settings to compare
+
+    Returns:
+        results (Dict[str, Dict[str, float]]): Per-query latency and bytes of each configuration
+    '''
+
+    results = {}
+
+    for name, config in configs.items():
+
+        latencies = []
+        num_bytes = []
+
+        for start in range(0, len(queries), batch_size):
+            texts = queries[start:start+batch_size]
+            request = es.multisearch_request(texts, config['size'], search_type=config['search_type'], source=config['source'])
+
+            # Fall back to the default of counting the total hits
+            if config['track_total_hits']:
+                for body in request[1::2]:
+                    del body['track_total_hits']
+
+            latency, size = msearch(url, request, filter_path=config['filter_path'])
+            latencies.append(latency / len(texts))
+            num_bytes.append(size / len(texts))
+
+        results[name] = {
+            "size": config['size'],
+            "latency_ms_mean": 1000 * float(np.mean(latencies)),
+            "latency_ms_p50": 1000 * float(np.percentile(latencies, 50)),
+            "latency_ms_p95": 1000 * float(np.percentile(latencies, 95)),
+            "bytes_per_query": float(np.mean(num_bytes)),
+        }
+
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the msearch requests of BM25.retrieve")
+    parser.add_argument("-d", "--dataset", type=str, default="ASQA_mini", help="Name of ASQA dev dataset to take queries from")
+    parser.add_argument("-k", "--topk", type=int, default=3, help="Number of documents retrieved per query")
+    parser.add_argument("-b", "--batch_size", type=int, default=20, help="Number of queries per msearch request")
+    parser.add_argument("--search_type", type=str, default="dfs_query_then_fetch", help="ElasticSearch search type of the new requests")
+    parser.add_argument("--url", type=str, default="http://localhost:9200", help="ElasticSearch url")
+    parser.add_argument("--index", type=str, default="wikipedia_dpr", help="Name of the ElasticSearch index")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Path to save the results as json")
+    args = parser.parse_args()
+
+    cur_path = os.path.abspath(os.curdir)
+
+    with open(cur_path + f"/dataset/{args.dataset}.json", 'r') as f:
+        queries = [v['ambiguous_question'] for v in json.load(f)['dev'].values()]
+
+    es = BM25(index_name=args.index).retriever.es
+
+    configs = {
+        # The requests sent before, 1000 hits with their full _source through EvaluateRetrieval
+        "before": {
+            "size": 1000,
+            "source": True,
+            "search_type": "dfs_query_then_fetch",
+            "track_total_hits": True,
+            "filter_path": None,
+        },
+        "after": {
+            "size": args.topk,
+            "source": None,
+            "search_type": args.search_type,
+            "track_total_hits": False,
+            "filter_path": MULTISEARCH_FILTER_PATH,
+        },
+    }
+
+    # Warm up the caches of ElasticSearch so both configurations are measured alike
+    run(es, args.url, queries[:args.batch_size], args.batch_size, configs)
+
+    results = run(es, args.url, queries, args.batch_size, configs)
+
+    for name, result in results.items():
+        print(f"{name:>6} (size={result['size']}): {result['latency_ms_mean']:.2f} ms/query (p50 {result['latency_ms_p50']:.2f}, p95 {result['latency_ms_p95']:.2f}), {result['bytes_per_query']:.0f} bytes/query")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
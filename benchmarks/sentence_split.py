@@ -0,0 +1,103 @@
+import os
+import sys
+import timeit
+import argparse
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from nltk.tokenize.punkt import PunktSentenceTokenizer
+
+from sentences import SentenceSplitter
+from mock_server import MockLM
+
+def legacy_extract_sentence(text, min_sent_len=5):
+    '''QueryAgent._extract_sentence before SentenceSplitter, a new tokenizer and namedtuple class and a full scan per call'''
+
+    Sentence = namedtuple('Sentence', 'text start_char end_char')
+    sents = [Sentence(text[s:e], s, e) for s, e in PunktSentenceTokenizer().span_tokenize(text)]
+
+    break_at = 0
+
+    for sent in sents:
+        num_trail_spaces = len(sent.text) - len(sent.text.rstrip())
+        break_at = sent.end_char - num_trail_spaces
+        if break_at >= min_sent_len:
+            break
+
+    return text[:break_at], break_at
+
+def legacy_token_break(text_offset, break_at):
+    '''QueryAgent._token_break before SentenceSplitter, a Python loop over the offsets'''
+
+    init_offset = text_offset[0]
+    trunc_at = 0
+
+    for j in range(len(text_offset)):
+        trunc_at += 1
+        if text_offset[j] - init_offset >= break_at:
+            trunc_at -= 1
+            break
+
+    return trunc_at
+
+def completions(num, num_sents, seed):
+    '''Completions of the mock LM with num_sents sentences, with their token offsets'''
+
+    lm = MockLM(seed=seed, min_answer_sents=num_sents, max_answer_sents=num_sents)
+
+    choices = []
+    for i in range(num):
+        choice = lm.choice(f"Question {i}\nAnswer:", 0, max_tokens=10000, logprobs=0)
+        choices.append((choice["text"], choice["logprobs"]["text_offset"]))
+
+    return choices
+
+def measure(fn, choices, number):
+    '''Microseconds per call of fn over the choices'''
+
+    seconds = timeit.timeit(lambda: [fn(text, offsets) for text, offsets in choices], number=number)
+
+    return 1e6 * seconds / (number * len(choices))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Micro-benchmark the sentence boundary and token truncation of the completions")
+    parser.add_argument("--sents", type=int, nargs="+", default=[1, 4, 16, 64], help="Numbers of sentences per completion to benchmark")
+    parser.add_argument("-n", "--num_completions", type=int, default=200, help="Number of completions per size")
+    parser.add_argument("--number", type=int, default=5, help="Number of timed passes over the completions")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the mock completions")
+    args = parser.parse_args()
+
+    splitter = SentenceSplitter(min_sent_len=5)
+
+    def legacy(text, offsets):
+        sent, break_at = legacy_extract_sentence(text)
+        return sent, legacy_token_break(offsets, break_at)
+
+    def current(text, offsets):
+        sent, break_at = splitter.first(text)
+        return sent, splitter.token_break(offsets, break_at)
+
+    for num_sents in args.sents:
+
+        choices = completions(args.num_completions, num_sents, args.seed)
+
+        # Both paths have to agree before comparing their speed
+        for text, offsets in choices:
+            assert legacy(text, offsets) == current(text, offsets)
+
+        chars = sum(len(text) for text, _ in choices) / len(choices)
+
+        legacy_us = measure(legacy, choices, args.number)
+        current_us = measure(current, choices, args.number)
+
+        print(f"{num_sents} sentences ({chars:.0f} chars): legacy {legacy_us:.1f}us, SentenceSplitter {current_us:.1f}us per completion, {legacy_us / current_us:.1f}x")
+
+        # The two halves apart
+        legacy_split_us = measure(lambda text, offsets: legacy_extract_sentence(text), choices, args.number)
+        split_us = measure(lambda text, offsets: splitter.first(text), choices, args.number)
+        legacy_break_us = measure(lambda text, offsets: legacy_token_break(offsets, len(text)), choices, args.number)
+        break_us = measure(lambda text, offsets: splitter.token_break(offsets, len(text)), choices, args.number)
+
+        print(f"  first sentence: {legacy_split_us:.1f}us -> {split_us:.1f}us, token break at the end: {legacy_break_us:.1f}us -> {break_us:.1f}us")
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(BENCH_DIR, '..', 'model')
+CONFIG_PATH = os.path.join(BENCH_DIR, '..', 'configs', 'asqa.json')
+
+HEAVY_MODULES = ["openai", "nltk", "scipy", "elasticsearch", "torch", "transformers", "retriever", "inverted_index"]
+
+def child(backend, question):
+    '''Times the startup of QueryAgent in this (fresh) interpreter, printing the timings as json
+
+    Args:
+        backend (str): "default" builds the agent as flare.py does (OpenAI API and BM25), "mock" injects the mock LM and
+            a fake retriever and also answers one question
+        question (str): The question answered with the mock backends
+
+    Returns:
+        None
+    '''
+
+    start = time.perf_counter()
+
+    sys.path.insert(0, MODEL_DIR)
+    from openai_api import QueryAgent
+
+    timings = {"import_s": time.perf_counter() - start}
+
+    with open(CONFIG_PATH, 'r') as f:
+        config = json.load(f)
+
+    kwargs = {}
+    if backend == "mock":
+        sys.path.insert(0, BENCH_DIR)
+        from mock_server import MockLM, MockCompletion
+        from flare_throughput import FakeRetriever
+        kwargs = {"lm": MockCompletion(MockLM()), "retriever": FakeRetriever()}
+
+    start = time.perf_counter()
+    qa = QueryAgent(model='gpt-3.5-turbo-instruct', retrieval_kwargs=config, api_key="startup", **kwargs)
+    timings["construct_s"] = time.perf_counter() - start
+
+    if backend == "mock":
+        start = time.perf_counter()
+        qa.respond([question])
+        timings["first_answer_s"] = time.perf_counter() - start
+
+    timings["loaded"] = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    print(json.dumps(timings))
+
+def run(backend, question):
+    '''Runs one fresh interpreter and collects its timings
+
+    Args:
+        backend (str): The backend of the agent
+        question (str): The question answered with the mock backends
+
+    Returns:
+        timings (Dict[str, object]): The import, construction and first answer seconds, the total seconds of the process
+            (interpreter startup included) and the heavy modules loaded by then
+    '''
+
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", "--backend", backend, "--question", question],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    total = time.perf_counter() - start
+
+    timings = json.loads(out.stdout.strip().splitlines()[-1])
+    timings["process_s"] = total
+
+    return timings
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Measure the startup time of QueryAgent, each run in a fresh interpreter")
+    parser.add_argument("--backend", type=str, nargs="+", default=["default", "mock"], choices=["default", "mock"], help="Backends of the agent to measure")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Number of fresh interpreters per backend, the median is reported")
+    parser.add_argument("--question", type=str, default="Who played bonnie in bonnie and clyde?", help="The question answered with the mock backends")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.backend[0], args.question)
+        sys.exit(0)
+
+    for backend in args.backend:
+
+        runs = [run(backend, args.question) for _ in range(args.runs)]
+
+        stages = [stage for stage in ("import_s", "construct_s", "first_answer_s", "process_s") if stage in runs[0]]
+        medians = ", ".join(f"{stage[:-2]} {1000 * np.median([r[stage] for r in runs]):.0f}ms" for stage in stages)
+
+        print(f"{backend}: {medians} (median of {args.runs})")
+        print(f"  loaded: {', '.join(runs[-1]['loaded']) or 'none'}")
@@ -153,6 +153,18 @@ class ASQA(object):
         }
         ]
 
+    def exemplars(self):
+        '''Formats every exemplar for the ASQA task
+
+        Returns:
+            exemplars (List[str]): The formatted exemplars, each ending with a blank line
+        '''
+
+        return [
+            self.question_template(exemplar['question']) + self.ans_template(exemplar['general_hint'], exemplar['subq_cot'], exemplar['answer']) + "\n\n"
+            for exemplar in self.general_hint_in_input_examplars[:self.num_exemplars]
+        ]
+
     def construct_exemplars(self):
         '''Constructs the exemplars for the ASQA task
 
@@ -160,16 +172,7 @@ class ASQA(object):
             exemplars (str): The string of exemplars to prefix input
         '''
 
-        exemplars = ""
-
-        for i in range(self.num_exemplars):
-            exemplars += self.question_template(self.general_hint_in_input_examplars[i]['question'])
-            exemplars += self.ans_template(
-                self.general_hint_in_input_examplars[i]['general_hint'],
-                self.general_hint_in_input_examplars[i]['subq_cot'],
-                self.general_hint_in_input_examplars[i]['answer']
-            )
-            exemplars += "\n\n"
+        exemplars = "".join(self.exemplars())
 
         self.ctx = exemplars
 
@@ -189,11 +192,6 @@ class ASQA(object):
         '''
 
         if not self.ctx_initialized:
-            query = self.construct_exemplars()
-        else:
-            query = self.ctx
-
-        query += context
-        query += self.question_template(question)
+            self.construct_exemplars()
 
-        return query
\ No newline at end of file
+        return "".join([self.ctx, context, self.question_template(question)])
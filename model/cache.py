@@ -0,0 +1,471 @@
+from typing import List, Dict, Any, Tuple, Optional
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+from collections import OrderedDict
+
+class SQLiteCache(object):
+    '''
+    A persistent key-value cache stored in a local SQLite database.
+
+    The database runs in WAL mode with a busy timeout, so several worker processes can read and write the same cache
+    file concurrently. Entries are evicted least recently used first once the cache holds more than max_entries, and
+    expire ttl seconds after they were written.
+
+    Args:
+        path (str): The path of the SQLite database file
+        max_entries (int): The maximum number of entries kept in the cache
+        ttl (float): The number of seconds an entry stays valid, entries never expire if None
+        timeout (float): The number of seconds to wait for a lock held by another process
+
+    Attributes:
+        path (str): This stores the path of the SQLite database file
+        max_entries (int): This stores the maximum number of entries kept in the cache
+        ttl (float): This stores the number of seconds an entry stays valid
+        hits (int): This stores the number of lookups answered by the cache
+        misses (int): This stores the number of lookups not found in the cache
+
+    '''
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 1000000,
+        ttl: float = None,
+        timeout: float = 60,
+    ):
+
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Check the size only every so often, counting rows is a full scan
+        self._evict_every = 1000
+        self._puts_since_evict = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # One connection per instance, shared between the threads of this process
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get_many(
+        self,
+        keys: List[str],
+    ) -> List[Optional[Any]]:
+        '''Looks up several keys at once
+
+        Args:
+            keys (List[str]): The keys to look up
+
+        Returns:
+            values (List[Optional[Any]]): The cached values, None where the key is not cached
+        '''
+
+        if not keys:
+            return []
+
+        unique_keys = list(set(keys))
+        found = {}
+        now = time.time()
+        oldest = now - self.ttl if self.ttl is not None else float('-inf')
+
+        with self._lock:
+
+            # Stay well below SQLite's limit on the number of host parameters
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start+500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(f"SELECT key, value FROM cache WHERE key IN ({marks}) AND created >= ?", [*chunk, oldest]).fetchall()
+                found.update(rows)
+
+            if found:
+                marks = ",".join("?" * len(found))
+                self._conn.execute(f"UPDATE cache SET accessed = ? WHERE key IN ({marks})", [now, *found])
+
+        values = [json.loads(found[key]) if key in found else None for key in keys]
+
+        # ANALYTICS
+        self.hits += sum(value is not None for value in values)
+        self.misses += sum(value is None for value in values)
+
+        return values
+
+    def put_many(
+        self,
+        items: List[Tuple[str, Any]],
+    ):
+        '''Stores several (key, value) pairs at once, values must be JSON serializable
+
+        Args:
+            items (List[Tuple[str, Any]]): The (key, value) pairs to store
+
+        Returns:
+            None
+        '''
+
+        if not items:
+            return
+
+        now = time.time()
+        rows = [(key, json.dumps(value), now, now) for key, value in items]
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+
+            self._puts_since_evict += len(rows)
+
+            if self._puts_since_evict >= self._evict_every:
+                self._puts_since_evict = 0
+                self._evict()
+
+    def _evict(self):
+        '''Drops the expired entries, and the least recently used entries beyond max_entries, callers hold the lock
+
+        Returns:
+            None
+        '''
+
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+
+        count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        '''Returns the hit/miss counters of this process
+
+        Returns:
+            stats (Dict[str, Any]): The number of hits and misses, and the hit rate
+        '''
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+    def close(self):
+        '''Closes the database connection
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            self._conn.close()
+
+class CompletionCache(SQLiteCache):
+    '''
+    A persistent cache of Completion API choices, keyed by the prompt and the sampling parameters.
+
+    Args:
+        path (str): The path of the SQLite database file
+        max_entries (int): The maximum number of choices kept in the cache
+
+    '''
+
+    # Every parameter which changes the output of the Completion API. Streamed choices cut short at a sentence boundary
+    # are never stored (see QueryAgent._store_cache), so the streaming settings are left out
+    KEY_PARAMS = ('model', 'max_tokens', 'temperature', 'top_p', 'logprobs')
+
+    def _key(self, prompt, params):
+        '''Hashes the prompt and the sampling parameters into a cache key
+
+        Args:
+            prompt (str): The prompt to complete
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            key (str): The cache key
+        '''
+
+        payload = {k: params.get(k) for k in self.KEY_PARAMS}
+        payload['prompt'] = prompt
+
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(
+        self,
+        prompts: List[str],
+        params: Dict[str, Any],
+    ) -> List[Optional[Dict[str, Any]]]:
+        '''Looks up the cached choices of the prompts
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            choices (List[Optional[Dict[str, Any]]]): The cached choices, None where the prompt is not cached
+        '''
+
+        return self.get_many([self._key(prompt, params) for prompt in prompts])
+
+    def store(
+        self,
+        prompts: List[str],
+        params: Dict[str, Any],
+        choices: List[Dict[str, Any]],
+    ):
+        '''Stores the choices returned for the prompts
+
+        Args:
+            prompts (List[str]): The prompts which were completed
+            params (Dict[str, Any]): The Completion API parameters
+            choices (List[Dict[str, Any]]): The choices returned, in the order of the prompts
+
+        Returns:
+            None
+        '''
+
+        self.put_many([(self._key(prompt, params), dict(choice)) for prompt, choice in zip(prompts, choices)])
+
+class LRUCache(object):
+    '''
+    A thread-safe in-memory cache evicting the least recently used entries.
+
+    Args:
+        max_entries (int): The maximum number of entries kept in memory
+        ttl (float): The number of seconds an entry stays valid, entries never expire if None
+
+    Attributes:
+        max_entries (int): This stores the maximum number of entries kept in memory
+        ttl (float): This stores the number of seconds an entry stays valid
+        hits (int): This stores the number of lookups answered by the cache
+        misses (int): This stores the number of lookups not found in the cache
+
+    '''
+    def __init__(
+        self,
+        max_entries: int = 100000,
+        ttl: float = None,
+    ):
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (time written, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(
+        self,
+        keys: List[str],
+    ) -> List[Optional[Any]]:
+        '''Looks up several keys at once
+
+        Args:
+            keys (List[str]): The keys to look up
+
+        Returns:
+            values (List[Optional[Any]]): The cached values, None where the key is not cached
+        '''
+
+        values = []
+        oldest = time.time() - self.ttl if self.ttl is not None else float('-inf')
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+
+                if entry is not None and entry[0] < oldest:
+                    del self._entries[key]
+                    entry = None
+
+                if entry is None:
+                    values.append(None)
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    values.append(entry[1])
+                    self.hits += 1
+
+        return values
+
+    def put_many(
+        self,
+        items: List[Tuple[str, Any]],
+    ):
+        '''Stores several (key, value) pairs at once
+
+        Args:
+            items (List[Tuple[str, Any]]): The (key, value) pairs to store
+
+        Returns:
+            None
+        '''
+
+        now = time.time()
+
+        with self._lock:
+            for key, value in items:
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        '''Returns the hit/miss counters
+
+        Returns:
+            stats (Dict[str, Any]): The number of hits and misses, and the hit rate
+        '''
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+class RetrievalCache(object):
+    '''
+    A two-level cache of retrieval results: an in-memory LRU in front of an optional persistent SQLite store.
+
+    Results are keyed by the normalized query text, the index name and topk.
+
+    Args:
+        max_entries (int): The maximum number of results kept in memory
+        ttl (float): The number of seconds a result stays valid, results never expire if None
+        path (str): The path of the persistent store, memory only if None
+        max_persistent_entries (int): The maximum number of results kept in the persistent store
+
+    Attributes:
+        memory (LRUCache): This stores the in-memory level
+        persistent (SQLiteCache): This stores the persistent level, None if disabled
+
+    '''
+    def __init__(
+        self,
+        max_entries: int = 100000,
+        ttl: float = None,
+        path: str = None,
+        max_persistent_entries: int = 1000000,
+    ):
+
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.persistent = SQLiteCache(path, max_entries=max_persistent_entries, ttl=ttl) if path else None
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        '''Normalizes a query so that trivially different queries share a cache entry
+
+        Elasticsearch lowercases and tokenizes on whitespace anyway, so case and spacing do not change the results.
+
+        Args:
+            query (str): The query to the retriever
+
+        Returns:
+            normalized (str): The normalized query
+        '''
+
+        return " ".join(unicodedata.normalize('NFKC', query).lower().split())
+
+    def key(self, query: str, index_name: str, topk: int) -> str:
+        '''Builds the cache key of a retrieval
+
+        Args:
+            query (str): The query to the retriever
+            index_name (str): The index retrieved from
+            topk (int): The number of documents retrieved
+
+        Returns:
+            key (str): The cache key
+        '''
+
+        return json.dumps([index_name, topk, self.normalize(query)])
+
+    def get_many(
+        self,
+        keys: List[str],
+    ) -> List[Optional[Any]]:
+        '''Looks up several keys, first in memory then in the persistent store
+
+        Args:
+            keys (List[str]): The keys to look up
+
+        Returns:
+            values (List[Optional[Any]]): The cached values, None where the key is not cached
+        '''
+
+        values = self.memory.get_many(keys)
+
+        if self.persistent is not None:
+            missing = [i for i, value in enumerate(values) if value is None]
+            found = self.persistent.get_many([keys[i] for i in missing])
+
+            # Promote the persistent hits to memory
+            self.memory.put_many([(keys[i], value) for i, value in zip(missing, found) if value is not None])
+
+            for i, value in zip(missing, found):
+                values[i] = value
+
+        return values
+
+    def put_many(
+        self,
+        items: List[Tuple[str, Any]],
+    ):
+        '''Stores several (key, value) pairs in both levels, values must be JSON serializable
+
+        Args:
+            items (List[Tuple[str, Any]]): The (key, value) pairs to store
+
+        Returns:
+            None
+        '''
+
+        self.memory.put_many(items)
+
+        if self.persistent is not None:
+            self.persistent.put_many(items)
+
+    def stats(self) -> Dict[str, Any]:
+        '''Returns the hit/miss counters of both levels
+
+        Returns:
+            stats (Dict[str, Any]): The overall hits, misses and hit rate, and the stats of each level
+        '''
+
+        hits = self.memory.hits
+        misses = self.memory.misses
+
+        stats = {"memory": self.memory.stats()}
+
+        if self.persistent is not None:
+            hits += self.persistent.hits
+            misses = self.persistent.misses
+            stats["persistent"] = self.persistent.stats()
+
+        stats["hits"] = hits
+        stats["misses"] = misses
+        stats["hit_rate"] = hits / (hits + misses) if hits + misses else 0
+
+        return stats
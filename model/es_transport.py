@@ -0,0 +1,292 @@
+from typing import Any, Dict, List
+import time
+import asyncio
+import itertools
+import threading
+import numpy as np
+
+from collections import deque
+
+from elasticsearch import AsyncElasticsearch
+
+class AsyncMultiSearch(object):
+    '''
+    A multisearch transport for the retriever, with a pool of connections per ElasticSearch node and bounded tail latency.
+
+    A multisearch request is split into sub-requests of sub_batch_size queries, which are sent concurrently over the
+    connection pools (at most max_in_flight at a time) instead of one after the other, so a slow shard only holds back
+    the queries of its own sub-request. A sub-request still unanswered after the hedge_percentile of the recent
+    sub-request latencies (hedge_after seconds until enough latencies were seen), and at most hedge_max_delay seconds,
+    is sent again to the next node, and again after as long to the node after, up to max_hedges times. The first answer
+    wins, the other requests being cancelled. Every copy goes to a node of its own, so there are no hedges with a single
+    node, and the hedges have a budget of their own (max_hedges_in_flight) on top of max_in_flight: a hedge never waits
+    behind the requests it is meant to overtake, and past the budget sub-requests are simply not hedged. The ceiling
+    keeps the hedging delay short of the stalls themselves, which the percentile reaches once more than
+    100 - hedge_percentile percent of the requests stall. A failed sub-request is retried once on the next node.
+
+    The requests run on an event loop of their own, in a background thread, so msearch can be called from any thread
+    (e.g. the worker threads of QueryAgent.arespond) with the interface of Elasticsearch.msearch.
+
+    Args:
+        hosts (List[str]): The ElasticSearch nodes, e.g. ["localhost:9200", "localhost:9201"], hedges go to the next nodes
+        pool_size (int): The maximum number of open connections per node
+        sub_batch_size (int): The maximum number of queries per sub-request
+        max_in_flight (int): The maximum number of sub-requests in flight, hedges excluded
+        request_timeout (float): The number of seconds before a sub-request fails
+        hedge_percentile (float): The percentile of the recent latencies after which a sub-request is hedged, never hedged if None
+        hedge_after (float): The number of seconds after which a sub-request is hedged until min_samples latencies were seen
+        hedge_max_delay (float): The maximum number of seconds after which a sub-request is hedged
+        max_hedges (int): The maximum number of hedges per sub-request, at most one per other node
+        max_hedges_in_flight (int): The maximum number of hedges in flight
+        min_samples (int): The number of latencies needed to estimate the hedge_percentile
+        window (int): The number of recent latencies the hedge_percentile is estimated from
+        http_compress (bool): Whether the requests and responses are gzipped
+
+    Attributes:
+        hosts (List[str]): This stores the ElasticSearch nodes
+        sub_batch_size (int): This stores the maximum number of queries per sub-request
+        request_timeout (float): This stores the number of seconds before a sub-request fails
+        hedge_percentile (float): This stores the percentile of the latencies after which a sub-request is hedged
+        hedge_after (float): This stores the hedging delay until min_samples latencies were seen
+        hedge_max_delay (float): This stores the maximum hedging delay
+        max_hedges (int): This stores the maximum number of hedges per sub-request, 0 with a single node
+        max_hedges_in_flight (int): This stores the maximum number of hedges in flight
+
+    '''
+    def __init__(
+        self,
+        hosts: List[str] = ["localhost"],
+        pool_size: int = 32,
+        sub_batch_size: int = 8,
+        max_in_flight: int = 16,
+        request_timeout: float = 10,
+        hedge_percentile: float = 95,
+        hedge_after: float = 0.5,
+        hedge_max_delay: float = 0.5,
+        max_hedges: int = 2,
+        max_hedges_in_flight: int = 4,
+        min_samples: int = 20,
+        window: int = 1000,
+        http_compress: bool = False,
+    ):
+
+        self.hosts = list(hosts)
+        self.sub_batch_size = sub_batch_size
+        self.request_timeout = request_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.hedge_max_delay = hedge_max_delay
+        self.max_hedges = min(max_hedges, len(self.hosts) - 1)
+        self.max_hedges_in_flight = max_hedges_in_flight
+        self.min_samples = min_samples
+
+        self._pool_size = pool_size
+        self._max_in_flight = max_in_flight
+        self._http_compress = http_compress
+
+        # The clients and the semaphore are bound to the event loop of the transport, created on its first request
+        self._clients = None
+        self._in_flight = None
+        self._hedges_in_flight = 0
+        self._nodes = itertools.count()
+        self._latencies = deque(maxlen=window)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="es-transport", daemon=True)
+        self._thread.start()
+
+        # ANALYTICS
+        self._requests = 0
+        self._sub_requests = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._retries = 0
+        self._failures = 0
+
+    def msearch(
+        self,
+        body: List[Dict[str, Any]],
+        filter_path: List[str] = None,
+    ) -> Dict[str, Any]:
+        '''Sends a multisearch request, like Elasticsearch.msearch
+
+        Args:
+            body (List[Dict[str, Any]]): The alternating header and body lines of the request
+            filter_path (List[str]): The response filter, no filtering if None
+
+        Returns:
+            response (Dict[str, Any]): The response, with one entry of "responses" per query in the order of the request
+        '''
+
+        return asyncio.run_coroutine_threadsafe(self.amsearch(body, filter_path), self._loop).result()
+
+    async def amsearch(
+        self,
+        body: List[Dict[str, Any]],
+        filter_path: List[str] = None,
+    ) -> Dict[str, Any]:
+        '''Asynchronous version of msearch, to be awaited on the event loop of the transport
+
+        Args:
+            body (List[Dict[str, Any]]): The alternating header and body lines of the request
+            filter_path (List[str]): The response filter, no filtering if None
+
+        Returns:
+            response (Dict[str, Any]): The response, with one entry of "responses" per query in the order of the request
+        '''
+
+        if self._clients is None:
+            self._clients = [
+                AsyncElasticsearch([host], maxsize=self._pool_size, timeout=self.request_timeout, max_retries=0, http_compress=self._http_compress)
+                for host in self.hosts
+            ]
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+
+        # Two lines per query
+        step = 2 * self.sub_batch_size
+        sub_bodies = [body[start:start + step] for start in range(0, len(body), step)]
+
+        # ANALYTICS
+        self._requests += 1
+        self._sub_requests += len(sub_bodies)
+
+        sub_responses = await asyncio.gather(*[self._hedged(sub_body, filter_path) for sub_body in sub_bodies])
+
+        return {"responses": [response for sub_response in sub_responses for response in sub_response["responses"]]}
+
+    async def _hedged(self, body, filter_path):
+        '''Sends a sub-request, and again to the next nodes while it is slower than the hedging delay, or once if it fails
+
+        Args:
+            body (List[Dict[str, Any]]): The lines of the sub-request
+            filter_path (List[str]): The response filter, no filtering if None
+
+        Returns:
+            response (Dict[str, Any]): The first successful response
+        '''
+
+        node = next(self._nodes)
+
+        tasks = [asyncio.ensure_future(self._send(node, body, filter_path))]
+        pending = set(tasks)
+        hedges = 0
+        retried = False
+        error = None
+
+        while pending:
+            delay = self._hedge_delay() if hedges < self.max_hedges else None
+            done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+
+                    # ANALYTICS
+                    self._hedge_wins += int(task is not tasks[0])
+
+                    return task.result()
+
+                error = task.exception()
+
+            if done:
+                # Retry once when every copy failed
+                if not pending and not retried:
+                    retried = True
+                    tasks.append(asyncio.ensure_future(self._send(node + len(tasks), body, filter_path)))
+                    pending.add(tasks[-1])
+
+                    # ANALYTICS
+                    self._retries += 1
+
+            # Past the hedging budget, the sub-request waits for the copies already sent
+            elif self._hedges_in_flight < self.max_hedges_in_flight:
+                hedges += 1
+                tasks.append(asyncio.ensure_future(self._send(node + len(tasks), body, filter_path, hedge=True)))
+                pending.add(tasks[-1])
+
+                # ANALYTICS
+                self._hedges += 1
+
+        # ANALYTICS
+        self._failures += 1
+
+        raise error
+
+    async def _send(self, node, body, filter_path, hedge=False):
+        '''Sends a sub-request to a node, recording its latency
+
+        Args:
+            node (int): The node to send to, modulo the number of nodes
+            body (List[Dict[str, Any]]): The lines of the sub-request
+            filter_path (List[str]): The response filter, no filtering if None
+            hedge (bool): Whether the request is a hedge, counted in the hedging budget instead of max_in_flight
+
+        Returns:
+            response (Dict[str, Any]): The response of the node
+        '''
+
+        if hedge:
+            self._hedges_in_flight += 1
+            try:
+                return await self._request(node, body, filter_path)
+            finally:
+                self._hedges_in_flight -= 1
+
+        async with self._in_flight:
+            return await self._request(node, body, filter_path)
+
+    async def _request(self, node, body, filter_path):
+        '''Sends a sub-request to a node right away, see _send'''
+
+        start = time.perf_counter()
+        response = await self._clients[node % len(self._clients)].msearch(body=body, filter_path=filter_path, request_timeout=self.request_timeout)
+        self._latencies.append(time.perf_counter() - start)
+
+        return response
+
+    def _hedge_delay(self):
+        '''The seconds after which a sub-request is hedged, None if hedging is off'''
+
+        if self.hedge_percentile is None or self.max_hedges < 1:
+            return None
+
+        if len(self._latencies) < self.min_samples:
+            return min(self.hedge_after, self.hedge_max_delay)
+
+        return min(float(np.percentile(self._latencies, self.hedge_percentile)), self.hedge_max_delay)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        '''The number of requests, sub-requests, hedges (and hedges answered first), retries, failures, and the sub-request latency percentiles'''
+
+        latencies = list(self._latencies)
+
+        stats = {
+            "requests": self._requests,
+            "sub_requests": self._sub_requests,
+            "hedged": self._hedges,
+            "hedge_wins": self._hedge_wins,
+            "retries": self._retries,
+            "failures": self._failures,
+        }
+
+        for p in (50, 95, 99):
+            stats[f"p{p}_ms"] = 1000 * float(np.percentile(latencies, p)) if latencies else 0.0
+
+        return stats
+
+    def close(self):
+        '''Closes the connection pools and stops the event loop of the transport
+
+        Returns:
+            None
+        '''
+
+        async def close_clients():
+            for client in self._clients or []:
+                await client.close()
+
+        asyncio.run_coroutine_threadsafe(close_clients(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -1,9 +1,10 @@
 import os
 import json
-import math
+import asyncio
 import argparse
 
 from openai_api import QueryAgent
+from scheduler import ContinuousBatcher
 
 if __name__ == "__main__":
 
@@ -13,12 +14,31 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Define experiment")
     parser.add_argument("-d", "--dataset", type=str, default="ASQA", help="Name of ASQA dev dataset")
     parser.add_argument("-n", "--name", type=str, default="final-predictions", help="Name of the experiment")
+    parser.add_argument("-b", "--batch_size", type=int, default=20, help="Number of questions answered at the same time")
+    parser.add_argument("--cache_path", type=str, default="cache/completions.db", help="Persistent completion cache, pass an empty string to disable")
+    parser.add_argument("--retrieval_cache_path", type=str, default="cache/retrieval.db", help="Persistent retrieval cache, pass an empty string to keep it in memory only")
+    parser.add_argument("-c", "--concurrency", type=int, default=0, help="Max in-flight API requests, answers all questions concurrently if > 0")
+    parser.add_argument("--checkpoint_every", type=int, default=20, help="Number of answered questions between analytics checkpoints")
+    parser.add_argument("--resume", action="store_true", help="Skip the questions already answered in outputs/{name}.jsonl and continue the run")
+    parser.add_argument("--stream", action="store_true", help="Stream the generation calls and stop them at the first sentence boundary")
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute limit of the OpenAI account")
+    parser.add_argument("--tpm", type=float, default=None, help="Tokens per minute limit of the OpenAI account")
+    parser.add_argument("--api_base", type=str, default=None, help="Base URL of the Completion API, e.g. a local stand-in server")
+    parser.add_argument("--local_model", type=str, default=None, help="Generate with this Hugging Face causal LM on CPU (e.g. gpt2) instead of the OpenAI API")
+    parser.add_argument("--local_cache_mb", type=int, default=512, help="Memory for the cached KV states of the local LM, gpt2 takes 72KB per token")
+    parser.add_argument("--trace", action="store_true", help="Record the timings of the FLARE stages to outputs/{name}-trace.jsonl and .json (Chrome trace)")
     # Parse the arguments
     args = parser.parse_args()
 
     # Retrieve the API key saved in environment
     api_key = os.getenv("OPENAI_API_KEY")
 
+    # Local generation, the KV states of the shared prompt prefixes are reused across FLARE iterations
+    lm = None
+    if args.local_model:
+        from local_lm import LocalLM
+        lm = LocalLM(args.local_model, cache_bytes=args.local_cache_mb * 2 ** 20)
+
     # Instatiate the Query Agent for OpenAI API Calls
     with open(cur_path + "/configs/asqa.json", 'r') as f:
 
@@ -27,6 +47,14 @@ if __name__ == "__main__":
             model='gpt-3.5-turbo-instruct',
             retrieval_kwargs=json.load(f),
             api_key=api_key, 
+            max_concurrency=max(args.concurrency, 1),
+            cache_path=os.path.join(cur_path, args.cache_path) if args.cache_path else None,
+            retrieval_cache_path=os.path.join(cur_path, args.retrieval_cache_path) if args.retrieval_cache_path else None,
+            stream=args.stream,
+            api_base=args.api_base,
+            trace=args.trace,
+            lm=lm,
+            rate_limits={"requests_per_minute": args.rpm, "tokens_per_minute": args.tpm, "max_batch_size": args.batch_size},
         )
 
     # Retrieve the evaluation questions
@@ -35,46 +63,86 @@ if __name__ == "__main__":
         questions = json.load(f)
         questions = questions['dev']
 
+    # Predictions are streamed to an append-only file as each question is answered
+    stream_path = cur_path + f"/outputs/{args.name}.jsonl"
+    analytics_path = f"/outputs/{args.name}-analytics.json"
+    done = set()
+
+    if args.resume and os.path.exists(stream_path):
+
+        # The analytics only account for the answers written before their last checkpoint, the later ones are answered again
+        answered = 0
+        if os.path.exists(cur_path + analytics_path):
+            answered = qa._load_analytics(analytics_path)
+
+        valid_bytes = 0
+
+        with open(stream_path, 'rb') as f:
+            for line in f:
+                if answered is not None and len(done) == answered:
+                    break
+                # A crash can leave the last line half written
+                try:
+                    done.add(json.loads(line)['id'])
+                except json.JSONDecodeError:
+                    break
+                valid_bytes += len(line)
+
+        # Drop the answers after the checkpoint and the half written line before appending
+        os.truncate(stream_path, valid_bytes)
+
+        print(f"Resuming, {len(done)} / {len(questions)} questions already answered")
+
+    pending = [(k, v['ambiguous_question']) for k, v in questions.items() if k not in done]
+
     # Gather predictions
     num_qs = len(questions)
-    batch_size = 20
-    batch_num = 0
-    count = 0
-    predictions = dict()
 
-    batch_keys = []
-    batch_questions = []
-    batch_responses = []
-    
-    for k, v in questions.items():
+    with open(stream_path, 'a' if args.resume else 'w') as stream:
+
+        def record(k, response):
+
+            stream.write(json.dumps({"id": k, "prediction": response}) + "\n")
+            stream.flush()
+
+            done.add(k)
+            print(f"Question {len(done)} / {num_qs}")
+
+            # Checkpoint analytics, with the number of answers they account for
+            if len(done) % args.checkpoint_every == 0:
+                qa._save_analytics(analytics_path, answered=len(done))
 
-        batch_keys.append(k)
-        batch_questions.append(v['ambiguous_question'])
+        if args.concurrency > 0:
 
-        count += 1
+            # Every question runs its own FLARE loop, overlapping API calls and retrievals across questions
+            async def answer_all():
+                async for k, response in qa.arespond_as_completed(pending):
+                    record(k, response)
 
-        if count % batch_size == 0 or count == num_qs:
-            # Track batch num
-            batch_num += 1
-            bs = count - batch_size * (batch_num - 1)
-            print(f"Batch {batch_num} / {math.ceil(num_qs/batch_size)}, Size: {bs}")
+            asyncio.run(answer_all())
 
-            # Query the agent
-            batch_responses = qa.respond(batch_questions)
+        else:
 
-            # Save the results
-            for i in range(bs):
-                predictions[batch_keys[i]] = batch_responses[i]
+            # Keep batch_size questions in flight, a finished question immediately hands its slot to the next one
+            batcher = ContinuousBatcher(qa, num_slots=args.batch_size)
 
-            # Reset batch variables
-            batch_keys = []
-            batch_questions = []
-            batch_responses = []
+            for k, response in batcher.run(pending):
+                record(k, response)
+
+    # Merge the streamed predictions into the ASQA format
+    predictions = dict()
+
+    with open(stream_path, 'r') as f:
+        for line in f:
+            prediction = json.loads(line)
+            predictions[prediction['id']] = prediction['prediction']
 
     with open(cur_path + f"/outputs/{args.name}.json", 'w') as f:
 
         json.dump(predictions, f)
 
     # Save analytics
-    qa._save_analytics(f"/outputs/{args.name}-analytics.json")
-    
\ No newline at end of file
+    qa._save_analytics(analytics_path, answered=len(done))
+
+    if args.trace:
+        qa._save_trace(f"/outputs/{args.name}-trace")
@@ -0,0 +1,307 @@
+from typing import List, Dict, Tuple
+import os
+import re
+import json
+import uuid
+import numpy as np
+import scipy.sparse as sp
+
+from functools import lru_cache
+from collections import Counter
+from nltk.stem.porter import PorterStemmer
+
+from passage_store import PassageStore
+from state import RetrievalResult
+
+# Stop words of Lucene's english analyzer
+ENGLISH_STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in", "into", "is", "it", "no", "not", "of",
+    "on", "or", "such", "that", "the", "their", "then", "there", "these", "they", "this", "to", "was", "will", "with",
+])
+
+# Words, keeping inner apostrophes, and the decimal points and thousands separators between digits, like the standard
+# tokenizer (which splits "a,b" and "a.b" between letters)
+TOKEN_PATTERN = re.compile(r"\w+(?:['’]\w+|(?<=\d)[.,](?=\d)\w+)*")
+
+_stemmer = PorterStemmer(PorterStemmer.ORIGINAL_ALGORITHM)
+
+@lru_cache(maxsize=1000000)
+def _stem(token: str) -> str:
+    return _stemmer.stem(token, to_lowercase=False)
+
+def analyze(text: str) -> List[str]:
+    '''Approximates ElasticSearch's english analyzer used for the title and txt fields of the index
+
+    standard tokenizer -> possessive stemmer -> lowercase -> english stop words -> porter stemmer
+
+    Args:
+        text (str): The text to analyze
+
+    Returns:
+        terms (List[str]): The terms of the text
+    '''
+
+    terms = []
+
+    for token in TOKEN_PATTERN.findall(text.lower()):
+
+        if token.endswith(("'s", "’s")):
+            token = token[:-2]
+
+        if token in ENGLISH_STOP_WORDS:
+            continue
+
+        # Like Lucene's PorterStemmer, words of one or two letters are not stemmed ("s" would become "")
+        terms.append(_stem(token) if len(token) > 2 else token)
+
+    return terms
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Encodes non-negative integers as varints, 7 bits per byte, the high bit set on all but the last byte of a value
+
+    Args:
+        values (np.ndarray): The integers to encode, below 2**35
+
+    Returns:
+        data (np.ndarray): The uint8 bytes of the values, one after the other
+        num_bytes (np.ndarray): The number of bytes of every value
+    '''
+
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = 1 + sum((values >= (1 << (7 * k))).astype(np.int64) for k in range(1, 5))
+
+    owner = np.repeat(np.arange(len(values)), num_bytes)
+    position = np.arange(len(owner)) - np.repeat(np.cumsum(num_bytes) - num_bytes, num_bytes)
+
+    data = (values[owner] >> (7 * position).astype(np.uint64)) & np.uint64(0x7f)
+    data |= (position < num_bytes[owner] - 1).astype(np.uint64) << np.uint64(7)
+
+    return data.astype(np.uint8), num_bytes
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    '''Decodes the varints written by encode_varints
+
+    Args:
+        data (np.ndarray): The uint8 bytes of the values
+
+    Returns:
+        values (np.ndarray): The int64 values
+    '''
+
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    last = data < 0x80
+    starts = np.concatenate([[0], np.flatnonzero(last)[:-1] + 1])
+    owner = np.concatenate([[0], np.cumsum(last)[:-1]])
+    position = np.arange(len(data)) - starts[owner]
+
+    # The 7 bit groups of a value do not overlap, so or-ing them adds them up
+    return np.bitwise_or.reduceat((data & 0x7f).astype(np.int64) << (7 * position), starts)
+
+class InvertedIndexBM25(object):
+    '''
+    An in-process BM25 retriever over an inverted index built by setup/build_inverted_index.py.
+
+    The postings of every field are stored term-major (CSR over terms x documents) in memory-mapped files: the document
+    rows of a posting list as the varints of their gaps (1 or 2 bytes per posting for the frequent terms instead of 4),
+    and the BM25 term-frequency normalizations as float16, precomputed at build time. A batch of queries is scored with
+    one sparse matrix product per field over only the postings of the query terms, decoded on the fly, following the
+    multi_match best_fields query of elasticsearch_lexical_multisearch:
+
+        score = max_f(score_f) + tie_breaker * sum of the other field scores
+
+    Args:
+        index_path (str): The directory written by setup/build_inverted_index.py
+        tie_breaker (float): The weight of the non-best fields
+
+    Attributes:
+        max_ret_topk (int): The maximum number of documents
+        index_path (str): This stores the directory of the index
+        fields (List[str]): The indexed fields
+        num_docs (int): The number of documents in the index
+        vocab (Dict[str, int]): The term ids
+        passages (PassageStore): The ids and texts of the documents
+
+    '''
+    def __init__(
+        self,
+        index_path: str,
+        tie_breaker: float = 0.5,
+    ):
+
+        self.max_ret_topk = 1000
+        self.index_path = index_path
+        self.tie_breaker = tie_breaker
+
+        with open(os.path.join(index_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        if meta.get('postings') != 'delta-varint':
+            raise ValueError(f'The inverted index at {index_path} stores uncompressed postings, rebuild it with setup/build_inverted_index.py')
+
+        self.fields = meta['fields']
+        self.num_docs = meta['num_docs']
+
+        with open(os.path.join(index_path, 'vocab.json'), 'r') as f:
+            self.vocab: Dict[str, int] = json.load(f)
+
+        # Postings, memory-mapped so only the postings of the query terms are ever read
+        self._indptr = {}
+        self._docptr = {}
+        self._docs = {}
+        self._impacts = {}
+        self._doc_count = {}
+
+        for field in self.fields:
+            self._indptr[field] = np.load(os.path.join(index_path, f'{field}.indptr.npy'), mmap_mode='r')
+            self._docptr[field] = np.load(os.path.join(index_path, f'{field}.docptr.npy'), mmap_mode='r')
+            self._docs[field] = self._load_bytes(os.path.join(index_path, f'{field}.docs.bin'))
+            self._impacts[field] = np.load(os.path.join(index_path, f'{field}.impacts.npy'), mmap_mode='r')
+            self._doc_count[field] = meta['doc_count'][field]
+
+        self.passages = PassageStore(index_path)
+
+    @staticmethod
+    def _load_bytes(path):
+        # np.memmap cannot map an empty file (a field without any term)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.uint8)
+
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    def _get_random_doc_id(self):
+        return f'_{uuid.uuid4()}'
+
+    def retrieve(
+        self,
+        queries: List[str],
+        topk: int = 1,
+    ):
+        '''Scores the documents for the given queries and returns the topk results
+
+        Args:
+            queries (List[str]): The list of queries from the user for the model to answer
+            topk (int): The maximum number of documents to return
+
+        Returns:
+            result (RetrievalResult): The (bs, topk) document ids retrieved, and their texts, read when accessed
+        '''
+        assert topk <= self.max_ret_topk
+        bs = len(queries)
+
+        scores = self._score(queries)
+
+        # Prepare outputs, -1 rows are dummy docs
+        docids: List[List[str]] = []
+        rows = np.full((bs, topk), -1, dtype=np.int64)
+
+        for qid in range(bs):
+
+            start, end = scores.indptr[qid], scores.indptr[qid+1]
+            _rows, row_scores = scores.indices[start:end], scores.data[start:end]
+
+            # Top k of the matching documents, best first
+            if len(_rows) > topk:
+                best = np.argpartition(-row_scores, topk)[:topk]
+                _rows, row_scores = _rows[best], row_scores[best]
+
+            order = np.argsort(-row_scores, kind='stable')
+            rows[qid, :len(order)] = _rows[order]
+
+            _docids = [str(self.passages.ids[row]) for row in _rows[order]]
+
+            # Add dummy docs to reach topk length
+            if len(_docids) < topk:
+                _docids += [self._get_random_doc_id() for _ in range(topk - len(_docids))]
+
+            docids.append(_docids)
+
+        docs = self.passages.lazy(rows)  # (bs, topk)
+        return RetrievalResult(docids, docs)
+
+    def _score(
+        self,
+        queries: List[str],
+    ) -> sp.csr_matrix:
+        '''Scores every document matching any query term, for a whole batch of queries at once
+
+        Args:
+            queries (List[str]): The list of queries
+
+        Returns:
+            scores (sp.csr_matrix): Shape (bs, num_docs), the best_fields BM25 scores of the matching documents
+        '''
+
+        bs = len(queries)
+
+        # Query term counts, a repeated term scores once per occurrence as in ElasticSearch
+        counts = [Counter(term for term in analyze(query) if term in self.vocab) for query in queries]
+        terms = sorted({term for count in counts for term in count})
+
+        if not terms:
+            return sp.csr_matrix((bs, self.num_docs), dtype=np.float32)
+
+        term_ids = np.array([self.vocab[term] for term in terms], dtype=np.int64)
+        column = {term: j for j, term in enumerate(terms)}
+
+        q_rows = np.array([i for i, count in enumerate(counts) for _ in count], dtype=np.int64)
+        q_cols = np.array([column[term] for count in counts for term in count], dtype=np.int64)
+        q_vals = np.array([tf for count in counts for tf in count.values()], dtype=np.float32)
+
+        field_scores = []
+
+        for field in self.fields:
+
+            postings = self._postings(field, term_ids)
+
+            # Lucene's idf, with the document count of the field
+            df = np.diff(postings.indptr).astype(np.float32)
+            idf = np.log(1 + (self._doc_count[field] - df + 0.5) / (df + 0.5))
+
+            weights = sp.csr_matrix((q_vals * idf[q_cols], (q_rows, q_cols)), shape=(bs, len(terms)))
+            field_scores.append((weights @ postings).tocsr())
+
+        # best_fields: the best field plus tie_breaker times the others
+        total = field_scores[0]
+        best = field_scores[0]
+
+        for scores in field_scores[1:]:
+            total = total + scores
+            best = best.maximum(scores)
+
+        scores = (best * (1 - self.tie_breaker) + total * self.tie_breaker).tocsr()
+        scores.sort_indices()
+
+        return scores
+
+    def _postings(
+        self,
+        field: str,
+        term_ids: np.ndarray,
+    ) -> sp.csr_matrix:
+        '''Reads the postings of the given terms
+
+        Args:
+            field (str): The field to read the postings of
+            term_ids (np.ndarray): The ids of the terms
+
+        Returns:
+            postings (sp.csr_matrix): Shape (len(term_ids), num_docs), the term-frequency normalizations of the terms
+        '''
+
+        indptr = self._indptr[field]
+        starts = indptr[term_ids]
+        ends = indptr[term_ids + 1]
+
+        docptr = self._docptr[field]
+        gaps = decode_varints(np.concatenate([self._docs[field][start:end] for start, end in zip(docptr[term_ids], docptr[term_ids + 1])]))
+        impacts = np.concatenate([self._impacts[field][start:end] for start, end in zip(starts, ends)]).astype(np.float32)
+
+        sub_indptr = np.concatenate([[0], np.cumsum(ends - starts)])
+
+        # Every posting list starts from document 0, the gaps add up to the documents
+        totals = np.concatenate([[0], np.cumsum(gaps)])
+        docs = (totals[1:] - np.repeat(totals[sub_indptr[:-1]], ends - starts)).astype(np.int32)
+
+        return sp.csr_matrix((impacts, docs, sub_indptr), shape=(len(term_ids), self.num_docs))
@@ -0,0 +1,431 @@
+from typing import Any, Dict, List, Tuple, Union
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+class PrefixCache(object):
+    '''
+    The KV states of the last token sequences run through the model. A new prompt resumes from the cached state sharing
+    its longest token prefix, so only its new tokens go through the model.
+
+    Every FLARE prompt starts with the same exemplars, and without retrieval the prompt of a question is its previous
+    prompt followed by the sentence just generated. The cached state of a question thus covers its whole next prompt
+    but the tokens at the boundary, and a new question reuses the state of the exemplars.
+
+    The states are past_key_values tuples with one (key, value) pair of shape (batch, heads, seq, head_dim) per layer,
+    the layout of GPT-2, GPT-Neo, GPT-J, OPT and most causal LMs of transformers. A token costs 2 * layers * hidden
+    floats, e.g. 72KB for gpt2 and 192KB for gpt2-medium in float32, so the cache is bounded by bytes rather than tokens.
+
+    Args:
+        max_bytes (int): The maximum size of the states kept, the least recently used are evicted first
+
+    '''
+    def __init__(
+        self,
+        max_bytes: int = 512 * 2 ** 20,
+    ):
+
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, ids: np.ndarray) -> Tuple[int, Any]:
+        '''Finds the cached state sharing the longest prefix with a token sequence
+
+        Args:
+            ids (np.ndarray): The token ids of the prompt
+
+        Returns:
+            length (int): The number of leading tokens whose state is reused, 0 if none
+            past (Any): The past_key_values of these tokens, None if none
+        '''
+
+        with self._lock:
+
+            best_key, best_length = None, 0
+
+            for key, (cached, _, _) in self._entries.items():
+                n = min(len(cached), len(ids))
+                mismatch = np.flatnonzero(cached[:n] != ids[:n])
+                length = int(mismatch[0]) if len(mismatch) else n
+
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            # The last token always goes through the model, for the distribution of the next one
+            best_length = min(best_length, len(ids) - 1)
+
+            if best_key is None or best_length <= 0:
+                return 0, None
+
+            self._entries.move_to_end(best_key)
+            past = self._entries[best_key][1]
+
+        return best_length, _crop(past, best_length)
+
+    def store(self, ids: np.ndarray, past: Any):
+        '''Caches the state of a token sequence, replacing the cached sequences it extends
+
+        Args:
+            ids (np.ndarray): The token ids run through the model
+            past (Any): Their past_key_values
+
+        Returns:
+            None
+        '''
+
+        if past is None or len(ids) == 0:
+            return
+
+        num_bytes = _nbytes(past)
+        if num_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+
+            for key, (cached, _, cached_bytes) in list(self._entries.items()):
+                if len(cached) <= len(ids) and np.array_equal(cached, ids[:len(cached)]):
+                    del self._entries[key]
+                    self._num_bytes -= cached_bytes
+
+            self._entries[self._next_key] = (ids, past, num_bytes)
+            self._num_bytes += num_bytes
+            self._next_key += 1
+
+            while self._num_bytes > self.max_bytes:
+                _, (_, _, cached_bytes) = self._entries.popitem(last=False)
+                self._num_bytes -= cached_bytes
+
+    @property
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+class LocalLM(object):
+    '''
+    A small Hugging Face causal LM run on CPU, served with the interface of openai.Completion for QueryAgent(lm=...).
+    It needs no network and costs nothing, and returns the tokens, log probabilities and text offsets FLARE reads.
+
+    The KV states of the prompts and of their completions are kept in a PrefixCache, so a FLARE step only runs the
+    model over the tokens it has not seen yet, and its cost grows with the new tokens rather than the prompt length.
+    Prompts are completed one at a time, as the states of different questions have different lengths. Decoding is
+    greedy at temperature 0, nucleus sampling otherwise. Prompts over the context of the model lose their start, so
+    the exemplars should rather be dropped by the token budget of the PromptBuilder ("max_input_tokens").
+
+    Args:
+        model_name (str): The name or path of the causal LM, e.g. gpt2 or distilgpt2
+        model (Any): A loaded causal LM, loaded from model_name if None
+        tokenizer (Any): The tokenizer of the model, loaded from model_name if None
+        cache_bytes (int): The maximum size of the cached KV states, 512MB holds about 7000 gpt2 tokens
+        seed (int): The seed of the sampling
+        num_threads (int): The number of CPU threads of torch, its default if None
+
+    Attributes:
+        model (Any): This stores the causal LM
+        tokenizer (Any): This stores the tokenizer
+        cache (PrefixCache): This stores the KV states of the last prompts
+        max_context (int): This stores the maximum number of tokens the model attends to
+        stats (Dict[str, int]): This stores the number of requests, prompts, prompt tokens reused from the cache or run through the model, completion tokens and prompts cut to fit the context
+
+    '''
+    def __init__(
+        self,
+        model_name: str = 'gpt2',
+        model: Any = None,
+        tokenizer: Any = None,
+        cache_bytes: int = 512 * 2 ** 20,
+        seed: int = 0,
+        num_threads: int = None,
+    ):
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.model_name = model_name
+        self.model = model if model is not None else AutoModelForCausalLM.from_pretrained(model_name)
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(model_name)
+        self.model.eval()
+
+        self.cache = PrefixCache(max_bytes=cache_bytes)
+        self.max_context = getattr(self.model.config, 'n_positions', None) or self.model.config.max_position_embeddings
+
+        self._generator = torch.Generator().manual_seed(seed)
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "requests": 0,
+            "prompts": 0,
+            "reused_tokens": 0,
+            "processed_tokens": 0,
+            "completion_tokens": 0,
+            "truncated_prompts": 0,
+        }
+
+    def create(
+        self,
+        prompt: Union[str, List[str]],
+        max_tokens: int = 16,
+        temperature: float = 0,
+        top_p: float = 1,
+        logprobs: int = None,
+        stream: bool = False,
+        model: str = None,
+        **kwargs,
+    ):
+        '''Like openai.Completion.create
+
+        Args:
+            prompt (Union[str, List[str]]): The prompts to complete
+            max_tokens (int): The maximum number of tokens to generate per prompt
+            temperature (float): The temperature of the sampling, greedy if 0
+            top_p (float): The probability mass of the nucleus sampling
+            logprobs (int): Whether to return the log probabilities, as in the Completion API
+            stream (bool): Whether to return the chunks of a streamed response
+            model (str): The model name, echoed in the response
+            kwargs: The other Completion API parameters, ignored
+
+        Returns:
+            response (Union[Dict[str, Any], Iterator[Dict[str, Any]]]): The response, or its chunks if streaming
+        '''
+
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        decodings = [self._decode(p, max_tokens, temperature, top_p) for p in prompts]
+
+        self.stats["requests"] += 1
+        self.stats["prompts"] += len(prompts)
+
+        if stream:
+            return self._stream(prompts, decodings, logprobs, model)
+
+        prompt_tokens = self.stats["reused_tokens"] + self.stats["processed_tokens"]
+
+        choices = []
+
+        for index, (p, decoding) in enumerate(zip(prompts, decodings)):
+
+            tokens, token_logprobs, text_offset = [], [], []
+            offset = len(p)
+
+            while True:
+                try:
+                    token, token_logprob = next(decoding)
+                except StopIteration as stop:
+                    finish_reason = stop.value
+                    break
+
+                tokens.append(token)
+                token_logprobs.append(token_logprob)
+                text_offset.append(offset)
+                offset += len(token)
+
+            choices.append({
+                "text": "".join(tokens),
+                "index": index,
+                "logprobs": {
+                    "tokens": tokens,
+                    "token_logprobs": token_logprobs,
+                    "top_logprobs": None,
+                    "text_offset": text_offset,
+                } if logprobs is not None else None,
+                "finish_reason": finish_reason,
+            })
+
+        prompt_tokens = self.stats["reused_tokens"] + self.stats["processed_tokens"] - prompt_tokens
+        completion_tokens = sum(len(choice["logprobs"]["tokens"]) if choice["logprobs"] else 0 for choice in choices)
+
+        return {
+            "id": "cmpl-local",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": model or self.model_name,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    async def acreate(self, stream: bool = False, **params):
+        '''Like openai.Completion.acreate, the model runs in a worker thread'''
+
+        if stream:
+            return self._astream(self.create(stream=True, **params))
+
+        return await asyncio.to_thread(self.create, **params)
+
+    def _stream(self, prompts, decodings, logprobs, model):
+        '''Streams the tokens of the prompts one at a time, taking turns between the prompts still generating'''
+
+        offsets = [len(p) for p in prompts]
+        active = list(enumerate(decodings))
+
+        try:
+            while active:
+
+                still_active = []
+
+                for index, decoding in active:
+
+                    try:
+                        token, token_logprob = next(decoding)
+                        finish_reason = None
+                        still_active.append((index, decoding))
+                        tokens = [token]
+                    except StopIteration as stop:
+                        finish_reason = stop.value
+                        token, token_logprob = "", None
+                        tokens = []
+
+                    offset = offsets[index]
+                    offsets[index] += len(token)
+
+                    yield {
+                        "id": "cmpl-local",
+                        "object": "text_completion",
+                        "created": int(time.time()),
+                        "model": model or self.model_name,
+                        "choices": [{
+                            "text": token,
+                            "index": index,
+                            "logprobs": {
+                                "tokens": tokens,
+                                "token_logprobs": [token_logprob] if tokens else [],
+                                "top_logprobs": None,
+                                "text_offset": [offset] if tokens else [],
+                            } if logprobs is not None else None,
+                            "finish_reason": finish_reason,
+                        }],
+                    }
+
+                active = still_active
+
+        finally:
+            # Closing the stream stops the generation, and caches the states reached
+            for decoding in decodings:
+                decoding.close()
+
+    async def _astream(self, stream):
+        done = object()
+
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, stream, done)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+    def _decode(self, prompt, max_tokens, temperature, top_p):
+        '''Generates the completion of a prompt, resuming from the cached state of its longest cached prefix
+
+        Args:
+            prompt (str): The prompt to complete
+            max_tokens (int): The maximum number of tokens to generate
+            temperature (float): The temperature of the sampling, greedy if 0
+            top_p (float): The probability mass of the nucleus sampling
+
+        Returns:
+            tokens (Iterator[Tuple[str, float]]): The text and log probability of every generated token, the generator
+            returns the finish_reason
+        '''
+
+        ids = self.tokenizer(prompt)["input_ids"]
+
+        # Drop the start of prompts too long for the context of the model, by whole strides so that the prompts of a
+        # growing response keep the same start, and their cached states
+        limit = max(self.max_context - max_tokens, 1)
+        if len(ids) > limit:
+            stride = max(limit // 4, 1)
+            ids = ids[-(-(len(ids) - limit) // stride) * stride:]
+            self.stats["truncated_prompts"] += 1
+
+        ids = np.array(ids, dtype=np.int64)
+        reused, past = self.cache.lookup(ids)
+
+        # ANALYTICS
+        self.stats["reused_tokens"] += reused
+        self.stats["processed_tokens"] += len(ids) - reused
+
+        fed = []
+        generated = []
+        text = ""
+        finish_reason = "length"
+
+        try:
+            logits, past = self._forward(ids[reused:], past)
+            fed = list(ids)
+
+            for step in range(max_tokens):
+
+                token_logprobs = torch.log_softmax(logits.float(), dim=-1)
+                token = self._sample(logits, token_logprobs, temperature, top_p)
+
+                if token == self.tokenizer.eos_token_id:
+                    finish_reason = "stop"
+                    break
+
+                generated.append(token)
+                self.stats["completion_tokens"] += 1
+
+                # Decode the whole completion, a token can end in the middle of a multi-byte character
+                full = self.tokenizer.decode(generated)
+                piece = "" if full.endswith("\ufffd") else full[len(text):]
+                text += piece
+
+                yield piece, float(token_logprobs[token])
+
+                if step + 1 < max_tokens:
+                    logits, past = self._forward([token], past)
+                    fed.append(token)
+
+        finally:
+            self.cache.store(np.array(fed, dtype=np.int64), past)
+
+        return finish_reason
+
+    def _forward(self, ids, past):
+        '''Runs new tokens through the model after the state past, returns the next token logits and the new state'''
+
+        with self._lock, torch.inference_mode():
+            out = self.model(input_ids=torch.tensor([list(ids)], dtype=torch.long), past_key_values=past, use_cache=True)
+
+        return out.logits[0, -1], out.past_key_values
+
+    def _sample(self, logits, token_logprobs, temperature, top_p):
+        '''Picks the next token, the most likely at temperature 0, else from the nucleus of the tempered distribution'''
+
+        if temperature == 0:
+            return int(torch.argmax(logits))
+
+        probs = torch.softmax(logits.float() / temperature, dim=-1)
+        sorted_probs, order = torch.sort(probs, descending=True)
+
+        # Keep the most likely tokens up to top_p of the probability mass
+        keep = torch.cumsum(sorted_probs, dim=-1) - sorted_probs < top_p
+        sorted_probs = sorted_probs * keep
+
+        choice = torch.multinomial(sorted_probs / sorted_probs.sum(), 1, generator=self._generator)
+
+        return int(order[choice])
+
+def _nbytes(past):
+    '''The size of the tensors of past_key_values in bytes'''
+
+    return sum(state.element_size() * state.nelement() for layer in past for state in layer)
+
+def _crop(past, length):
+    '''Keeps the states of the first length tokens of past_key_values'''
+
+    return tuple(tuple(state[:, :, :length] for state in layer) for layer in past)
@@ -0,0 +1,441 @@
+from typing import Any, Dict, List, Union
+import json
+import math
+import time
+import asyncio
+import random
+import hashlib
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "the film was released in city by a famous actor during year with many people and songs who played first "
+    "second version album series country state world record award season character history number team game"
+).split()
+
+class MockLM(object):
+    '''
+    A deterministic stand-in for the OpenAI Completion API, generating random sentences with token log probabilities.
+
+    The completion of a prompt only depends on the prompt and the seed. Every token is a word (or the period ending a
+    sentence) whose probability is drawn from a Beta(prob_alpha, prob_beta) distribution, so the share of tokens
+    triggering retrieval is controlled by the distribution. An answer is made of a number of sentences drawn per
+    question: the sentences already answered are counted after the last answer_marker of the prompt, and once there
+    are enough the completion is empty, which ends the FLARE loop.
+
+    Args:
+        seed (int): The seed of the generation
+        min_words (int): The minimum number of words per sentence
+        max_words (int): The maximum number of words per sentence
+        min_answer_sents (int): The minimum number of sentences of an answer
+        max_answer_sents (int): The maximum number of sentences of an answer
+        prob_alpha (float): The alpha parameter of the Beta distribution of the token probabilities
+        prob_beta (float): The beta parameter of the Beta distribution of the token probabilities
+        answer_marker (str): The text after which the answer starts in a prompt
+        latency (float): The seconds to wait before the first token of a request
+        latency_per_token (float): The seconds to wait per generated token (of the longest choice)
+        error_rate (float): The probability of answering a request with a 429 rate limit error
+
+    Attributes:
+        stats (Dict[str, int]): This stores the number of requests, prompts and tokens generated and streamed
+
+    '''
+    def __init__(
+        self,
+        seed: int = 0,
+        min_words: int = 4,
+        max_words: int = 12,
+        min_answer_sents: int = 2,
+        max_answer_sents: int = 6,
+        prob_alpha: float = 5,
+        prob_beta: float = 1,
+        answer_marker: str = "Answer:",
+        latency: float = 0,
+        latency_per_token: float = 0,
+        error_rate: float = 0,
+    ):
+
+        self.seed = seed
+        self.min_words = min_words
+        self.max_words = max_words
+        self.min_answer_sents = min_answer_sents
+        self.max_answer_sents = max_answer_sents
+        self.prob_alpha = prob_alpha
+        self.prob_beta = prob_beta
+        self.answer_marker = answer_marker
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.error_rate = error_rate
+
+        self._lock = threading.Lock()
+        self._errors = random.Random(seed)
+        self.stats = {"requests": 0, "prompts": 0, "tokens": 0, "streamed_tokens": 0}
+
+    def _random(self, *keys) -> random.Random:
+        digest = hashlib.sha256("\x00".join([str(self.seed)] + list(keys)).encode('utf-8')).hexdigest()
+        return random.Random(digest)
+
+    def throttled(self) -> bool:
+        '''Whether to answer the next request with a rate limit error, a retried request may succeed'''
+
+        with self._lock:
+            return self.error_rate > 0 and self._errors.random() < self.error_rate
+
+    def choice(
+        self,
+        prompt: str,
+        index: int = 0,
+        max_tokens: int = 16,
+        logprobs: int = None,
+    ) -> Dict[str, Any]:
+        '''Completes one prompt
+
+        Args:
+            prompt (str): The prompt to complete
+            index (int): The index of the prompt in the request
+            max_tokens (int): The maximum number of tokens to generate
+            logprobs (int): Whether to return the log probabilities, as in the Completion API
+
+        Returns:
+            choice (Dict[str, Any]): The choice, shaped like a Completion API choice
+        '''
+
+        # The number of sentences of the answer depends on the question, what comes before the answer
+        head, marker, answer = prompt.rpartition(self.answer_marker)
+        if not marker:
+            head, answer = prompt, ""
+
+        num_sents = self._random("answer", head).randint(self.min_answer_sents, self.max_answer_sents)
+        remaining = num_sents - answer.count(".") if marker else 1
+
+        rnd = self._random("completion", prompt)
+        tokens = []
+        probs = []
+
+        for _ in range(max(remaining, 0)):
+            for _ in range(rnd.randint(self.min_words, self.max_words)):
+                tokens.append(" " + rnd.choice(WORDS))
+                probs.append(rnd.betavariate(self.prob_alpha, self.prob_beta))
+            tokens.append(".")
+            probs.append(rnd.betavariate(self.prob_alpha, self.prob_beta))
+
+        finish_reason = "length" if len(tokens) > max_tokens else "stop"
+        tokens = tokens[:max_tokens]
+        probs = probs[:max_tokens]
+
+        text_offset = []
+        offset = len(prompt)
+        for token in tokens:
+            text_offset.append(offset)
+            offset += len(token)
+
+        return {
+            "text": "".join(tokens),
+            "index": index,
+            "logprobs": {
+                "tokens": tokens,
+                "token_logprobs": [math.log(max(prob, 1e-6)) for prob in probs],
+                "top_logprobs": None,
+                "text_offset": text_offset,
+            } if logprobs is not None else None,
+            "finish_reason": finish_reason,
+        }
+
+    def create(
+        self,
+        prompt: Union[str, List[str]],
+        max_tokens: int = 16,
+        logprobs: int = None,
+        model: str = "mock",
+        **kwargs,
+    ) -> Dict[str, Any]:
+        '''Completes a (multi-prompt) request, like openai.Completion.create without streaming nor latency
+
+        Args:
+            prompt (Union[str, List[str]]): The prompts to complete
+            max_tokens (int): The maximum number of tokens to generate per prompt
+            logprobs (int): Whether to return the log probabilities, as in the Completion API
+            model (str): The model name, echoed in the response
+            kwargs: The other Completion API parameters, ignored
+
+        Returns:
+            response (Dict[str, Any]): The response, shaped like a Completion API response
+        '''
+
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        choices = [self.choice(p, i, max_tokens, logprobs) for i, p in enumerate(prompts)]
+
+        completion_tokens = sum(len(self._tokens(choice)) for choice in choices)
+
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["prompts"] += len(prompts)
+            self.stats["tokens"] += completion_tokens
+
+        return {
+            "id": "cmpl-mock",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": sum(len(p) for p in prompts) // 4,
+                "completion_tokens": completion_tokens,
+                "total_tokens": sum(len(p) for p in prompts) // 4 + completion_tokens,
+            },
+        }
+
+    def _tokens(self, choice):
+        return choice["logprobs"]["tokens"] if choice["logprobs"] else choice["text"].split()
+
+    def delay(self, response: Dict[str, Any]) -> float:
+        '''The seconds a request takes, generating the tokens of its longest choice'''
+
+        return self.latency + self.latency_per_token * max(len(self._tokens(choice)) for choice in response["choices"])
+
+    def stream(self, response: Dict[str, Any]):
+        '''Streams a response at the pace of the latency, see chunks
+
+        Args:
+            response (Dict[str, Any]): The response to stream
+
+        Returns:
+            chunks (Iterator[Dict[str, Any]]): The chunks of the streamed response
+        '''
+
+        time.sleep(self.latency)
+        last_step = 0
+
+        for step, chunk in self.chunks(response):
+
+            if step > last_step:
+                time.sleep(self.latency_per_token * (step - last_step))
+                last_step = step
+
+            yield chunk
+
+    def chunks(self, response: Dict[str, Any]):
+        '''Splits a response into the chunks of a streamed response, one token of one choice per chunk
+
+        Args:
+            response (Dict[str, Any]): The response to stream
+
+        Returns:
+            chunks (Iterator[Tuple[int, Dict[str, Any]]]): The token step of every chunk, and the chunk
+        '''
+
+        choices = response["choices"]
+        tokens = [choice["logprobs"]["tokens"] if choice["logprobs"] else [choice["text"]] for choice in choices]
+
+        for step in range(max(len(t) for t in tokens) + 1):
+            for choice, toks in zip(choices, tokens):
+
+                if step < len(toks):
+                    logprobs = choice["logprobs"]
+
+                    with self._lock:
+                        self.stats["streamed_tokens"] += 1
+
+                    yield step, {
+                        "id": response["id"],
+                        "object": "text_completion",
+                        "created": response["created"],
+                        "model": response["model"],
+                        "choices": [{
+                            "text": toks[step],
+                            "index": choice["index"],
+                            "logprobs": {
+                                "tokens": [toks[step]],
+                                "token_logprobs": [logprobs["token_logprobs"][step]],
+                                "top_logprobs": None,
+                                "text_offset": [logprobs["text_offset"][step]],
+                            } if logprobs else None,
+                            "finish_reason": None,
+                        }],
+                    }
+                elif step == len(toks):
+                    yield step, {
+                        "id": response["id"],
+                        "object": "text_completion",
+                        "created": response["created"],
+                        "model": response["model"],
+                        "choices": [{"text": "", "index": choice["index"], "logprobs": None, "finish_reason": choice["finish_reason"]}],
+                    }
+
+class MockHandler(BaseHTTPRequestHandler):
+    '''Serves POST {base}/completions of the Completion API, and GET /stats'''
+
+    lm: MockLM = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.lm.stats)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+
+        params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        if not self.path.rstrip("/").endswith("/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        if self.lm.throttled():
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests"}})
+            return
+
+        response = self.lm.create(**params)
+
+        if not params.get("stream"):
+            time.sleep(self.lm.delay(response))
+            self._send_json(200, response)
+            return
+
+        # Server-sent events, one token per event, until the client disconnects
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            for chunk in self.lm.stream(response):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+class MockCompletion(object):
+    '''
+    An in-process backend with the interface of openai.Completion serving a MockLM, latency included, for
+    QueryAgent(lm=...). It avoids the HTTP overhead of the server when benchmarking the FLARE loop itself.
+
+    Args:
+        lm (MockLM): The mock model to serve, a default MockLM if None
+
+    Attributes:
+        lm (MockLM): This stores the mock model
+
+    '''
+    def __init__(
+        self,
+        lm: MockLM = None,
+    ):
+
+        self.lm = lm if lm is not None else MockLM()
+
+    def _response(self, params):
+        if self.lm.throttled():
+            import openai
+            raise openai.error.RateLimitError("Rate limit reached (mock)")
+
+        return self.lm.create(**params)
+
+    def create(self, stream: bool = False, **params):
+        '''Like openai.Completion.create'''
+
+        response = self._response(params)
+
+        if stream:
+            return self.lm.stream(response)
+
+        time.sleep(self.lm.delay(response))
+        return response
+
+    async def acreate(self, stream: bool = False, **params):
+        '''Like openai.Completion.acreate'''
+
+        response = self._response(params)
+
+        if stream:
+            return self._astream(response)
+
+        await asyncio.sleep(self.lm.delay(response))
+        return response
+
+    async def _astream(self, response):
+        await asyncio.sleep(self.lm.latency)
+        last_step = 0
+
+        for step, chunk in self.lm.chunks(response):
+
+            if step > last_step:
+                await asyncio.sleep(self.lm.latency_per_token * (step - last_step))
+                last_step = step
+
+            yield chunk
+
+def serve(lm: MockLM, host: str = "127.0.0.1", port: int = 8000, background: bool = False):
+    '''Serves a MockLM over HTTP
+
+    Args:
+        lm (MockLM): The mock model to serve
+        host (str): The host to bind
+        port (int): The port to bind, 0 for any free port
+        background (bool): Whether to serve from a daemon thread and return, or to block
+
+    Returns:
+        server (ThreadingHTTPServer): The server, its api_base is f"http://{host}:{server.server_port}/v1"
+    '''
+
+    handler = type("Handler", (MockHandler,), {"lm": lm})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        print(f"Serving the mock Completion API on http://{host}:{server.server_port}/v1")
+        server.serve_forever()
+
+    return server
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve a deterministic mock of the OpenAI Completion API")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generation")
+    parser.add_argument("--min_words", type=int, default=4, help="Minimum number of words per sentence")
+    parser.add_argument("--max_words", type=int, default=12, help="Maximum number of words per sentence")
+    parser.add_argument("--min_answer_sents", type=int, default=2, help="Minimum number of sentences per answer")
+    parser.add_argument("--max_answer_sents", type=int, default=6, help="Maximum number of sentences per answer")
+    parser.add_argument("--prob_alpha", type=float, default=5, help="Alpha of the Beta distribution of the token probabilities")
+    parser.add_argument("--prob_beta", type=float, default=1, help="Beta of the Beta distribution of the token probabilities")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds before the first token of a request")
+    parser.add_argument("--latency_per_token", type=float, default=0, help="Seconds per generated token")
+    parser.add_argument("--error_rate", type=float, default=0, help="Probability of a 429 rate limit error per request")
+    args = parser.parse_args()
+
+    lm = MockLM(
+        seed=args.seed,
+        min_words=args.min_words,
+        max_words=args.max_words,
+        min_answer_sents=args.min_answer_sents,
+        max_answer_sents=args.max_answer_sents,
+        prob_alpha=args.prob_alpha,
+        prob_beta=args.prob_beta,
+        latency=args.latency,
+        latency_per_token=args.latency_per_token,
+        error_rate=args.error_rate,
+    )
+
+    serve(lm, host=args.host, port=args.port)
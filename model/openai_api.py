@@ -1,14 +1,25 @@
 from typing import List, Dict, Any, Tuple, Union, Set
 import os
 import json
-import openai
+import asyncio
+import itertools
+import weakref
+import threading
 import numpy as np
 
-from nltk.tokenize.punkt import PunktSentenceTokenizer
-from collections import namedtuple, Counter
+from collections import Counter
 
-from retriever import BM25
 from asqa import ASQA
+from cache import CompletionCache
+from prompt import PromptBuilder
+from sentences import SentenceSplitter
+from streaming import StreamedCompletion
+from rate_limit import RateLimiter
+from tracing import Tracer, NullTracer
+from state import GenerationState, RetrievalResult
+from singleflight import SingleFlight
+from packing import ContextPacker
+from passage_store import LazyPassages
 
 class QueryAgent(object):
     '''
@@ -20,10 +31,19 @@ class QueryAgent(object):
         temperature (float): Nonnegative parameter controlling randomness of output. As temperature -> 0, the OpenAI output becomes more deterministic
         top_p (float): In [0,1], nucleus sampling. Model only considers tokens with top_p probability mass
         api_key (str): Your personal OpenAI API key
-        retriever (BM25): Custom BM25 retriever
-        dataset (Any): This stores the dataset we are working with, default ASQA
+        retriever (BM25): Custom BM25 retriever, built from retrieval_kwargs on first use if None
+        dataset (Any): This stores the dataset we are working with, ASQA if None
         mode (str): Retrieval mode, FLARE direct implicit or FLARE direct explicit
         retrieval_kwargs (Dict[str, Any]): Hyperparameters of the model to tune
+        max_concurrency (int): The maximum number of in-flight API requests when responding asynchronously
+        cache_path (str): Path of the persistent completion cache, no caching if None
+        cache_size (int): The maximum number of completions kept in the persistent cache
+        retrieval_cache_path (str): Path of the persistent retrieval cache, memory only if None
+        stream (bool): Whether to stream the generation calls and close the stream at the first sentence boundary
+        rate_limits (Dict[str, Any]): Keyword arguments of the RateLimiter, e.g. requests_per_minute and tokens_per_minute
+        lm (Any): Custom Completion API backend with create and acreate (e.g. mock_server.MockCompletion, local_lm.LocalLM), openai.Completion if None. Its tokenizer, if any, counts the prompt tokens
+        trace (bool): Whether to record the timings of the stages of the FLARE loop
+        api_base (str): Base URL of the Completion API, e.g. a local stand-in server, the OpenAI API if None
 
     Attributes:
         model (str): This stores the OpenAI API model name
@@ -31,14 +51,27 @@ class QueryAgent(object):
         temperature (float): This stores the temperature for API calls
         top_p (float): This stores the parameter for nucleus sampling for the API calls
         api_key (str): Your personal OpenAI API key 
-        psentencizer : The PunktSentenceTokenizer
+        splitter (SentenceSplitter): This stores the sentence boundary finder, built once around a Punkt tokenizer
         min_sent_len (int): This stores the minimum sentence length acceptable for generation
         look_ahead_filter_prob (float): This stores theta, the probability threshold for a token below which triggers retrieval
         look_ahead_mask_prob (float): This stores beta, the probability threshold for tokens below which masks the token in retrieval
         topk_retriever (int): This stores the number of documents for the retriever to retrieve per call
-        retriever (BM25): This stores the custom BM25 retriever
+        max_look_ahead_sents (int): This stores the maximum number of confident sentences accepted from one completion, 1 to accept only the first
+        retriever (BM25): This stores the retriever, built on first use unless given
         dataset (Any): This stores the dataset we are working with, default ASQA
+        prompt_builder (PromptBuilder): This stores the prompt assembly, fitting prompts to max_input_tokens
+        packer (ContextPacker): This stores the packing of the retrieved passages, dropping empty, duplicate and already seen passages
         mode (str): This stores whether we are in FLARE direct implicit or FLARE direct explicit
+        query_model (str): This stores the OpenAI API model generating explicit queries
+        query_max_gen_len (int): This stores the maximum tokens generated per explicit query
+        max_concurrency (int): This stores the maximum number of in-flight API requests for arespond
+        cache (CompletionCache): This stores the persistent completion cache, None if disabled
+        stream (bool): This stores whether the generation calls are streamed and cut at the sentence boundary
+        rate_limiter (RateLimiter): This stores the scheduler of the API requests, retrying failed requests
+        lm (Any): This stores the Completion API backend
+        tracer (Tracer): This stores the recorder of the timings of every stage, a NullTracer if tracing is off
+        completion_flight (SingleFlight): This stores the coalescing of identical completion requests
+        retrieval_flight (SingleFlight): This stores the coalescing of identical retrieval queries
 
     '''
     def __init__(
@@ -48,9 +81,18 @@ class QueryAgent(object):
         temperature: float = 0,
         top_p: float = 1,
         api_key: str = None,
-        retriever: object = BM25(),
-        dataset: object = ASQA(),
+        retriever: object = None,
+        dataset: object = None,
         retrieval_kwargs: Dict[str, Any] = {},
+        max_concurrency: int = 8,
+        cache_path: str = None,
+        cache_size: int = 1000000,
+        retrieval_cache_path: str = None,
+        stream: bool = False,
+        api_base: str = None,
+        rate_limits: Dict[str, Any] = None,
+        lm: object = None,
+        trace: bool = False,
     ):
 
         # API call parameters
@@ -59,33 +101,129 @@ class QueryAgent(object):
         self.temperature = temperature
         self.top_p = top_p
         self.api_key = api_key
-        
-        # Set API key
-        openai.api_key = self.api_key
 
-        # Tokenizer
-        self.psentencizer = PunktSentenceTokenizer()
+        # Tracing, spans cost a method call when off
+        self.tracer = Tracer() if trace else NullTracer()
+
+        # Completion API backend, openai is only imported when it is the backend
+        if lm is None:
+            import openai
+
+            # Set API key
+            openai.api_key = self.api_key
+
+            if api_base is not None:
+                openai.api_base = api_base
+
+            lm = openai.Completion
+
+        self.lm = lm
+
+        # Streaming, stop receiving tokens once the sentences of a step are complete
+        self.stream = stream
+
+        # Every API request goes through the rate limiter
+        self.rate_limiter = RateLimiter(**(rate_limits or {}))
 
         # Parameters for generation
         self.min_sent_len = 5
+
+        # Sentence tokenizer, optionally trained on a text file
+        punkt_train_text = None
+        if retrieval_kwargs.get('punkt_train_path'):
+            with open(retrieval_kwargs['punkt_train_path'], 'r') as f:
+                punkt_train_text = f.read()
+
+        self.splitter = SentenceSplitter(min_sent_len=self.min_sent_len, train_text=punkt_train_text)
         self.look_ahead_filter_prob = retrieval_kwargs.get('look_ahead_filter_prob', 0)
         self.look_ahead_mask_prob = retrieval_kwargs.get('look_ahead_mask_prob', 0)
         self.topk_retriever = retrieval_kwargs.get('topk_retriever', 1)
+        self.max_look_ahead_sents = retrieval_kwargs.get('max_look_ahead_sents', 1)
 
-        # Retriever
-        self.retriever = BM25(index_name='wikipedia_dpr')
+        # Retriever, built on first use unless given
+        self._retriever = retriever
+        self._retriever_lock = threading.Lock()
+        self._retrieval_kwargs = retrieval_kwargs
+        self._retrieval_cache_path = retrieval_cache_path
 
         # Dataset
-        self.dataset = dataset
+        self.dataset = dataset if dataset is not None else ASQA()
+
+        # Prompt assembly within the input-token budget of the model
+        self.prompt_builder = PromptBuilder(
+            self.dataset,
+            max_input_tokens=retrieval_kwargs.get('max_input_tokens'),
+            max_passage_tokens=retrieval_kwargs.get('max_passage_tokens'),
+            min_exemplars=retrieval_kwargs.get('min_exemplars', 1),
+            model=model,
+            tokenizer=getattr(self.lm, 'tokenizer', None),
+        )
+
+        # Passage packing between the retriever and the prompt assembly, off unless configured
+        self.packer = ContextPacker(
+            dedup=retrieval_kwargs.get('dedup_passages', False),
+            near_duplicate_threshold=retrieval_kwargs.get('near_duplicate_threshold', 0.8),
+            drop_seen=retrieval_kwargs.get('drop_seen_passages', False),
+        )
 
         # Mode
         self.mode = retrieval_kwargs.get("mode", "implicit")
 
+        # Explicit query generation
+        self.query_model = retrieval_kwargs.get("query_model", "gpt-3.5-turbo-instruct")
+        self.query_max_gen_len = retrieval_kwargs.get("query_max_tokens", 64)
+
+        # Async execution, one semaphore per event loop shared by all of its calls (a semaphore is bound to its loop)
+        self.max_concurrency = max_concurrency
+        self._in_flight = weakref.WeakKeyDictionary()
+
+        # Completion cache, shared by reruns and worker processes
+        self.cache = CompletionCache(cache_path, max_entries=cache_size) if cache_path else None
+
+        # Identical requests in a batch, or in flight from another batch, are only sent once
+        self.completion_flight = SingleFlight()
+        self.retrieval_flight = SingleFlight()
+
         # Track analytics 
         self._total_api_calls = 0
         self._total_retrieval_calls = 0
         self._low_probability_tokens = Counter()
         self._masked_tokens = Counter()
+        self._api_calls_saved = 0
+        self._streamed_tokens = 0
+        self._stream_cuts = 0
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            with self._retriever_lock:
+                if self._retriever is None:
+                    self._retriever = self._build_retriever()
+        return self._retriever
+
+    def _build_retriever(self):
+        '''Builds the retriever from the retrieval kwargs, ElasticSearch or the in-process inverted index (see setup/build_inverted_index.py)
+
+        Returns:
+            retriever (Union[BM25, InvertedIndexBM25]): The retriever
+        '''
+
+        # Imported here, beir and scipy are slow to import and not needed with a custom retriever
+        if self._retrieval_kwargs.get('retriever', 'elasticsearch') == 'inverted_index':
+            from inverted_index import InvertedIndexBM25
+            return InvertedIndexBM25(self._retrieval_kwargs.get('index_path', 'dataset/dpr/inverted_index'))
+
+        from retriever import BM25
+
+        return BM25(
+            index_name='wikipedia_dpr',
+            cache_path=self._retrieval_cache_path,
+            search_type=self._retrieval_kwargs.get('search_type', 'dfs_query_then_fetch'),
+            passage_store_path=self._retrieval_kwargs.get('passage_store_path'),
+            tracer=self.tracer,
+            hostname=self._retrieval_kwargs.get('es_hostname', 'localhost'),
+            transport_kwargs=self._retrieval_kwargs.get('es_transport'),
+        )
 
     def respond(
         self,
@@ -100,79 +238,578 @@ class QueryAgent(object):
             responses (List[str]): The responses to the user's queries
         '''
 
-        bs = len(user_inputs)
-        responses = np.array(["" for _ in range(bs)])
-        next_inputs = np.array(["" for _ in range(bs)])
+        with self.tracer.span("respond", batch_size=len(user_inputs)):
+
+            states = [GenerationState(user_input) for user_input in user_inputs]
 
-        # 1.1 We bootstrap generation by retrieving for the input, and generate the first sentence.
-        ctx_ids, ctx_texts = self.retriever.retrieve(user_inputs, topk=self.topk_retriever)
+            # 1.1 We bootstrap generation by retrieving for the input, and generate the first sentence.
+            ctx_ids, ctx_texts = self._retrieve(user_inputs)
+            ctx_texts = self._pack_documents(ctx_texts, states)
         
-        # Set up the documents according to Appendix D.1 in FLARE paper
-        next_inputs = self._linearize_documents(ctx_texts, user_inputs, responses)
+            # Set up the documents according to Appendix D.1 in FLARE paper
+            next_inputs = self._linearize_documents(ctx_texts, user_inputs, [state.text for state in states])
         
-        # Call the OpenAI API and get the first sentences
-        first_sents, _, _ = self._complete(next_inputs)
+            # Call the OpenAI API and get the first sentences
+            first_sents, _, _ = self._complete(next_inputs)
         
-        # Update the final responses
-        responses = np.char.add(responses, first_sents)
+            # Update the final responses
+            for state, first_sent in zip(states, first_sents):
+                state.append(first_sent)
         
-        SAFEGUARD_SENTINEL = 0
+            # The questions still generating, a question is done once it completes to nothing
+            active = states
+            SAFEGUARD_SENTINEL = 0
 
-        while(True):
+            while(True):
             
-            SAFEGUARD_SENTINEL += 1
+                SAFEGUARD_SENTINEL += 1
 
-            # 1.2 Then, we DO NOT use the retrieved documents and generate the next forward looking sentence(s)
-            next_inputs = self._linearize_documents([[] for _ in range(bs)], user_inputs, responses)
-            next_sents, all_tok_probs, all_toks = self._complete(next_inputs)
-            
-            if next_sents == ["" for _ in range(bs)]:
-                self._total_api_calls -= bs
-                break
+                with self.tracer.span("iteration", iteration=SAFEGUARD_SENTINEL, batch_size=len(active)):
+                    # 1.2 Then, we DO NOT use the retrieved documents and generate the next forward looking sentence(s)
+                    next_inputs = self._linearize_documents([[] for _ in active], [state.question for state in active], [state.text for state in active])
+                    next_sents, all_tok_probs, all_toks = self._complete(next_inputs, look_ahead=True)
 
-            # Update the responses through one iteration of active retrieval
-            responses = self._iterative_generate(user_inputs, responses, next_sents, all_tok_probs, all_toks)
+                    finished = [sent == "" for sent in next_sents]
+                    active_idxs = [i for i, done in enumerate(finished) if not done]
 
-            if SAFEGUARD_SENTINEL > 15:
-                break
+                    # ANALYTICS, the final empty completion of a question is discounted once, as in _step and _arespond_one
+                    self._total_api_calls -= sum(finished)
+
+                    if not active_idxs:
+                        break
+
+                    # Update the responses through one iteration of active retrieval
+                    active = [active[i] for i in active_idxs]
+                    self._iterative_generate(
+                        active,
+                        [next_sents[i] for i in active_idxs],
+                        [all_tok_probs[i] for i in active_idxs],
+                        [all_toks[i] for i in active_idxs],
+                    )
+
+                if SAFEGUARD_SENTINEL > 15:
+                    break
+
+            return self.normalize([state.text for state in states])
+
+    def _step(self, new_inputs, states):
+        '''Runs one FLARE iteration for the active questions, and bootstraps newly admitted questions in the same completion call
+
+        Args:
+            new_inputs (List[str]): The questions admitted in this step, which still need their bootstrap retrieval and first sentence
+            states (List[GenerationState]): The responses generated thus far to the active questions, extended in place
+
+        Returns:
+            new_states (List[GenerationState]): The responses of the new questions, holding their first sentence
+            finished (List[bool]): Whether each active question is done generating
+        '''
+
+        with self.tracer.span("step", new=len(new_inputs), batch_size=len(states)):
+            num_new = len(new_inputs)
+            new_states = [GenerationState(user_input) for user_input in new_inputs]
+            next_inputs = []
+
+            # 1.1 Bootstrap the new questions by retrieving for the input
+            if new_inputs:
+                ctx_ids, ctx_texts = self._retrieve(new_inputs)
+                ctx_texts = self._pack_documents(ctx_texts, new_states)
+                next_inputs += self._linearize_documents(ctx_texts, new_inputs, ["" for _ in range(num_new)])
+
+            # 1.2 Generate the next forward looking sentence of the active questions without retrieved documents
+            next_inputs += self._linearize_documents([[] for _ in range(len(states))], [state.question for state in states], [state.text for state in states])
+
+            if not next_inputs:
+                return [], []
+
+            # A single completion call keeps every slot busy
+            sents, all_tok_probs, all_toks = self._complete(next_inputs, look_ahead=[False] * num_new + [True] * len(states))
+
+            for state, first_sent in zip(new_states, sents[:num_new]):
+                state.append(first_sent)
+
+            sents, all_tok_probs, all_toks = sents[num_new:], all_tok_probs[num_new:], all_toks[num_new:]
+
+            finished = [sent == "" for sent in sents]
+            active_idxs = [i for i, done in enumerate(finished) if not done]
+
+            # ANALYTICS, the final empty completion of a question is discounted as in respond
+            self._total_api_calls -= sum(finished)
+
+            if active_idxs:
+                self._iterative_generate(
+                    [states[i] for i in active_idxs],
+                    [sents[i] for i in active_idxs],
+                    [all_tok_probs[i] for i in active_idxs],
+                    [all_toks[i] for i in active_idxs],
+                )
+
+            return new_states, finished
+
+    async def arespond(
+        self,
+        user_inputs: List[str] = None,
+    ):
+        '''Asynchronous version of respond, each question runs its own FLARE loop concurrently
+
+        Completion and query generation requests of different questions are in flight at the same time (bounded
+        by max_concurrency), and the retrieval of one question overlaps with the generation of the others.
+
+        Args:
+            user_inputs (List[str]): The initial queries from the user for the model to answer
+
+        Returns:
+            responses (List[str]): The responses to the user's queries
+        '''
+
+        responses = await asyncio.gather(*[self._arespond_one(user_input) for user_input in user_inputs])
 
         return self.normalize(list(responses))
 
-    def _complete(self, texts):
-        '''Calls the Complete API for an OpenAI API model
-        
+    async def arespond_as_completed(
+        self,
+        keyed_inputs: List[Tuple[Any, str]],
+    ):
+        '''Asynchronous version of respond which yields every response as soon as its question is answered
+
         Args:
-            texts (List[str]): The texts for the model to complete
+            keyed_inputs (List[Tuple[Any, str]]): The (key, query) pairs from the user for the model to answer
 
         Returns:
-            completions (List[str]): The completions to the texts
-            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
-            all_toks (List[List[float]]): List of list of tokens generated
+            responses (AsyncIterator[Tuple[Any, str]]): The (key, response) pairs, in order of completion
+        '''
+
+        async def _respond(key, user_input):
+            return key, await self._arespond_one(user_input)
+
+        for answered in asyncio.as_completed([_respond(key, user_input) for key, user_input in keyed_inputs]):
+            key, response = await answered
+            yield key, self.normalize([response])[0]
+
+    async def _arespond_one(self, user_input):
+        '''Runs the FLARE loop of respond for a single question, awaiting the API and the retriever
+
+        Args:
+            user_input (str): The initial query from the user for the model to answer
+
+        Returns:
+            response (str): The (unnormalized) response to the user's query
+        '''
+
+        with self.tracer.span("respond", batch_size=1, question=user_input):
+
+            state = GenerationState(user_input)
+
+            # 1.1 Bootstrap generation by retrieving for the input, the retriever is blocking so it runs in a worker thread
+            ctx_ids, ctx_texts = await asyncio.to_thread(self._retrieve, [user_input])
+            ctx_texts = self._pack_documents(ctx_texts, [state])
+            next_inputs = self._linearize_documents(ctx_texts, [user_input], [state.text])
+            first_sents, _, _ = await self._acomplete(next_inputs)
+            state.append(first_sents[0])
+
+            SAFEGUARD_SENTINEL = 0
+
+            while(True):
+
+                SAFEGUARD_SENTINEL += 1
+
+                with self.tracer.span("iteration", iteration=SAFEGUARD_SENTINEL, batch_size=1):
+                    # 1.2 Generate the next forward looking sentence without the retrieved documents
+                    next_inputs = self._linearize_documents([[]], [user_input], [state.text])
+                    next_sents, all_tok_probs, all_toks = await self._acomplete(next_inputs, look_ahead=True)
+
+                    if next_sents == [""]:
+                        self._total_api_calls -= 1
+                        break
+
+                    await self._aiterative_generate([state], next_sents, all_tok_probs, all_toks)
+
+                if SAFEGUARD_SENTINEL > 15:
+                    break
+
+            return state.text
+
+    def _completion_params(self):
+        '''Returns the sampling parameters of the main generation calls
+
+        Returns:
+            params (Dict[str, Any]): Keyword arguments for the Completion API
         '''
 
-        # Call the OpenAI API 
-        response = openai.Completion.create(
+        return dict(
             model=self.model,
-            prompt=texts,
             max_tokens=self.max_gen_len,
             temperature=self.temperature,
             top_p=self.top_p,
             logprobs=0,
         )
 
+    def _create_completion(self, prompts, num_sents=None, **params):
+        '''Sends one (multi-prompt) request to the Completion API, once per distinct prompt not already in flight
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt when streaming, the full completions if None
+            params: The Completion API parameters, see _completion_params
+
+        Returns:
+            choices (List[Dict[str, Any]]): The choices of the response, in the order of the prompts
+        '''
+
+        def send(lead):
+            return self._send_completion([prompts[i] for i in lead], [num_sents[i] for i in lead] if num_sents is not None else None, params)
+
+        return self.completion_flight.call(self._completion_keys(prompts, num_sents, params), send)
+
+    async def _acreate_completion(self, prompts, num_sents=None, **params):
+        '''Asynchronous version of _create_completion
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt when streaming, the full completions if None
+            params: The Completion API parameters, see _completion_params
+
+        Returns:
+            choices (List[Dict[str, Any]]): The choices of the response, in the order of the prompts
+        '''
+
+        async def send(lead):
+            return await self._asend_completion([prompts[i] for i in lead], [num_sents[i] for i in lead] if num_sents is not None else None, params)
+
+        return await self.completion_flight.acall(self._completion_keys(prompts, num_sents, params), send)
+
+    def _completion_keys(self, prompts, num_sents, params):
+        '''The keys under which completion requests are coalesced, identical keys getting the same choice
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt when streaming, the full completions if None
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            keys (List[Tuple]): The key of every prompt
+        '''
+
+        params_key = tuple(sorted(params.items()))
+
+        # A streamed completion stops after the sentences it needs, so it is only shared with requests needing as many
+        if self.stream and num_sents is not None:
+            return [(prompt, num, params_key) for prompt, num in zip(prompts, num_sents)]
+
+        return [(prompt, None, params_key) for prompt in prompts]
+
+    def _send_completion(self, prompts, num_sents, params):
+        '''Sends the prompts missing from the cache to the Completion API
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt when streaming, the full completions if None
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            choices (List[Dict[str, Any]]): The choices of the response, in the order of the prompts
+        '''
+
+        choices, missing = self._lookup_cache(prompts, params)
+
+        if missing:
+            missing_prompts = [prompts[i] for i in missing]
+
+            if self.stream and num_sents is not None:
+                missing_sents = [num_sents[i] for i in missing]
+                request = lambda start, end: self._stream_request(missing_prompts[start:end], missing_sents[start:end], params)
+            else:
+                request = lambda start, end: self.lm.create(prompt=missing_prompts[start:end], **params)
+
+            # The rate limiter splits the prompts into sub-batches, and retries them
+            with self.tracer.span("api", model=params['model'], batch_size=len(missing_prompts), cached=len(prompts) - len(missing)):
+                response = self.rate_limiter.call(request, missing_prompts, params['max_tokens'])
+            self._store_cache(prompts, params, choices, missing, response)
+
+        return choices
+
+    def _in_flight_limit(self):
+        '''The semaphore bounding the in-flight API requests of the running event loop, created on its first request
+
+        Returns:
+            in_flight (asyncio.Semaphore): The semaphore shared by every call of arespond and arespond_as_completed on the loop
+        '''
+
+        loop = asyncio.get_running_loop()
+
+        if loop not in self._in_flight:
+            self._in_flight[loop] = asyncio.Semaphore(self.max_concurrency)
+
+        return self._in_flight[loop]
+
+    async def _asend_completion(self, prompts, num_sents, params):
+        '''Asynchronous version of _send_completion, bounded by the in-flight limit
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt when streaming, the full completions if None
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            choices (List[Dict[str, Any]]): The choices of the response, in the order of the prompts
+        '''
+
+        in_flight = self._in_flight_limit()
+
+        choices, missing = self._lookup_cache(prompts, params)
+
+        if missing:
+            missing_prompts = [prompts[i] for i in missing]
+            missing_sents = [num_sents[i] for i in missing] if num_sents is not None else None
+
+            # Backoffs wait outside of the in-flight limit
+            async def request(start, end):
+                async with in_flight:
+                    if self.stream and missing_sents is not None:
+                        return await self._astream_request(missing_prompts[start:end], missing_sents[start:end], params)
+                    return await self.lm.acreate(prompt=missing_prompts[start:end], **params)
+
+            with self.tracer.span("api", model=params['model'], batch_size=len(missing_prompts), cached=len(prompts) - len(missing)):
+                response = await self.rate_limiter.acall(request, missing_prompts, params['max_tokens'])
+            self._store_cache(prompts, params, choices, missing, response)
+
+        return choices
+
+    def _stream_request(self, prompts, num_sents, params):
+        '''Streams a request to the Completion API, until every prompt holds its sentences
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            response (Dict[str, Any]): The response the chunks received add up to
+        '''
+
+        stream = self.lm.create(prompt=prompts, stream=True, **params)
+        streamed = self._streamed_completion(num_sents)
+
+        try:
+            for chunk in stream:
+                if streamed.add(chunk):
+                    break
+        finally:
+            # Closing the stream drops the connection, so no more tokens are generated nor billed
+            stream.close()
+
+        return self._stream_response(streamed)
+
+    async def _astream_request(self, prompts, num_sents, params):
+        '''Asynchronous version of _stream_request
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            num_sents (List[int]): The number of sentences needed per prompt
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            response (Dict[str, Any]): The response the chunks received add up to
+        '''
+
+        stream = await self.lm.acreate(prompt=prompts, stream=True, **params)
+        streamed = self._streamed_completion(num_sents)
+
+        try:
+            async for chunk in stream:
+                if streamed.add(chunk):
+                    break
+        finally:
+            await stream.aclose()
+
+        return self._stream_response(streamed)
+
+    def _num_sents(self, texts, look_ahead):
+        '''The number of sentences a streamed generation call needs for each text, see _parse_choices
+
+        Args:
+            texts (List[str]): The texts for the model to complete
+            look_ahead (Union[bool, List[bool]]): Whether the confident sentences following the first one are reused
+
+        Returns:
+            num_sents (List[int]): The number of sentences to receive before the stream of a text can stop
+        '''
+
+        if isinstance(look_ahead, bool):
+            look_ahead = [look_ahead for _ in texts]
+
+        return [self.max_look_ahead_sents if reuse else 1 for reuse in look_ahead]
+
+    def _streamed_completion(self, num_sents):
+        '''Starts assembling a streamed completion, whose choices stop once they hold their sentences
+
+        Args:
+            num_sents (List[int]): The number of sentences needed per choice
+
+        Returns:
+            streamed (StreamedCompletion): The streamed completion
+        '''
+
+        # The final sentence ends of every choice, kept between the chunks so only the new text is split
+        ends = [[] for _ in num_sents]
+
+        return StreamedCompletion(len(num_sents), lambda i, text: len(self.splitter.final_ends(text, ends[i])) >= num_sents[i])
+
+    def _stream_response(self, streamed):
+        '''Ends a streamed completion
+
+        Args:
+            streamed (StreamedCompletion): The streamed completion
+
+        Returns:
+            response (Dict[str, Any]): The response the chunks add up to, the choices cut short flagged with 'cut'
+        '''
+
+        # ANALYTICS
+        self._streamed_tokens += streamed.num_tokens
+        self._stream_cuts += sum(streamed.cut)
+
+        response = streamed.response()
+
+        # The cache key does not hold the sentences a stream stopped after, so _store_cache leaves the cut choices out
+        for choice, cut in zip(response['choices'], streamed.cut):
+            if cut:
+                choice['cut'] = True
+
+        return response
+
+    def _lookup_cache(self, prompts, params):
+        '''Looks up the prompts in the completion cache
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            params (Dict[str, Any]): The Completion API parameters
+
+        Returns:
+            choices (List[Dict[str, Any]]): The cached choices, None where the prompt still needs to be completed
+            missing (List[int]): The indices of the prompts which still need to be completed
+        '''
+
+        if self.cache is None:
+            return [None for _ in prompts], list(range(len(prompts)))
+
+        choices = self.cache.lookup(prompts, params)
+        missing = [i for i, choice in enumerate(choices) if choice is None]
+
+        return choices, missing
+
+    def _store_cache(self, prompts, params, choices, missing, response):
+        '''Fills in the choices of the missing prompts from an API response, and caches the complete ones
+
+        Streamed choices cut at a sentence boundary (flagged with 'cut') are used this time only, as a later request
+        with the same prompt and parameters may need more of the completion.
+
+        Args:
+            prompts (List[str]): The prompts to complete
+            params (Dict[str, Any]): The Completion API parameters
+            choices (List[Dict[str, Any]]): The choices found so far, filled in place
+            missing (List[int]): The indices of the prompts sent to the API
+            response (Dict[str, Any]): The Completion API response for the missing prompts
+
+        Returns:
+            None
+        '''
+
+        new_choices = sorted(response['choices'], key=lambda choice: choice['index'])
+
+        for i, choice in zip(missing, new_choices):
+            choices[i] = choice
+
+        if self.cache is not None:
+            complete = [(prompts[i], choice) for i, choice in zip(missing, new_choices) if not choice.get('cut')]
+            self.cache.store([prompt for prompt, _ in complete], params, [choice for _, choice in complete])
+
+    def _complete(self, texts, look_ahead=False):
+        '''Calls the Complete API for an OpenAI API model
+        
+        Args:
+            texts (List[str]): The texts for the model to complete
+            look_ahead (Union[bool, List[bool]]): Whether to reuse the confident sentences following the first one, per text or for all of them
+
+        Returns:
+            completions (List[str]): The completions to the texts
+            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
+            all_toks (List[List[float]]): List of list of tokens generated
+        '''
+
+        with self.tracer.span("complete", batch_size=len(texts)) as span:
+
+            # Attributes costing more than a len are only computed when they are recorded
+            if self.tracer.enabled:
+                span["prompt_chars"] = sum(len(text) for text in texts)
+
+            # Call the OpenAI API 
+            choices = self._create_completion(texts, num_sents=self._num_sents(texts, look_ahead), **self._completion_params())
+            completions, all_tok_probs, all_toks = self._parse_choices(choices, look_ahead)
+
+            if self.tracer.enabled:
+                span["completion_tokens"] = sum(len(toks) for toks in all_toks)
+
+        return completions, all_tok_probs, all_toks
+
+    async def _acomplete(self, texts, look_ahead=False):
+        '''Asynchronous version of _complete
+
+        Args:
+            texts (List[str]): The texts for the model to complete
+            look_ahead (Union[bool, List[bool]]): Whether to reuse the confident sentences following the first one, per text or for all of them
+
+        Returns:
+            completions (List[str]): The completions to the texts
+            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
+            all_toks (List[List[float]]): List of list of tokens generated
+        '''
+
+        with self.tracer.span("complete", batch_size=len(texts)) as span:
+
+            # Attributes costing more than a len are only computed when they are recorded
+            if self.tracer.enabled:
+                span["prompt_chars"] = sum(len(text) for text in texts)
+
+            choices = await self._acreate_completion(texts, num_sents=self._num_sents(texts, look_ahead), **self._completion_params())
+            completions, all_tok_probs, all_toks = self._parse_choices(choices, look_ahead)
+
+            if self.tracer.enabled:
+                span["completion_tokens"] = sum(len(toks) for toks in all_toks)
+
+        return completions, all_tok_probs, all_toks
+
+    def _parse_choices(self, choices, look_ahead=False):
+        '''Extracts the first sentence of each choice along with its token probabilities and tokens
+
+        With look_ahead, a confident first sentence is followed by the next complete sentences of the choice up to the first
+        low probability token (at most max_look_ahead_sents sentences), which saves the API calls generating them again.
+
+        Args:
+            choices (List[Dict[str, Any]]): The choices returned by the Completion API
+            look_ahead (Union[bool, List[bool]]): Whether to reuse the confident sentences following the first one, per choice or for all of them
+
+        Returns:
+            completions (List[str]): The completions to the texts
+            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
+            all_toks (List[List[float]]): List of list of tokens generated
+        '''
+
         completions = []
         all_tok_probs = []
         all_toks = []
 
-        for i in range(len(texts)):
+        if isinstance(look_ahead, bool):
+            look_ahead = [look_ahead for _ in choices]
+
+        for choice, reuse in zip(choices, look_ahead):
 
             # For each text, find the relevant information
-            tok_logprobs = response['choices'][i]['logprobs']['token_logprobs']
-            text_offset = response['choices'][i]['logprobs']['text_offset']
-            toks = response['choices'][i]['logprobs']['tokens']
+            tok_logprobs = choice['logprobs']['token_logprobs']
+            text_offset = choice['logprobs']['text_offset']
+            toks = choice['logprobs']['tokens']
             tok_probs = np.exp(tok_logprobs)
-            str_response = response['choices'][i]['text']
-            finish_reason = response['choices'][i]['finish_reason']
+            str_response = choice['text']
+            finish_reason = choice['finish_reason']
             # tokens_used = response['usage']['total_tokens']
 
             # Handle finish_reason
@@ -189,15 +826,16 @@ class QueryAgent(object):
                 all_toks.append(toks)
             else:
                 # Find breakpoint to cut off tok_probs and toks
-                init_offset = text_offset[0]
-                trunc_at = 0
+                trunc_at = self.splitter.token_break(text_offset, break_at)
+
+                # Reuse the look-ahead when the first sentence does not trigger retrieval
+                if reuse and self.max_look_ahead_sents > 1:
+                    break_at, trunc_at, num_reused = self._reuse_look_ahead(str_response, finish_reason, tok_probs, text_offset, break_at, trunc_at)
+                    completion = str_response[:break_at]
+
+                    # ANALYTICS
+                    self._api_calls_saved += num_reused
 
-                for j in range(len(text_offset)):
-                    trunc_at += 1
-                    if text_offset[j] - init_offset >= break_at:
-                        trunc_at -= 1
-                        break
-                    
                 # Append to outputs
                 completions.append(completion)
                 all_tok_probs.append(tok_probs[:trunc_at])
@@ -208,6 +846,48 @@ class QueryAgent(object):
 
         return completions, all_tok_probs, all_toks
 
+    def _reuse_look_ahead(self, text, finish_reason, tok_probs, text_offset, break_at, trunc_at):
+        '''Extends a confident first sentence with the next confident sentences of the completion
+
+        A sentence is reused only if it is complete (followed by another sentence, or the completion stopped by itself) and
+        none of its tokens falls below look_ahead_filter_prob, i.e. it would not have triggered retrieval either.
+
+        Args:
+            text (str): The text of the completion
+            finish_reason (str): Why the completion stopped
+            tok_probs (np.array): The probability of every token of the completion
+            text_offset (List[int]): The character offset of every token, relative to the prompt
+            break_at (int): The breakpoint of the first sentence
+            trunc_at (int): The token breakpoint of the first sentence
+
+        Returns:
+            break_at (int): The breakpoint of the last sentence reused
+            trunc_at (int): The token breakpoint of the last sentence reused
+            num_reused (int): The number of sentences reused after the first one
+        '''
+
+        num_reused = 0
+
+        if trunc_at == 0 or min(tok_probs[:trunc_at]) < self.look_ahead_filter_prob:
+            return break_at, trunc_at, num_reused
+
+        # The sentences after the first one
+        for sent_break_at, last in self.splitter.ends(text, break_at):
+
+            # The last sentence of a truncated completion may be cut off
+            if num_reused + 1 >= self.max_look_ahead_sents or (last and finish_reason != 'stop'):
+                break
+
+            sent_trunc_at = self.splitter.token_break(text_offset, sent_break_at)
+
+            if sent_trunc_at <= trunc_at or min(tok_probs[trunc_at:sent_trunc_at]) < self.look_ahead_filter_prob:
+                break
+
+            break_at, trunc_at = sent_break_at, sent_trunc_at
+            num_reused += 1
+
+        return break_at, trunc_at, num_reused
+
     def _extract_sentence(self, text):
         '''Extracts a sentence from a given text.
 
@@ -219,22 +899,67 @@ class QueryAgent(object):
             break_at (int): The breakpoint of the first sentence
         ''' 
 
-        # Set up sentences
-        Sentence = namedtuple('Sentence', 'text start_char end_char')
-        sents = [Sentence(text[s:e], s, e) for s, e in self.psentencizer.span_tokenize(text)]
+        with self.tracer.span("extract_sentence", chars=len(text)):
+            return self.splitter.first(text)
 
-        # Remove whitespace at end of sentence which is usually tokenized into next token of sentence by OpenAI API
-        break_at = 0
+    def _retrieve(self, queries):
+        '''Retrieves the top documents of a batch of queries
 
-        for sent in sents:
+        Args:
+            queries (List[str]): The queries to retrieve for
 
-            # Remove the whitespace and check if the sentence satisfies a minimum length
-            num_trail_spaces = len(sent.text) - len(sent.text.rstrip())
-            break_at = sent.end_char - num_trail_spaces
-            if break_at >= self.min_sent_len:
-                break
+        Returns:
+            ctx_ids (List[List[str]]): The ids of the retrieved documents
+            ctx_texts (List[Sequence[str]]): The texts of the retrieved documents
+        '''
+
+        # Every query gets the batch it was retrieved in and its index there, so the texts of a LazyPassages are not read
+        def send(lead):
+            docids, docs = self.retriever.retrieve([queries[i] for i in lead], topk=self.topk_retriever)
+            return [(docids, docs, j) for j in range(len(lead))]
+
+        with self.tracer.span("retrieve", queries=len(queries), topk=self.topk_retriever):
+            # Duplicate queries (e.g. the same masked sentence) are only searched once, and their documents shared
+            results = self.retrieval_flight.call([(query, self.topk_retriever) for query in queries], send)
+
+        return RetrievalResult([docids[j] for docids, _, j in results], self._gather_documents(results))
+
+    def _gather_documents(self, results):
+        '''Gathers the documents of every query from the batches they were retrieved in
+
+        Args:
+            results (List[Tuple[List[List[str]], Sequence[Sequence[str]], int]]): The docids and documents of the batch
+                of every query, and its index in the batch
+
+        Returns:
+            documents (Sequence[Sequence[str]]): The documents of every query, still a LazyPassages if they all are
+        '''
+
+        batches = [docs for _, docs, _ in results]
+
+        if batches and all(isinstance(docs, LazyPassages) for docs in batches) and len({id(docs.store) for docs in batches}) == 1:
+            return LazyPassages(batches[0].store, np.stack([docs.rows[j] for _, docs, j in results]))
 
-        return text[:break_at], break_at
+        return [docs[j] for _, docs, j in results]
+
+    def _pack_documents(self, documents, states):
+        '''Packs the retrieved documents of every question, see ContextPacker
+
+        Args:
+            documents (Sequence[Sequence[str]]): The retrieved documents of every question
+            states (List[GenerationState]): The responses generated thus far, remembering the passages already shown
+
+        Returns:
+            documents (Sequence[Sequence[str]]): The documents to linearize, unchanged if packing is off
+        '''
+
+        if not self.packer.enabled:
+            return documents
+
+        assert(len(documents) == len(states))
+
+        with self.tracer.span("pack_documents", batch_size=len(states)):
+            return [self.packer.pack(docs, state.passages) for docs, state in zip(documents, states)]
 
     def _linearize_documents(self, documents, user_inputs, texts):
         '''Linearizes the context documents according to Appendix D.1 in the FLARE paper
@@ -257,110 +982,162 @@ class QueryAgent(object):
 
         assert(len(documents) == len(user_inputs) == len(texts))
 
-        bs = len(documents)
-        linearized_documents = ["" for _ in range(bs)]
+        with self.tracer.span("build_prompts", batch_size=len(documents)):
+            linearized_documents = [self.prompt_builder.build(documents[i], user_inputs[i], texts[i]) for i in range(len(documents))]
+
+        return linearized_documents
+
 
-        for i in range(bs):
+    def _iterative_generate(self, states, sents, all_tok_probs, all_toks):
+        '''Runs one iteration of active retrieval generation
+        
+        Args:
+            states (List[GenerationState]): The responses generated thus far to the user's queries, extended in place
+            sents (List[str]): The sentences just generated
+            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
+            all_toks (List[List[float]]): List of list of tokens generated
 
-            _lin_doc = ""
+        Returns:
+            next_sents (List[str]): The sentences appended to the responses, following the FLARE framework
+        '''
 
-            # In case there is no context
-            if list(documents[i]):
-                _lin_doc += "Search results:\n"
+        with self.tracer.span("iterative_generate", batch_size=len(sents)) as span:
+            next_sents, queries, activated_idxs = self._prepare_retrieval(sents, all_tok_probs, all_toks)
+            span["retrievals"] = len(queries)
 
-            for idx, document in enumerate(documents[i]):
+            if queries:
 
-                _lin_doc += f"[{idx+1}] {document}\n"
+                activated = [states[i] for i in activated_idxs]
 
-            _lin_doc = self.dataset.construct_query(_lin_doc, user_inputs[i])
-            _lin_doc += texts[i]
+                if self.mode == "explicit":
+                    # Explicit queries via one batched LLM Query
+                    queries = self._generate_queries([state.question for state in activated], [state.text for state in activated])
+            
+                # Batch retrieve
+                ctx_ids, ctx_texts = self._retrieve(queries)
+                ctx_texts = self._pack_documents(ctx_texts, activated)
+                next_inputs = self._linearize_documents(ctx_texts, [state.question for state in activated], [state.text for state in activated])
+            
+                # Make sure to only complete for queries where retrieval was necessary
+                gen_sents, _, _ = self._complete(next_inputs)
 
-            linearized_documents[i] = _lin_doc
+                # Update the final responses, making sure to remember which queries activated retrieval
+                for i, gen_sent in zip(activated_idxs, gen_sents):
+                    next_sents[i] = gen_sent
 
-        return linearized_documents
+            for state, next_sent in zip(states, next_sents):
+                state.append(next_sent)
 
+        return next_sents
+
+    async def _aiterative_generate(self, states, sents, all_tok_probs, all_toks):
+        '''Asynchronous version of _iterative_generate
+
+        Args:
+            states (List[GenerationState]): The responses generated thus far to the user's queries, extended in place
+            sents (List[str]): The sentences just generated
+            all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
+            all_toks (List[List[float]]): List of list of tokens generated
+
+        Returns:
+            next_sents (List[str]): The sentences appended to the responses, following the FLARE framework
+        '''
+
+        with self.tracer.span("iterative_generate", batch_size=len(sents)) as span:
+            next_sents, queries, activated_idxs = self._prepare_retrieval(sents, all_tok_probs, all_toks)
+            span["retrievals"] = len(queries)
+
+            if queries:
+
+                activated = [states[i] for i in activated_idxs]
+
+                if self.mode == "explicit":
+                    queries = await self._agenerate_queries([state.question for state in activated], [state.text for state in activated])
+
+                ctx_ids, ctx_texts = await asyncio.to_thread(self._retrieve, queries)
+                ctx_texts = self._pack_documents(ctx_texts, activated)
+                next_inputs = self._linearize_documents(ctx_texts, [state.question for state in activated], [state.text for state in activated])
+
+                gen_sents, _, _ = await self._acomplete(next_inputs)
+
+                for i, gen_sent in zip(activated_idxs, gen_sents):
+                    next_sents[i] = gen_sent
+
+            for state, next_sent in zip(states, next_sents):
+                state.append(next_sent)
+
+        return next_sents
+
+    def _prepare_retrieval(self, sents, all_tok_probs, all_toks):
+        '''Finds the sentences which trigger active retrieval and builds their implicit queries
 
-    def _iterative_generate(self, user_inputs, responses, sents, all_tok_probs, all_toks):
-        '''Runs one iteration of active retrieval generation
-        
         Args:
-            user_inputs (List[str]): The initial queries from the user for the model to answer
-            responses (List[str]): The responses generated thus far to the user's queries
             sents (List[str]): The sentences just generated
             all_tok_probs (List[List[float]]): List of list of probabilities associated with generating each token
             all_toks (List[List[float]]): List of list of tokens generated
 
         Returns:
-            responses (List[str]): The responses generated thus far + sentences generated following the FLARE framework
+            next_sents (List[str]): The sentences to keep, "" where retrieval was triggered
+            queries (List[str]): The queries to the retriever, placeholders in explicit mode to be generated by the caller
+            activated_idxs (List[int]): The indices of the sentences which triggered retrieval
         '''
 
         assert(len(sents) == len(all_tok_probs) == len(all_toks))
 
-        next_sents = []
-        queries = []
-        activated_idxs = []
         bs = len(sents)
 
-        # Prepare the queries to the retriever
-        for i in range(bs):
-
-            # If we generate a sentence that has low probability tokens, use retrieval and append documents to input + content generated thus far
-            # Q: Where do we put exemplars in our response? A: Keep exemplars at the beginning and sandwich retrieved docs
-            if sents[i] != "" and min(all_tok_probs[i]) < self.look_ahead_filter_prob:
-                
-                if self.mode == "implicit":
-                    # Implicity query by masking
-                    _mask = np.array(all_tok_probs[i]) < self.look_ahead_mask_prob
-                    query = np.where(_mask, "", all_toks[i])
-                    query = "".join(query)
-                elif self.mode == "explicit":
-                    # Explicit query via LLM Query
-                    query = self._generate_query(user_inputs[i], responses[i]) 
-                else:
-                    raise Exception("Invalide retrieval mode! Acceptable modes: 'implicit', 'explicit'")
-
-                # Remove whitespace in beginning of query
-                query = query.lstrip()
-
-                queries.append(query)
-                activated_idxs.append(i)
-                next_sents.append("")
+        if bs == 0:
+            return [], [], []
 
-                # ANALYTICS
-                self._total_retrieval_calls += 1
-                self._total_api_calls -= 1 # or else API Calls double counted from self._complete below
-                
-                if self.mode == "implicit":
-                    self._masked_tokens.update(np.array(all_toks[i])[_mask])
+        # The tokens of the whole batch in flat arrays, along with the sentence each token belongs to
+        lengths = [len(tok_probs) for tok_probs in all_tok_probs]
+        probs = np.concatenate(all_tok_probs, dtype=float)
+        owner = np.repeat(np.arange(bs), lengths)
 
-                _mask2 = np.array(all_tok_probs[i]) < self.look_ahead_filter_prob
-                self._low_probability_tokens.update(np.array(all_toks[i])[_mask2])
+        # If we generate a sentence that has low probability tokens, use retrieval and append documents to input + content generated thus far
+        # Q: Where do we put exemplars in our response? A: Keep exemplars at the beginning and sandwich retrieved docs
+        low = probs < self.look_ahead_filter_prob
+        activated = (np.bincount(owner[low], minlength=bs) > 0) & np.array([sent != "" for sent in sents], dtype=bool)
+        activated_idxs = np.flatnonzero(activated).tolist()
 
-            else:
-                next_sents.append(sents[i])
+        next_sents = ["" if active else sent for sent, active in zip(sents, activated)]
 
-        if queries:
-            
-            # Batch retrieve
-            ctx_ids, ctx_texts = self.retriever.retrieve(queries, topk=self.topk_retriever)
-            next_inputs = self._linearize_documents(ctx_texts, np.array(user_inputs)[activated_idxs], np.array(responses)[activated_idxs])
-            
-            # Make sure to only complete for queries where retrieval was necessary
-            gen_sents, _, _ = self._complete(next_inputs)
+        if not activated_idxs:
+            return next_sents, [], []
+
+        if self.mode not in ("implicit", "explicit"):
+            raise Exception("Invalide retrieval mode! Acceptable modes: 'implicit', 'explicit'")
+
+        toks = list(itertools.chain.from_iterable(all_toks))
+        on_activated = activated[owner]
 
-            # Update the final responses, making sure to remember which queries activated retrieval
-            c = 0
-            for i in range(bs):
-                if i in activated_idxs:
-                    next_sents[i] = gen_sents[c]
-                    c += 1
-                
-        responses = np.char.add(responses, next_sents)
+        # ANALYTICS
+        self._total_retrieval_calls += len(activated_idxs)
+        self._total_api_calls -= len(activated_idxs) # or else API Calls double counted from self._complete below
+        self._low_probability_tokens.update(itertools.compress(toks, low & on_activated))
 
-        return responses
+        if self.mode == "implicit":
 
-    def _generate_query(self, user_input, response):
-        '''Generates an explicit query for the retriever from content generated thus far
+            # Implicit queries by masking the low probability tokens
+            masked = probs < self.look_ahead_mask_prob
+            kept = ~masked & on_activated
+
+            # ANALYTICS
+            self._masked_tokens.update(itertools.compress(toks, masked & on_activated))
+
+            # Split the kept tokens back into the sentences, and remove whitespace in beginning of queries
+            kept_toks = list(itertools.compress(toks, kept))
+            bounds = np.concatenate([[0], np.cumsum(np.bincount(owner[kept], minlength=bs)[activated])]).tolist()
+            queries = ["".join(kept_toks[start:end]).lstrip() for start, end in zip(bounds[:-1], bounds[1:])]
+
+        else:
+            # Explicit queries via LLM Query, generated in one batch by the caller
+            queries = ["" for _ in activated_idxs]
+
+        return next_sents, queries, activated_idxs
+
+    def _generate_queries(self, user_inputs, responses):
+        '''Generates explicit queries for the retriever from content generated thus far, in one batched API call
 
         Ex.
         {USER INPUT}
@@ -370,29 +1147,71 @@ class QueryAgent(object):
         or
         Given the above passage, ask a question to verify the truthfulness of the last sentence in the passage.
 
+        Args:
+            user_inputs (List[str]): The user inputs
+            responses (List[str]): The responses generated thus far for the user inputs, including the sentence to regenerate
+
+        Returns:
+            queries (List[str]): The queries to be passed to the retriever
+        '''
+
+        with self.tracer.span("generate_queries", batch_size=len(user_inputs)):
+            choices = self._create_completion(
+                [self._query_prompt(user_input, response) for user_input, response in zip(user_inputs, responses)],
+                **self._query_params(),
+            )
+
+        return [choice['text'].replace('"', "").lstrip() for choice in choices]
+
+    async def _agenerate_queries(self, user_inputs, responses):
+        '''Asynchronous version of _generate_queries
+
+        Args:
+            user_inputs (List[str]): The user inputs
+            responses (List[str]): The responses generated thus far for the user inputs, including the sentence to regenerate
+
+        Returns:
+            queries (List[str]): The queries to be passed to the retriever
+        '''
+
+        with self.tracer.span("generate_queries", batch_size=len(user_inputs)):
+            choices = await self._acreate_completion(
+                [self._query_prompt(user_input, response) for user_input, response in zip(user_inputs, responses)],
+                **self._query_params(),
+            )
+
+        return [choice['text'].replace('"', "").lstrip() for choice in choices]
+
+    def _query_prompt(self, user_input, response):
+        '''Builds the prompt asking the LM for an explicit query, see _generate_queries
+
         Args:
             user_input (str): The user input
-            response (str): The response generated thus far for the user input, including the sentence to regenerate
+            response (str): The response generated thus far for the user input
 
         Returns:
-            query (str): The query to be passed to the retriever
+            prompt (str): The prompt for the query generation call
         '''
 
         context = user_input + "\n" + response.lstrip()
-        
-        response = openai.Completion.create(
-            model="gpt-3.5-turbo-instruct",
-            prompt=[f"{context}\n\nLet's verify the truthfulness of the last sentence in the passage above. Given the above passage, state a search query to verify the factuality of the last sentence in the passage above."],
+
+        return f"{context}\n\nLet's verify the truthfulness of the last sentence in the passage above. Given the above passage, state a search query to verify the factuality of the last sentence in the passage above."
+
+    def _query_params(self):
+        '''Returns the sampling parameters of the explicit query generation calls
+
+        Returns:
+            params (Dict[str, Any]): Keyword arguments for the Completion API
+        '''
+
+        return dict(
+            model=self.query_model,
             temperature=0,
-            max_tokens=64,
+            max_tokens=self.query_max_gen_len,
             top_p=1,
-            logprobs=0
+            logprobs=0,
         )
 
-        query = response['choices'][0]['text'].replace('"', "")
-
-        return query
-
     def normalize(self, responses):
         '''Normalizes the output of the model
         
@@ -422,17 +1241,63 @@ class QueryAgent(object):
         print(f"Total API calls: {self._total_api_calls}")
         print(f"Total Retrievals: {self._total_retrieval_calls}")
         print(f"Retrieval Rate: {self._total_retrieval_calls/self._total_api_calls}")
+        print(f"API calls saved by reusing look-ahead sentences: {self._api_calls_saved}")
+
+        stats = self.rate_limiter.stats
+        print(f"API requests: {stats['requests']}, retries: {stats['retries']}, throttled: {stats['throttled']}, rate limit waits: {stats['wait_seconds']:.1f}s")
+
+        if self.stream:
+            print(f"Streamed tokens: {self._streamed_tokens}, completions cut at the sentence boundary: {self._stream_cuts}")
         print('─' * 20)
         print(f"Most common low probability tokens: {self._low_probability_tokens.most_common(10)}")
         print(f"Most common masked tokens for implicit retrieval: {self._masked_tokens.most_common(10)}")
         print(f"Total num low probability tokens: {self._low_probability_tokens.total()}")
         print(f"Total num masked tokens for implicit retrieval: {self._masked_tokens.total()}")
 
-    def _save_analytics(self, path):
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print('─' * 20)
+            print(f"Completion cache hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hit_rate']}")
+
+        if getattr(self._retriever, 'cache', None) is not None:
+            stats = self._retriever.cache.stats()
+            print(f"Retrieval cache hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hit_rate']}")
+
+        if getattr(self._retriever, 'transport', None) is not None:
+            stats = self._retriever.transport.stats
+            print(f"ElasticSearch sub-requests: {stats['sub_requests']}, hedged: {stats['hedged']} (answered first: {stats['hedge_wins']}), failed: {stats['failures']}, p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms")
+
+        for name, flight in (("Completion", self.completion_flight), ("Retrieval", self.retrieval_flight)):
+            stats = flight.stats
+            print(f"{name} requests: {stats['requested']}, duplicates coalesced in a batch: {stats['coalesced']}, joined in flight: {stats['joined']}, dedup ratio: {stats['dedup_ratio']:.3f}")
+
+        if getattr(self.lm, 'stats', None) is not None:
+            stats = self.lm.stats
+            print('─' * 20)
+            print(f"Local LM prompt tokens reused from the KV cache: {stats['reused_tokens']}, run through the model: {stats['processed_tokens']}, prompts cut to fit the context: {stats['truncated_prompts']}")
+
+        if self.packer.enabled:
+            stats = self.packer.stats
+            print('─' * 20)
+            print(f"Passages kept: {stats['kept']} / {stats['passages']}, dropped empty: {stats['empty']}, duplicates: {stats['duplicates']}, near duplicates: {stats['near_duplicates']}, seen earlier in the answer: {stats['seen']}")
+
+        if self.prompt_builder.budgeted:
+            stats = self.prompt_builder.stats
+            print('─' * 20)
+            print(f"Prompts cut to fit the token budget: {stats['cut_prompts']} / {stats['prompts']}, max prompt tokens: {stats['max_prompt_tokens']}")
+            print(f"Dropped exemplars: {stats['dropped_exemplars']}, truncated passages: {stats['truncated_passages']}")
+
+        if self.tracer.enabled:
+            print('─' * 20)
+            for name, stats in self.tracer.summary().items():
+                print(f"{name}: {stats['count']} spans, total {stats['total_ms']:.0f}ms, mean {stats['mean_ms']:.1f}ms, p50 {stats['p50_ms']:.1f}ms, p95 {stats['p95_ms']:.1f}ms")
+
+    def _save_analytics(self, path, answered=None):
         '''Save model analytics to the specified path
 
         Args:
             path (str): The path to save analytics of model to
+            answered (int): The number of answers already written out, which the analytics account for
 
         Returns:
             None
@@ -445,7 +1310,83 @@ class QueryAgent(object):
             "retrieval_calls": self._total_retrieval_calls,
             "low_prob_toks": self._low_probability_tokens,
             "low_masked_toks": self._masked_tokens,
+            "api_calls_saved": self._api_calls_saved,
+            "streamed_tokens": self._streamed_tokens,
+            "stream_cuts": self._stream_cuts,
+            "rate_limiter": self.rate_limiter.stats,
+            "completion_dedup": self.completion_flight.stats,
+            "retrieval_dedup": self.retrieval_flight.stats,
         }
 
-        with open(cur_path + path, 'w') as f:
-            json.dump(data, f)
\ No newline at end of file
+        if answered is not None:
+            data["answered"] = answered
+
+        if self.cache is not None:
+            data["completion_cache"] = self.cache.stats()
+
+        if getattr(self._retriever, 'cache', None) is not None:
+            data["retrieval_cache"] = self._retriever.cache.stats()
+
+        if getattr(self._retriever, 'transport', None) is not None:
+            data["es_transport"] = self._retriever.transport.stats
+
+        if getattr(self.lm, 'stats', None) is not None:
+            data["local_lm"] = self.lm.stats
+
+        if self.packer.enabled:
+            data["packing"] = self.packer.stats
+
+        if self.prompt_builder.budgeted:
+            data["prompts"] = self.prompt_builder.stats
+
+        if self.tracer.enabled:
+            data["timings"] = self.tracer.summary()
+
+        # Write then rename, so a crash while checkpointing never leaves a truncated file
+        with open(cur_path + path + '.tmp', 'w') as f:
+            json.dump(data, f)
+
+        os.replace(cur_path + path + '.tmp', cur_path + path)
+
+    def _save_trace(self, path):
+        '''Save the spans recorded by the tracer, as JSONL and as a Chrome trace
+
+        Args:
+            path (str): The path to save the spans to, without extension
+
+        Returns:
+            None
+        '''
+
+        cur_path = os.path.abspath(os.curdir)
+
+        self.tracer.save_jsonl(cur_path + path + '.jsonl')
+        self.tracer.save_chrome_trace(cur_path + path + '.json')
+
+    def _load_analytics(self, path):
+        '''Load model analytics saved by _save_analytics, to resume counting from a checkpoint
+
+        Args:
+            path (str): The path the analytics of the model were saved to
+
+        Returns:
+            answered (int): The number of answers the analytics account for, None if it was not saved
+        '''
+
+        cur_path = os.path.abspath(os.curdir)
+
+        with open(cur_path + path, 'r') as f:
+            data = json.load(f)
+
+        self._total_api_calls = data["api_calls"]
+        self._total_retrieval_calls = data["retrieval_calls"]
+        self._low_probability_tokens = Counter(data["low_prob_toks"])
+        self._masked_tokens = Counter(data["low_masked_toks"])
+        self._api_calls_saved = data.get("api_calls_saved", 0)
+        self._streamed_tokens = data.get("streamed_tokens", 0)
+        self._stream_cuts = data.get("stream_cuts", 0)
+
+        if "prompts" in data:
+            self.prompt_builder.stats.update(data["prompts"])
+
+        return data.get("answered")
\ No newline at end of file
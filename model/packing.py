@@ -0,0 +1,139 @@
+from typing import List, Sequence, Set
+import re
+
+WORD = re.compile(r"\w+")
+
+class ContextPacker(object):
+    '''
+    Packs the retrieved passages of a prompt, between the retriever and the prompt assembly, so the LM is not sent the
+    same evidence twice.
+
+    The retriever pads missing hits with empty passages, and DPR holds many near copies of the same passage (e.g. the
+    same paragraph in two revisions of an article). Whenever the packer is enabled, empty passages are skipped. With
+    dedup, a passage is also dropped if its normalized words (lowercase, punctuation removed) are those of a passage kept before it, or if the Jaccard
+    similarity of their word shingles reaches near_duplicate_threshold. The shingles are hashed, and a prompt only
+    holds a few passages, so comparing them pairwise is cheap. With drop_seen, the passages already shown to the LM
+    earlier in the same answer are dropped as well.
+
+    The passages are otherwise kept in the order of the retriever. Cutting each passage to a token allowance is left to
+    the PromptBuilder (max_passage_tokens), which counts the tokens of the packed passages only.
+
+    Args:
+        dedup (bool): Whether duplicates and near duplicates are dropped
+        near_duplicate_threshold (float): The shingle Jaccard similarity from which passages are near duplicates, exact duplicates only if None
+        shingle_size (int): The number of words of a shingle
+        drop_seen (bool): Whether the passages already shown earlier in the same answer are dropped
+
+    Attributes:
+        dedup (bool): This stores whether duplicates and near duplicates are dropped
+        near_duplicate_threshold (float): This stores the similarity from which passages are near duplicates
+        shingle_size (int): This stores the number of words of a shingle
+        drop_seen (bool): This stores whether the passages already shown earlier in the same answer are dropped
+        stats (Dict[str, int]): This stores the number of passages packed, kept and dropped for each reason
+
+    '''
+    def __init__(
+        self,
+        dedup: bool = False,
+        near_duplicate_threshold: float = 0.8,
+        shingle_size: int = 3,
+        drop_seen: bool = False,
+    ):
+
+        self.dedup = dedup
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.shingle_size = shingle_size
+        self.drop_seen = drop_seen
+
+        self.stats = {
+            "passages": 0,
+            "kept": 0,
+            "empty": 0,
+            "duplicates": 0,
+            "near_duplicates": 0,
+            "seen": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.dedup or self.drop_seen
+
+    def pack(
+        self,
+        documents: Sequence[str],
+        seen: Set[int] = None,
+    ) -> List[str]:
+        '''Packs the retrieved passages of one prompt
+
+        Args:
+            documents (Sequence[str]): The retrieved passages, in the order of the retriever
+            seen (Set[int]): The fingerprints of the passages shown earlier in the same answer, extended in place with the
+                passages kept
+
+        Returns:
+            documents (List[str]): The passages to put in the prompt
+        '''
+
+        if not self.enabled:
+            return list(documents)
+
+        kept = []
+        kept_shingles = []
+        fingerprints = set()
+
+        for document in documents:
+
+            words = WORD.findall(document.lower())
+            fingerprint = hash(" ".join(words))
+
+            # Never kept, so an empty passage is not remembered as seen either
+            if not words:
+                reason = "empty"
+            elif self.dedup and fingerprint in fingerprints:
+                reason = "duplicates"
+            elif self.drop_seen and seen is not None and fingerprint in seen:
+                reason = "seen"
+            else:
+                reason = None
+
+            if reason is None and self.dedup and self.near_duplicate_threshold is not None:
+                shingles = self._shingles(words)
+
+                if any(self._jaccard(shingles, other) >= self.near_duplicate_threshold for other in kept_shingles):
+                    reason = "near_duplicates"
+                else:
+                    kept_shingles.append(shingles)
+
+            # ANALYTICS
+            self.stats["passages"] += 1
+
+            if reason is not None:
+                self.stats[reason] += 1
+                continue
+
+            self.stats["kept"] += 1
+
+            kept.append(document)
+            fingerprints.add(fingerprint)
+
+        if self.drop_seen and seen is not None:
+            seen.update(fingerprints)
+
+        return kept
+
+    def _shingles(self, words: List[str]) -> Set[int]:
+        '''The hashes of the runs of shingle_size words of a passage, the whole passage if it is shorter'''
+
+        k = min(self.shingle_size, len(words))
+
+        return {hash(tuple(words[i:i + k])) for i in range(len(words) - k + 1)}
+
+    @staticmethod
+    def _jaccard(a: Set[int], b: Set[int]) -> float:
+
+        if not a or not b:
+            return 0.0
+
+        common = len(a & b)
+
+        return common / (len(a) + len(b) - common)
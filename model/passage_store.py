@@ -0,0 +1,203 @@
+from typing import List, Sequence
+import os
+import array
+import numpy as np
+
+class PassageStore(object):
+    '''
+    A memory-mapped store of the passage texts of a corpus.
+
+    The texts are kept as one contiguous UTF-8 blob along with the offsets of every passage, so the passage of a row is
+    decoded straight from the page cache without loading the corpus into memory. Document ids are mapped to rows with a
+    binary search over the sorted ids.
+
+    Args:
+        path (str): The directory holding passages.bin, passages.offsets.npy and ids.npy (and ids.order.npy, ids.sorted.npy if the ids are not sorted)
+
+    Attributes:
+        path (str): This stores the directory of the passage store
+        offsets (np.ndarray): Shape (N+1,), the byte offset of every passage in the blob
+        ids (np.ndarray): Shape (N,), the document id of every row
+
+    '''
+    def __init__(
+        self,
+        path: str,
+    ):
+
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'passages.offsets.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+
+        # An empty file cannot be memory-mapped
+        if self.offsets[-1] > 0:
+            self._blob = np.memmap(os.path.join(path, 'passages.bin'), dtype=np.uint8, mode='r')
+        else:
+            self._blob = np.zeros(0, dtype=np.uint8)
+
+        # The DPR ids are already sorted by row, only other corpora need the permutation
+        order_path = os.path.join(path, 'ids.order.npy')
+        self._order = np.load(order_path, mmap_mode='r') if os.path.exists(order_path) else None
+
+        # The sorted ids are searched on every retrieval, memory-mapped if the writer saved them, or else sorted once here
+        sorted_path = os.path.join(path, 'ids.sorted.npy')
+        if self._order is None:
+            self._sorted_ids = self.ids
+        elif os.path.exists(sorted_path):
+            self._sorted_ids = np.load(sorted_path, mmap_mode='r')
+        else:
+            self._sorted_ids = self.ids[self._order]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        # Decodes from the memory-mapped buffer without an intermediate bytes copy
+        return str(self._blob[self.offsets[row]:self.offsets[row+1]], 'utf-8')
+
+    def get_many(self, rows: List[int]) -> List[str]:
+        '''Reads the passages of several rows
+
+        Args:
+            rows (List[int]): The rows of the passages
+
+        Returns:
+            passages (List[str]): The passage texts
+        '''
+
+        return [self[row] for row in rows]
+
+    def rows(self, docids: Sequence[str]) -> np.ndarray:
+        '''Finds the rows of document ids
+
+        Args:
+            docids (Sequence[str]): The document ids, ids which are not in the store (e.g. dummy docs) are allowed
+
+        Returns:
+            rows (np.ndarray): The row of every document id, -1 if the id is not in the store
+        '''
+
+        shape = np.shape(docids)
+        docids = np.ravel(docids)
+
+        # Dummy doc ids are not numbers
+        valid = np.array([str(docid).isdigit() for docid in docids], dtype=bool)
+        keys = np.zeros(len(docids), dtype=np.int64)
+        keys[valid] = [int(docid) for docid in docids[valid]]
+
+        sorted_ids = self._sorted_ids
+        positions = np.searchsorted(sorted_ids, keys).clip(0, max(len(sorted_ids) - 1, 0))
+
+        found = valid & (len(sorted_ids) > 0)
+        found[found] = sorted_ids[positions[found]] == keys[found]
+
+        rows = positions if self._order is None else np.asarray(self._order)[positions]
+        rows = np.where(found, rows, -1)
+
+        return rows.reshape(shape)
+
+    def lazy(self, rows: np.ndarray) -> 'LazyPassages':
+        '''Wraps a (bs, topk) array of rows into documents which are only read when accessed
+
+        Args:
+            rows (np.ndarray): Shape (bs, topk), the rows of the documents, -1 for an empty document
+
+        Returns:
+            documents (LazyPassages): The lazily read documents
+        '''
+
+        return LazyPassages(self, rows)
+
+class LazyPassages(object):
+    '''
+    Retrieved documents whose texts are read from a PassageStore only when a row of the batch is accessed.
+
+    Indexing the batch gives the list of texts of one query, as _linearize_documents expects.
+
+    Args:
+        store (PassageStore): The store to read the texts from
+        rows (np.ndarray): Shape (bs, topk), the rows of the documents, -1 for an empty document
+
+    Attributes:
+        store (PassageStore): This stores the store to read the texts from
+        rows (np.ndarray): This stores the rows of the documents
+
+    '''
+    def __init__(
+        self,
+        store: PassageStore,
+        rows: np.ndarray,
+    ):
+
+        self.store = store
+        self.rows = rows
+
+    @property
+    def shape(self):
+        return self.rows.shape
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> List[str]:
+        return [self.store[row] if row >= 0 else '' for row in self.rows[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class PassageStoreWriter(object):
+    '''
+    Appends passages to a new passage store, see PassageStore.
+
+    Args:
+        path (str): The directory to write the passage store into
+
+    '''
+    def __init__(
+        self,
+        path: str,
+    ):
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self._blob = open(os.path.join(path, 'passages.bin'), 'wb')
+
+        # Compact arrays, lists of 21M Python ints would take gigabytes
+        self._offsets = array.array('q', [0])
+        self._ids = array.array('q')
+
+    def add(self, docid: str, text: str):
+        '''Appends a passage
+
+        Args:
+            docid (str): The (numeric) document id of the passage
+            text (str): The passage text
+
+        Returns:
+            None
+        '''
+
+        data = text.encode('utf-8')
+        self._blob.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        self._ids.append(int(docid))
+
+    def close(self):
+        '''Writes the offsets and the ids, and closes the blob
+
+        Returns:
+            None
+        '''
+
+        self._blob.close()
+
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        np.save(os.path.join(self.path, 'passages.offsets.npy'), np.frombuffer(self._offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'ids.npy'), ids)
+
+        if np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind='stable')
+            np.save(os.path.join(self.path, 'ids.order.npy'), order)
+            np.save(os.path.join(self.path, 'ids.sorted.npy'), ids[order])
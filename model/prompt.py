@@ -0,0 +1,217 @@
+from typing import List, Sequence
+import itertools
+from functools import lru_cache
+
+def load_tokenizer(model: str = 'gpt-3.5-turbo-instruct'):
+    '''Loads the tokenizer of an OpenAI model, tiktoken if installed or else the GPT-2 tokenizer of transformers
+
+    Args:
+        model (str): The name of the OpenAI API model
+
+    Returns:
+        tokenizer (Any): An object with encode(str) -> List[int] and decode(List[int]) -> str
+    '''
+
+    try:
+        import tiktoken
+    except ImportError:
+        from transformers import GPT2TokenizerFast
+        return GPT2TokenizerFast.from_pretrained('gpt2')
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+def _water_level(lengths: Sequence[int], available: int) -> int:
+    '''The largest cap such that the lengths clipped at the cap sum to at most available'''
+
+    remaining = max(available, 0)
+    lengths = sorted(lengths)
+
+    for i, length in enumerate(lengths):
+        share = remaining // (len(lengths) - i)
+        if length > share:
+            return share
+        remaining -= length
+
+    return lengths[-1] if lengths else 0
+
+class PromptBuilder(object):
+    '''
+    Assembles the prompts of a dataset within an input-token budget.
+
+    A prompt is made of segments, in this order: the exemplars, the retrieved passages (Appendix D.1 of the FLARE paper),
+    the question and the response generated thus far. The exemplars are formatted once, and their prefix strings and
+    token counts are precomputed for every number of exemplars, so building a prompt is a single join. The token count of
+    a prompt is the sum of the counts of its segments.
+
+    When a prompt exceeds max_input_tokens, exemplars are dropped from the end down to min_exemplars, then the passages
+    are truncated to a common token cap. The question and the response are never cut. Without a budget no tokenizer is
+    loaded and prompts are built as they always were.
+
+    Args:
+        dataset (Any): The dataset providing exemplars() and question_template
+        max_input_tokens (int): The input-token budget of a prompt, unbounded if None
+        max_passage_tokens (int): The maximum number of tokens of each passage, unbounded if None
+        min_exemplars (int): The number of exemplars never dropped to fit the budget
+        model (str): The OpenAI API model whose tokenizer counts tokens
+        tokenizer (Any): Custom tokenizer with encode and decode, loaded from the model if None
+
+    Attributes:
+        dataset (Any): This stores the dataset the prompts are built for
+        max_input_tokens (int): This stores the input-token budget of a prompt
+        max_passage_tokens (int): This stores the maximum number of tokens of each passage
+        min_exemplars (int): This stores the number of exemplars never dropped
+        stats (Dict[str, int]): This stores the number of prompts built, cut to fit, and the tokens of the prompts
+
+    '''
+    def __init__(
+        self,
+        dataset: object,
+        max_input_tokens: int = None,
+        max_passage_tokens: int = None,
+        min_exemplars: int = 1,
+        model: str = 'gpt-3.5-turbo-instruct',
+        tokenizer: object = None,
+    ):
+
+        self.dataset = dataset
+        self.max_input_tokens = max_input_tokens
+        self.max_passage_tokens = max_passage_tokens
+        self.min_exemplars = min_exemplars
+        self.model = model
+
+        self._tokenizer = tokenizer
+        self._prefixes = None
+        self._prefix_tokens = None
+        self._count = lru_cache(maxsize=100000)(self._count_tokens)
+
+        self.stats = {
+            "prompts": 0,
+            "cut_prompts": 0,
+            "dropped_exemplars": 0,
+            "truncated_passages": 0,
+            "prompt_tokens": 0,
+            "max_prompt_tokens": 0,
+        }
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = load_tokenizer(self.model)
+        return self._tokenizer
+
+    @property
+    def budgeted(self) -> bool:
+        return self.max_input_tokens is not None or self.max_passage_tokens is not None
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text))
+
+    def _truncate(self, text: str, num_tokens: int) -> str:
+        return self.tokenizer.decode(self.tokenizer.encode(text)[:max(num_tokens, 0)])
+
+    def _exemplar_prefixes(self):
+        '''Formats the exemplars once, the prefix of the first k exemplars is self._prefixes[k]'''
+
+        if self._prefixes is None:
+            exemplars = self.dataset.exemplars()
+            self._prefixes = [""] + list(itertools.accumulate(exemplars))
+
+            if self.budgeted:
+                self._prefix_tokens = [0] + list(itertools.accumulate(self._count(exemplar) for exemplar in exemplars))
+
+        return self._prefixes
+
+    def build(
+        self,
+        documents: Sequence[str],
+        question: str,
+        response: str,
+    ) -> str:
+        '''Builds the prompt of one question
+
+        Ex.
+        (Exemplars)
+        Search results:
+        [1] Document 1
+        [2] Document 2
+        ...
+        (The user input x)(Output generated thus far)
+
+        Args:
+            documents (Sequence[str]): The retrieved passages, possibly none
+            question (str): The user input question
+            response (str): The response generated thus far
+
+        Returns:
+            prompt (str): The prompt to pass into the LM
+        '''
+
+        prefixes = self._exemplar_prefixes()
+        documents = list(documents)
+        question = self.dataset.question_template(question)
+
+        if not self.budgeted:
+            return self._join(prefixes[-1], documents, question, response)
+
+        num_exemplars = len(prefixes) - 1
+        labels = [f"[{idx+1}] " for idx in range(len(documents))]
+
+        fixed = self._count(question) + self._count_tokens(response)
+        if documents:
+            fixed += self._count("Search results:\n") + sum(self._count(label) + 1 for label in labels)
+
+        doc_tokens = [self._count(document) for document in documents]
+        cap = max(doc_tokens) if doc_tokens else 0
+
+        if self.max_passage_tokens is not None:
+            cap = min(cap, self.max_passage_tokens)
+
+        clipped = sum(min(tokens, cap) for tokens in doc_tokens)
+
+        if self.max_input_tokens is not None:
+
+            # Drop exemplars first, then cut the passages to a common cap
+            while num_exemplars > self.min_exemplars and fixed + self._prefix_tokens[num_exemplars] + clipped > self.max_input_tokens:
+                num_exemplars -= 1
+
+            available = self.max_input_tokens - fixed - self._prefix_tokens[num_exemplars]
+
+            if clipped > available:
+                cap = min(cap, _water_level(doc_tokens, available))
+                clipped = sum(min(tokens, cap) for tokens in doc_tokens)
+
+        truncated = 0
+        for i, tokens in enumerate(doc_tokens):
+            if tokens > cap:
+                documents[i] = self._truncate(documents[i], cap)
+                truncated += 1
+
+        # ANALYTICS
+        num_tokens = fixed + self._prefix_tokens[num_exemplars] + clipped
+        dropped = len(prefixes) - 1 - num_exemplars
+
+        self.stats["prompts"] += 1
+        self.stats["cut_prompts"] += int(dropped > 0 or truncated > 0)
+        self.stats["dropped_exemplars"] += dropped
+        self.stats["truncated_passages"] += truncated
+        self.stats["prompt_tokens"] += num_tokens
+        self.stats["max_prompt_tokens"] = max(self.stats["max_prompt_tokens"], num_tokens)
+
+        return self._join(prefixes[num_exemplars], documents, question, response)
+
+    def _join(self, prefix: str, documents: List[str], question: str, response: str) -> str:
+
+        segments = [prefix]
+
+        # In case there is no context
+        if documents:
+            segments.append("Search results:\n")
+            segments.extend(f"[{idx+1}] {document}\n" for idx, document in enumerate(documents))
+
+        segments.append(question)
+        segments.append(response)
+
+        return "".join(segments)
@@ -0,0 +1,300 @@
+from typing import Any, Callable, Dict, List, Tuple
+import sys
+import time
+import asyncio
+import threading
+
+from tenacity import Retrying, AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+def retryable_errors() -> Tuple[type, ...]:
+    '''The errors worth retrying, the others (e.g. invalid requests) would fail again
+
+    An openai error can only be raised once openai was imported (by its backend), so it is looked up in sys.modules
+    rather than imported, and other backends never pay for importing it.
+
+    Returns:
+        errors (Tuple[type, ...]): The exception classes to retry, none if openai was not imported
+    '''
+
+    openai = sys.modules.get('openai')
+
+    if openai is None:
+        return ()
+
+    return (
+        openai.error.RateLimitError,
+        openai.error.Timeout,
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    )
+
+def _is_retryable(exception: BaseException) -> bool:
+    return isinstance(exception, retryable_errors())
+
+def _is_rate_limit(exception: BaseException) -> bool:
+    openai = sys.modules.get('openai')
+    return openai is not None and isinstance(exception, openai.error.RateLimitError)
+
+class TokenBucket(object):
+    '''
+    A token bucket refilled continuously at a per minute rate, holding at most one minute worth of tokens.
+
+    Reserving takes the tokens right away, possibly going into debt, and returns how long to wait for the debt to be
+    repaid. Concurrent callers thus queue up behind each other instead of all waking up at once.
+
+    Args:
+        per_minute (float): The number of tokens (or requests) allowed per minute
+
+    Attributes:
+        rate (float): This stores the refill rate, per second
+        capacity (float): This stores the maximum number of tokens in the bucket
+
+    '''
+    def __init__(
+        self,
+        per_minute: float,
+    ):
+
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+
+        self._level = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        '''Takes tokens from the bucket
+
+        Args:
+            amount (float): The number of tokens to take, negative to give tokens back
+
+        Returns:
+            delay (float): The number of seconds to wait before using the tokens
+        '''
+
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            self._level -= amount
+
+            return max(0, -self._level / self.rate)
+
+    def drain(self):
+        '''Empties the bucket, after the server said the limit was hit
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            self._level = min(self._level, 0)
+
+class RateLimiter(object):
+    '''
+    Client-side scheduling of the OpenAI API requests within the requests and tokens per minute limits of the account.
+
+    A multi-prompt request is sent as sub-batches of at most batch_size prompts. Before each sub-batch, its tokens are
+    estimated from the prompt lengths plus max_tokens per prompt and reserved in the token buckets, then corrected with
+    the usage reported by the API. Rate limits, timeouts, connection and server errors are retried with jittered
+    exponential backoff. The batch size adapts additively-increase / multiplicatively-decrease: it is halved whenever
+    the API throttles, and grows by one after every increase_every requests in a row without throttling.
+
+    Args:
+        requests_per_minute (float): The requests per minute limit, unbounded if None
+        tokens_per_minute (float): The tokens per minute limit, unbounded if None
+        max_batch_size (int): The maximum number of prompts per request
+        min_batch_size (int): The minimum number of prompts per request
+        increase_every (int): The number of requests without throttling before the batch size grows
+        max_retries (int): The maximum number of attempts of a request
+        min_wait (float): The scale of the exponential backoff, in seconds
+        max_wait (float): The maximum backoff, in seconds
+        chars_per_token (float): The number of prompt characters per token to estimate the usage of a request
+
+    Attributes:
+        requests (TokenBucket): This stores the requests per minute bucket, None if unbounded
+        tokens (TokenBucket): This stores the tokens per minute bucket, None if unbounded
+        batch_size (int): This stores the current number of prompts per request
+        stats (Dict[str, float]): This stores the number of requests, retries, throttles and seconds waited
+
+    '''
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_batch_size: int = 20,
+        min_batch_size: int = 1,
+        increase_every: int = 10,
+        max_retries: int = 8,
+        min_wait: float = 1,
+        max_wait: float = 60,
+        chars_per_token: float = 4,
+    ):
+
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.increase_every = increase_every
+        self.max_retries = max_retries
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.chars_per_token = chars_per_token
+
+        self.batch_size = max_batch_size
+        self._successes = 0
+
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def estimate_tokens(self, prompts: List[str], max_tokens: int) -> int:
+        '''Estimates the tokens billed for a request
+
+        Args:
+            prompts (List[str]): The prompts of the request
+            max_tokens (int): The maximum number of tokens generated per prompt
+
+        Returns:
+            tokens (int): The estimated number of prompt and completion tokens
+        '''
+
+        return int(sum(len(prompt) for prompt in prompts) / self.chars_per_token) + max_tokens * len(prompts)
+
+    def call(
+        self,
+        request: Callable[[int, int], Dict[str, Any]],
+        prompts: List[str],
+        max_tokens: int,
+    ) -> Dict[str, Any]:
+        '''Sends a multi-prompt request within the rate limits
+
+        Args:
+            request (Callable[[int, int], Dict[str, Any]]): Sends the prompts[start:end] and returns the API response
+            prompts (List[str]): The prompts to complete
+            max_tokens (int): The maximum number of tokens generated per prompt
+
+        Returns:
+            response (Dict[str, Any]): The API response for all of the prompts
+        '''
+
+        choices = []
+        start = 0
+
+        while start < len(prompts):
+
+            for attempt in self._retrying(Retrying):
+                with attempt:
+                    end = start + self.batch_size
+                    estimate = self._reserve(prompts[start:end], max_tokens)
+                    time.sleep(estimate[1])
+                    response = request(start, end)
+
+            choices += self._done(response, start, estimate[0])
+            start = end
+
+        return {'choices': choices}
+
+    async def acall(
+        self,
+        request: Callable[[int, int], Any],
+        prompts: List[str],
+        max_tokens: int,
+    ) -> Dict[str, Any]:
+        '''Asynchronous version of call, request is a coroutine function
+
+        Args:
+            request (Callable[[int, int], Awaitable[Dict[str, Any]]]): Sends the prompts[start:end] and returns the API response
+            prompts (List[str]): The prompts to complete
+            max_tokens (int): The maximum number of tokens generated per prompt
+
+        Returns:
+            response (Dict[str, Any]): The API response for all of the prompts
+        '''
+
+        choices = []
+        start = 0
+
+        while start < len(prompts):
+
+            async for attempt in self._retrying(AsyncRetrying):
+                with attempt:
+                    end = start + self.batch_size
+                    estimate = self._reserve(prompts[start:end], max_tokens)
+                    await asyncio.sleep(estimate[1])
+                    response = await request(start, end)
+
+            choices += self._done(response, start, estimate[0])
+            start = end
+
+        return {'choices': choices}
+
+    def _retrying(self, retrying_cls):
+        return retrying_cls(
+            retry=retry_if_exception(_is_retryable),
+            wait=wait_random_exponential(multiplier=self.min_wait, max=self.max_wait),
+            stop=stop_after_attempt(self.max_retries),
+            before_sleep=self._before_retry,
+            reraise=True,
+        )
+
+    def _reserve(self, prompts, max_tokens):
+        '''Reserves a request and its estimated tokens, returns the estimate and the seconds to wait'''
+
+        tokens = self.estimate_tokens(prompts, max_tokens)
+        delay = 0
+
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.reserve(tokens))
+
+        # ANALYTICS
+        self.stats["requests"] += 1
+        self.stats["wait_seconds"] += delay
+
+        return tokens, delay
+
+    def _done(self, response, start, estimate):
+        '''Records a successful request, and offsets the indices of its choices by the start of its sub-batch'''
+
+        usage = response.get('usage')
+
+        # Settle the estimate with the actual usage, streamed responses do not report it
+        if self.tokens is not None and usage:
+            self.tokens.reserve(usage['total_tokens'] - estimate)
+
+        self._successes += 1
+        if self._successes >= self.increase_every:
+            self.batch_size = min(self.batch_size + 1, self.max_batch_size)
+            self._successes = 0
+
+        choices = []
+        for choice in response['choices']:
+            choice = dict(choice)
+            choice['index'] = choice['index'] + start
+            choices.append(choice)
+
+        return choices
+
+    def _before_retry(self, retry_state):
+        '''Halves the batch size and pauses the buckets when throttled'''
+
+        # ANALYTICS
+        self.stats["retries"] += 1
+
+        if _is_rate_limit(retry_state.outcome.exception()):
+            self.stats["throttled"] += 1
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+            self._successes = 0
+
+            if self.requests is not None:
+                self.requests.drain()
+            if self.tokens is not None:
+                self.tokens.drain()
@@ -1,34 +1,71 @@
-from typing import List, Dict, Tuple
+from typing import Any, List, Dict, Tuple
 import time
 import uuid
 import tqdm
-import numpy as np
 
-from beir.retrieval.evaluation import EvaluateRetrieval
 from beir.retrieval.search.lexical import BM25Search
 from beir.retrieval.search.lexical.elastic_search import ElasticSearch
 
+from cache import RetrievalCache
+from passage_store import PassageStore
+from tracing import NullTracer
+from state import RetrievalResult
+
 class BM25(object):
     '''
     The BM25 retriever instance.
 
     Args:
         index_name (str): The ElasticSearch index for the retriever to retriever from.
+        cache_size (int): The maximum number of retrieval results kept in memory
+        cache_ttl (float): The number of seconds a cached retrieval result stays valid, never expires if None
+        cache_path (str): Path of the persistent retrieval cache, memory only if None
+        search_type (str): The ElasticSearch search type, dfs_query_then_fetch computes global term statistics first
+        passage_store_path (str): Path of a passage store (see setup/build_passage_store.py), ElasticSearch then only returns ids
+        tracer (Tracer): Records the ElasticSearch requests, not recorded if None
+        hostname (str): The ElasticSearch node, e.g. localhost:9200
+        transport_kwargs (Dict[str, Any]): Arguments of the AsyncMultiSearch transport (see es_transport.py), the synchronous client of beir if None
 
     Attributes:
         max_ret_topk (int): The maximum number of documents
+        index_name (str): The ElasticSearch index retrieved from
+        search_type (str): The ElasticSearch search type of the multisearch requests
+        passages (PassageStore): The store the document texts are read from, None if ElasticSearch returns the texts
+        cache (RetrievalCache): The cache of retrieval results, keyed by normalized query, index name and topk
+        tracer (Tracer): The recorder of the ElasticSearch requests
+        transport (AsyncMultiSearch): The pooled asynchronous multisearch transport, None if the client of beir is used
 
     '''
     def __init__(
         self,
         index_name: str = 'wikipedia_dpr',
+        cache_size: int = 100000,
+        cache_ttl: float = None,
+        cache_path: str = None,
+        search_type: str = 'dfs_query_then_fetch',
+        passage_store_path: str = None,
+        tracer=None,
+        hostname: str = 'localhost',
+        transport_kwargs: Dict[str, Any] = None,
     ):
 
         self.max_ret_topk = 1000
-        self.retriever = EvaluateRetrieval(
-            BM25Search(index_name=index_name, hostname='localhost', initialize=False, number_of_shards=1),
-            k_values=[self.max_ret_topk]
-        )
+        self.index_name = index_name
+        self.cache = RetrievalCache(max_entries=cache_size, ttl=cache_ttl, path=cache_path)
+        self.search_type = search_type
+        self.passages = PassageStore(passage_store_path) if passage_store_path else None
+        self.tracer = tracer if tracer is not None else NullTracer()
+
+        # Search with BM25Search directly, EvaluateRetrieval would always ask ElasticSearch for max_ret_topk hits
+        self.retriever = BM25Search(index_name=index_name, hostname=hostname, initialize=False, number_of_shards=1)
+
+        # Pipelined and hedged multisearch requests, imported here as the asynchronous client needs aiohttp
+        self.transport = None
+
+        if transport_kwargs is not None:
+            from es_transport import AsyncMultiSearch
+            self.transport = AsyncMultiSearch(**{"hosts": [hostname], **transport_kwargs})
+            self.retriever.es.transport = self.transport
 
     def _get_random_doc_id(self):
         return f'_{uuid.uuid4()}'
@@ -45,19 +82,60 @@ class BM25(object):
             topk (int): The maximum number of documents to return
 
         Returns:
-            docids (np.array): Shape (bs, topk), the document ids retrieved
-            docs (np.array): Shape (bs, topk), the text of the documents retrieved
+            result (RetrievalResult): The (bs, topk) document ids retrieved, and their texts, lazily read if there is a passage store
         '''
         assert topk <= self.max_ret_topk
-        bs = len(queries)
 
-        # Retrieve, queries should be Dict[str, str]
-        results: Dict[str, Dict[str, Tuple[float, str]]] = self.retriever.retrieve(
-            None, dict(zip(range(len(queries)), queries)), disable_tqdm=True)
+        # Only send the queries missing from the cache to ElasticSearch, results without texts are cached apart
+        namespace = self.index_name if self.passages is None else f"{self.index_name}:ids"
+        keys = [self.cache.key(query, namespace, topk) for query in queries]
+        results = self.cache.get_many(keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        if missing:
+            with self.tracer.span("es_search", queries=len(missing), topk=topk):
+                searched, failed = self._search([queries[i] for i in missing], topk)
+
+            # The dummy results of failed searches are used this time only, so the queries are searched again next time
+            self.cache.put_many([(keys[i], result) for i, result, fail in zip(missing, searched, failed) if not fail])
+
+            for i, result in zip(missing, searched):
+                results[i] = result
+
+        # Prepare outputs, lists of the texts rather than unicode arrays as wide as the longest passage
+        docids = [list(result[0]) for result in results]  # (bs, topk)
+
+        if self.passages is not None:
+            docs = self.passages.lazy(self.passages.rows(docids))  # (bs, topk)
+        else:
+            docs = [list(result[1]) for result in results]  # (bs, topk)
+
+        return RetrievalResult(docids, docs)
+
+    def _search(
+        self,
+        queries: List[str],
+        topk: int,
+    ):
+        '''Searches ElasticSearch for the given queries, padding the results to topk documents
+
+        Args:
+            queries (List[str]): The list of queries to search for
+            topk (int): The maximum number of documents to return
+
+        Returns:
+            results (List[Tuple[List[str], List[str]]]): The document ids and texts retrieved for each query, texts are None with a passage store
+            failed (List[bool]): Whether the search of each query failed, its results then being dummy docs only
+        '''
+
+        # Retrieve only topk hits per query (and only their ids with a passage store), queries should be Dict[str, str]
+        results: Dict[str, Dict[str, Tuple[float, str]]] = self.retriever.search(
+            None, dict(zip(range(len(queries)), queries)), topk, disable_tqdm=True, search_type=self.search_type,
+            source=False if self.passages is not None else None)
 
         # Prepare outputs
-        docids: List[str] = []
-        docs: List[str] = []
+        searched = []
+        failed = []
 
         for qid, query in enumerate(queries):
 
@@ -65,8 +143,11 @@ class BM25(object):
             _docids: List[str] = []
             _docs: List[str] = []
 
+            # Failed searches are marked with None, see bm25search_custom
+            failed.append(qid in results and results[qid] is None)
+
             # If the query yielded results
-            if qid in results:
+            if results.get(qid):
                 for did, (score, text) in results[qid].items():
                     _docids.append(did)
                     _docs.append(text)
@@ -76,14 +157,11 @@ class BM25(object):
             # Add dummy docs to reach topk length
             if len(_docids) < topk:  # add dummy docs
                 _docids += [self._get_random_doc_id() for _ in range(topk - len(_docids))]
-                _docs += [''] * (topk - len(_docs))
+                _docs += [None if self.passages is not None else ''] * (topk - len(_docs))
 
-            docids.extend(_docids)
-            docs.extend(_docs)
+            searched.append((_docids, _docs))
 
-        docids = np.array(docids).reshape(bs, topk)  # (bs, topk)
-        docs = np.array(docs).reshape(bs, topk)  # (bs, topk)
-        return docids, docs
+        return searched, failed
 
 ''' We need to modify the implementation of BM25Search to return the text as well as the scores of the search results'''
 def bm25search_custom(self, corpus: Dict[str, Dict[str, str]], queries: Dict[str, str], top_k: int, *args, **kwargs) -> Dict[str, Dict[str, float]]:
@@ -100,46 +178,65 @@ def bm25search_custom(self, corpus: Dict[str, Dict[str, str]], queries: Dict[str
     queries = [queries[qid] for qid in query_ids]
 
     # ---Custom Code---
-    self.results: Dict[str, Dict[str, Tuple[float, str]]] = {}
+    # Results are kept local (not on self) so that concurrent retrievals from worker threads do not overwrite each other
+    search_results: Dict[str, Dict[str, Tuple[float, str]]] = {}
+
+    # The transport splits the queries into sub-requests sent concurrently, rather than batch after batch
+    batch_size = self.batch_size if getattr(self.es, 'transport', None) is None else max(len(queries), 1)
 
-    for start_idx in tqdm.trange(0, len(queries), self.batch_size, desc='que', disable=kwargs.get('disable_tqdm', False)):
-        query_ids_batch = query_ids[start_idx:start_idx+self.batch_size]
+    for start_idx in tqdm.trange(0, len(queries), batch_size, desc='que', disable=kwargs.get('disable_tqdm', False)):
+        query_ids_batch = query_ids[start_idx:start_idx+batch_size]
         results = self.es.lexical_multisearch(
-            texts=queries[start_idx:start_idx+self.batch_size],
-            top_hits=top_k)
+            texts=queries[start_idx:start_idx+batch_size],
+            top_hits=top_k,
+            search_type=kwargs.get('search_type', 'dfs_query_then_fetch'),
+            source=kwargs.get('source'))
 
         for (query_id, hit) in zip(query_ids_batch, results):
+
+            # The search of this query failed (e.g. a shard failure), which is not the same as no hits
+            if hit['meta']['error'] is not None:
+                search_results[query_id] = None
+                continue
+
             scores = {}
             for corpus_id, score, text in hit['hits']:
                 scores[corpus_id] = (score, text)
-                self.results[query_id] = scores
+                search_results[query_id] = scores
+
+        # Queries left without a response failed as well
+        for query_id in query_ids_batch[len(results):]:
+            search_results[query_id] = None
     # ---End Custom---
 
-    return self.results
+    return search_results
 
 # Modifying BM25Search implementation
 BM25Search.search = bm25search_custom
 
-'''We also need to modify the implementation of ElasticSearch in case there are no hits'''
-def elasticsearch_lexical_multisearch(self, texts: List[str], top_hits: int, skip: int = 0) -> Dict[str, object]:
-    """Multiple Query search in Elasticsearch
+'''We also need to modify the implementation of ElasticSearch in case there are no hits, and to only transfer what is used'''
+def elasticsearch_multisearch_request(self, texts: List[str], top_hits: int, skip: int = 0, search_type: str = "dfs_query_then_fetch", source: object = None) -> List[Dict[str, object]]:
+    """Builds the body of a multiple query search
 
     Args:
         texts (List[str]): Multiple query texts
         top_hits (int): top k hits to be retrieved
         skip (int, optional): top hits to be skipped. Defaults to 0.
+        search_type (str, optional): Elasticsearch search type. Defaults to dfs_query_then_fetch.
+        source (object, optional): The _source filter of the hits. Defaults to the text field only.
 
     Returns:
-        Dict[str, object]: Hit results
+        List[Dict[str, object]]: The alternating header and body lines of the msearch request
     """
     request = []
 
     assert skip + top_hits <= 10000, "Elastic-Search Window too large, Max-Size = 10000"
 
     for text in texts:
-        req_head = {"index" : self.index_name, "search_type": "dfs_query_then_fetch"}
+        req_head = {"index" : self.index_name, "search_type": search_type}
         req_body = {
-            "_source": True, # No need to return source objects
+            "_source": [self.text_key] if source is None else source, # Only the passage text is used
+            "track_total_hits": False, # No need to count every matching document
             "query": {
                 "multi_match": {
                     "query": text, # matching query with both text and title fields
@@ -152,7 +249,35 @@ def elasticsearch_lexical_multisearch(self, texts: List[str], top_hits: int, ski
             }
         request.extend([req_head, req_body])
 
-    res = self.es.msearch(body = request)
+    return request
+
+# Only keep the parts of the msearch response which are read below
+MULTISEARCH_FILTER_PATH = [
+    "responses.took",
+    "responses.error",
+    "responses.hits.hits._id",
+    "responses.hits.hits._score",
+    "responses.hits.hits._source",
+]
+
+def elasticsearch_lexical_multisearch(self, texts: List[str], top_hits: int, skip: int = 0, search_type: str = "dfs_query_then_fetch", source: object = None) -> Dict[str, object]:
+    """Multiple Query search in Elasticsearch
+
+    Args:
+        texts (List[str]): Multiple query texts
+        top_hits (int): top k hits to be retrieved
+        skip (int, optional): top hits to be skipped. Defaults to 0.
+        search_type (str, optional): Elasticsearch search type. Defaults to dfs_query_then_fetch.
+        source (object, optional): The _source filter of the hits, False for ids only. Defaults to the text field only.
+
+    Returns:
+        Dict[str, object]: Hit results, the text is None if the source was not returned
+    """
+    request = self.multisearch_request(texts, top_hits, skip=skip, search_type=search_type, source=source)
+
+    # The pooled transport if the retriever has one (see es_transport.py), or else the client of beir
+    client = getattr(self, 'transport', None) or self.es
+    res = client.msearch(body = request, filter_path = MULTISEARCH_FILTER_PATH)
 
     result = []
     for resp in res["responses"]:
@@ -160,7 +285,7 @@ def elasticsearch_lexical_multisearch(self, texts: List[str], top_hits: int, ski
 
         hits = []
         for hit in responses:
-            hits.append((hit["_id"], hit['_score'], hit['_source']['txt']))
+            hits.append((hit["_id"], hit['_score'], hit['_source'][self.text_key] if '_source' in hit else None))
 
         result.append(self.hit_template(es_res=resp, hits=hits))
     return result
@@ -177,7 +302,8 @@ def elasticsearch_hit_template(self, es_res: Dict[str, object], hits: List[Tuple
     """
     result = {
         'meta': {
-            'total': es_res['hits']['total']['value'] if 'hits' in es_res else None,
+            'error': es_res.get('error'),
+            'total': es_res['hits']['total']['value'] if 'total' in es_res.get('hits', {}) else None,
             'took': es_res['took'] if 'took' in es_res else None,
             'num_hits': len(hits)
         },
@@ -186,5 +312,6 @@ def elasticsearch_hit_template(self, es_res: Dict[str, object], hits: List[Tuple
     return result
 
 # Modifying ElasticSearch implementation
+ElasticSearch.multisearch_request = elasticsearch_multisearch_request
 ElasticSearch.lexical_multisearch = elasticsearch_lexical_multisearch
 ElasticSearch.hit_template = elasticsearch_hit_template
\ No newline at end of file
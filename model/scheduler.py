@@ -0,0 +1,78 @@
+from typing import Any, Iterable, Iterator, Tuple
+import itertools
+
+class ContinuousBatcher(object):
+    '''
+    Continuously batches questions through the FLARE loop of a QueryAgent.
+
+    A fixed pool of question slots is kept active. Every step issues one completion call for all of the slots, and as
+    soon as a question finishes generating (or hits the safeguard) its slot is handed to the next question of the
+    dataset, so no slot waits for the slowest answer of a batch.
+
+    Args:
+        agent (QueryAgent): The agent answering the questions
+        num_slots (int): The number of questions answered at the same time
+        max_iterations (int): The safeguard on the number of FLARE iterations per question
+
+    Attributes:
+        agent (QueryAgent): This stores the agent answering the questions
+        num_slots (int): This stores the number of active question slots
+        max_iterations (int): This stores the safeguard on the number of FLARE iterations per question
+
+    '''
+    def __init__(
+        self,
+        agent: object,
+        num_slots: int = 20,
+        max_iterations: int = 15,
+    ):
+
+        self.agent = agent
+        self.num_slots = num_slots
+        self.max_iterations = max_iterations
+
+    def run(
+        self,
+        questions: Iterable[Tuple[Any, str]],
+    ) -> Iterator[Tuple[Any, str]]:
+        '''Answers the questions, yielding each answer as soon as its question finishes
+
+        Args:
+            questions (Iterable[Tuple[Any, str]]): The (key, question) pairs to answer
+
+        Returns:
+            answers (Iterator[Tuple[Any, str]]): The (key, normalized response) pairs, in order of completion
+        '''
+
+        pending = iter(questions)
+
+        # Active slots
+        keys = []
+        states = []
+        iterations = []
+
+        while(True):
+
+            # Admit new questions into the free slots
+            admitted = list(itertools.islice(pending, self.num_slots - len(keys)))
+            new_keys = [key for key, _ in admitted]
+            new_inputs = [question for _, question in admitted]
+
+            if not keys and not new_keys:
+                break
+
+            new_states, finished = self.agent._step(new_inputs, states)
+
+            # Retire the questions which are done, freeing their slots for the next step
+            for i in reversed(range(len(keys))):
+
+                iterations[i] += 1
+
+                if finished[i] or iterations[i] > self.max_iterations:
+                    yield keys[i], self.agent.normalize([states[i].text])[0]
+
+                    del keys[i], states[i], iterations[i]
+
+            keys += new_keys
+            states += new_states
+            iterations += [0 for _ in new_keys]
@@ -0,0 +1,135 @@
+from typing import Iterator, List, Sequence, Tuple
+import re
+import bisect
+
+# A complete word after a sentence boundary, once seen the sentence tokenizer will not move the boundary
+FOLLOWING_WORD = re.compile(r"\S+\s")
+
+class SentenceSplitter(object):
+    '''
+    Finds the sentence boundaries of completions, with one Punkt sentence tokenizer built on first use (importing
+    nltk is slow, and not needed until the first completion).
+
+    Punkt yields the sentences lazily, so the text is only scanned up to the sentences asked for (e.g. the first one
+    of at least min_sent_len characters) instead of the whole completion. Character breakpoints are mapped to tokens
+    with a binary search over the token offsets, which are sorted. The offsets come as short lists from the API, which
+    bisect searches in place where np.searchsorted would first pay for converting them to an array.
+
+    Args:
+        min_sent_len (int): The minimum number of characters of a first sentence, shorter ones are merged with the next
+        tokenizer (PunktSentenceTokenizer): A pre-built (e.g. trained) Punkt tokenizer, built from train_text if None
+        train_text (str): Text to learn the abbreviations and collocations of Punkt from, untrained if None
+
+    Attributes:
+        tokenizer (PunktSentenceTokenizer): This stores the Punkt sentence tokenizer, built on first use
+
+    '''
+    def __init__(
+        self,
+        min_sent_len: int = 5,
+        tokenizer: object = None,
+        train_text: str = None,
+    ):
+
+        self.min_sent_len = min_sent_len
+
+        self._tokenizer = tokenizer
+        self._train_text = train_text
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from nltk.tokenize.punkt import PunktSentenceTokenizer
+            self._tokenizer = PunktSentenceTokenizer(self._train_text)
+        return self._tokenizer
+
+    def first(self, text: str) -> Tuple[str, int]:
+        '''Extracts the first sentence of a text, of at least min_sent_len characters
+
+        Args:
+            text (str): The string to extract the first sentence from
+
+        Returns:
+            sent (str): The first sentence of the text, without its trailing whitespace
+            break_at (int): The breakpoint of the first sentence
+        '''
+
+        break_at = 0
+
+        # Whitespace at the end of a sentence is usually tokenized into the next token by the OpenAI API
+        for break_at, _ in self.ends(text):
+            if break_at >= self.min_sent_len:
+                break
+
+        return text[:break_at], break_at
+
+    def ends(self, text: str, start_at: int = 0) -> Iterator[Tuple[int, bool]]:
+        '''Generates the ends of the sentences starting at or after a character, without their trailing whitespace
+
+        Args:
+            text (str): The text to split
+            start_at (int): The sentences starting before this character are skipped
+
+        Returns:
+            ends (Iterator[Tuple[int, bool]]): The end of every sentence, and whether it is the last sentence of the text
+        '''
+
+        end_at = None
+
+        for start, end in self.tokenizer.span_tokenize(text):
+
+            if start < start_at:
+                continue
+
+            if end_at is not None:
+                yield end_at, False
+
+            end_at = start + len(text[start:end].rstrip())
+
+        if end_at is not None:
+            yield end_at, True
+
+    def final_ends(self, text: str, ends: List[int]) -> List[int]:
+        '''Extends the final sentence ends of a growing text (e.g. a streamed completion), as first and ends split it
+
+        A boundary is only final once the word after it is complete, as the sentence tokenizer looks at that word to
+        decide whether a period ends a sentence (e.g. an abbreviation). Final boundaries do not move as the text grows,
+        so only the text after the last one is split again, and a whole completion is split in linear time.
+
+        Args:
+            text (str): The text received so far
+            ends (List[int]): The final ends found in the text received before, extended in place
+
+        Returns:
+            ends (List[int]): The final ends, the first one being the end of the first sentence of at least min_sent_len characters
+        '''
+
+        start = ends[-1] if ends else 0
+
+        for end, _ in self.ends(text[start:]):
+            end += start
+
+            # Shorter first sentences are merged with the next, as in first
+            if not ends and end < self.min_sent_len:
+                continue
+
+            if FOLLOWING_WORD.match(text[end:].lstrip()) is None:
+                break
+
+            ends.append(end)
+
+        return ends
+
+    @staticmethod
+    def token_break(text_offset: Sequence[int], break_at: int) -> int:
+        '''Finds the number of tokens starting before a character breakpoint of the completion
+
+        Args:
+            text_offset (Sequence[int]): The character offset of every token, relative to the prompt
+            break_at (int): The breakpoint in the completion
+
+        Returns:
+            trunc_at (int): The breakpoint in the tokens
+        '''
+
+        return bisect.bisect_left(text_offset, text_offset[0] + break_at)
@@ -0,0 +1,168 @@
+from typing import Any, Callable, Dict, Hashable, List, Sequence
+import asyncio
+import threading
+from concurrent.futures import Future
+
+class SingleFlight(object):
+    '''
+    Coalesces identical requests to a backend (the Completion API, the retriever), keyed by whatever makes two requests
+    interchangeable (e.g. the prompt and the sampling parameters).
+
+    A batch first collapses its duplicate keys, so every key is only sent once. A key already in flight, sent by another
+    thread or asyncio task, is not sent again either: the batch waits on the pending result instead. The results are then
+    fanned out to every position of the batch, the same objects shared between the duplicates.
+
+    Requests are only coalesced while they are in flight, finished ones are left to the caches. Like the completion
+    cache, identical requests are taken to have identical results, i.e. duplicate prompts sampled with a temperature
+    above 0 get the same completion.
+
+    Attributes:
+        requested (int): This stores the number of keys asked for
+        coalesced (int): This stores the number of keys which were duplicates within their batch
+        joined (int): This stores the number of keys which waited on the same key in flight from another batch
+
+    '''
+    def __init__(self):
+
+        self.requested = 0
+        self.coalesced = 0
+        self.joined = 0
+
+        self._pending: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def call(
+        self,
+        keys: Sequence[Hashable],
+        fn: Callable[[List[int]], Sequence[Any]],
+    ) -> List[Any]:
+        '''Gets the results of a batch of keys, sending only the keys no one else is already waiting for
+
+        Args:
+            keys (Sequence[Hashable]): The key of every request of the batch
+            fn (Callable[[List[int]], Sequence[Any]]): Sends the requests at the given indices of the batch, returning their results in order
+
+        Returns:
+            results (List[Any]): The result of every request of the batch
+        '''
+
+        lead, futures = self._claim(keys)
+
+        if lead:
+            try:
+                results = fn(lead)
+            except BaseException as exception:
+                self._resolve(keys, lead, futures, exception=exception)
+                raise
+
+            self._resolve(keys, lead, futures, results=results)
+
+        return [futures[key].result() for key in keys]
+
+    async def acall(
+        self,
+        keys: Sequence[Hashable],
+        fn: Callable[[List[int]], Any],
+    ) -> List[Any]:
+        '''Asynchronous version of call
+
+        Args:
+            keys (Sequence[Hashable]): The key of every request of the batch
+            fn (Callable[[List[int]], Awaitable[Sequence[Any]]]): Sends the requests at the given indices of the batch, returning their results in order
+
+        Returns:
+            results (List[Any]): The result of every request of the batch
+        '''
+
+        lead, futures = self._claim(keys)
+
+        if lead:
+            try:
+                results = await fn(lead)
+            except BaseException as exception:
+                self._resolve(keys, lead, futures, exception=exception)
+                raise
+
+            self._resolve(keys, lead, futures, results=results)
+
+        # Shielded, so a cancelled waiter does not cancel the result shared with the other waiters
+        for future in set(futures.values()):
+            if not future.done():
+                await asyncio.shield(asyncio.wrap_future(future))
+
+        return [futures[key].result() for key in keys]
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        '''The number of keys asked for, coalesced within a batch and joined in flight, and the ratio of keys not sent'''
+
+        deduplicated = self.coalesced + self.joined
+
+        return {
+            "requested": self.requested,
+            "coalesced": self.coalesced,
+            "joined": self.joined,
+            "dedup_ratio": deduplicated / self.requested if self.requested else 0.0,
+        }
+
+    def _claim(self, keys):
+        '''Finds the pending result of every key, taking the lead for the keys not in flight yet
+
+        Args:
+            keys (Sequence[Hashable]): The key of every request of the batch
+
+        Returns:
+            lead (List[int]): The index of the first occurrence of the keys this batch has to send
+            futures (Dict[Hashable, Future]): The pending result of every key
+        '''
+
+        lead = []
+        futures = {}
+
+        with self._lock:
+
+            for i, key in enumerate(keys):
+
+                if key in futures:
+                    self.coalesced += 1
+                    continue
+
+                future = self._pending.get(key)
+
+                if future is None:
+                    future = self._pending[key] = Future()
+                    lead.append(i)
+                else:
+                    self.joined += 1
+
+                futures[key] = future
+
+            self.requested += len(keys)
+
+        return lead, futures
+
+    def _resolve(self, keys, lead, futures, results=None, exception=None):
+        '''Publishes the results (or the failure) of the keys this batch sent, to every batch waiting on them
+
+        Args:
+            keys (Sequence[Hashable]): The key of every request of the batch
+            lead (List[int]): The indices of the keys sent by this batch
+            futures (Dict[Hashable, Future]): The pending result of every key
+            results (Sequence[Any]): The results of the keys sent, in order
+            exception (BaseException): The failure of the request, if it failed
+
+        Returns:
+            None
+        '''
+
+        with self._lock:
+            for i in lead:
+                del self._pending[keys[i]]
+
+        for n, i in enumerate(lead):
+            future = futures[keys[i]]
+
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(results[n])
@@ -0,0 +1,67 @@
+from typing import List, NamedTuple, Sequence, Set
+
+class GenerationState(object):
+    '''
+    The response generated thus far to one question of the FLARE loop.
+
+    The sentences are appended to a list and only joined when the text is read, the joined text being kept for the
+    next read. Growing a response thus copies this response alone, where a NumPy unicode array of the batch would be
+    copied whole, at the width of its longest response, at every iteration.
+
+    Args:
+        question (str): The user input question
+
+    Attributes:
+        question (str): This stores the user input question
+        sentences (List[str]): This stores the sentences generated thus far, in order
+        passages (Set[int]): This stores the fingerprints of the passages shown to the LM thus far, see ContextPacker
+
+    '''
+    __slots__ = ("question", "sentences", "passages", "_text", "_num_joined")
+
+    def __init__(
+        self,
+        question: str,
+    ):
+
+        self.question = question
+        self.sentences: List[str] = []
+        self.passages: Set[int] = set()
+
+        self._text = ""
+        self._num_joined = 0
+
+    def append(self, sentence: str):
+        '''Appends the next sentence of the response
+
+        Args:
+            sentence (str): The sentence, empty sentences are skipped
+
+        Returns:
+            None
+        '''
+
+        if sentence:
+            self.sentences.append(sentence)
+
+    @property
+    def text(self) -> str:
+        '''The response generated thus far'''
+
+        if self._num_joined < len(self.sentences):
+            self._text += "".join(self.sentences[self._num_joined:])
+            self._num_joined = len(self.sentences)
+
+        return self._text
+
+class RetrievalResult(NamedTuple):
+    '''
+    The documents retrieved for a batch of queries, which unpacks as (docids, docs).
+
+    Attributes:
+        docids (List[List[str]]): The ids of the topk documents of every query
+        docs (Sequence[Sequence[str]]): The texts of the topk documents of every query, a LazyPassages if they are read from a passage store
+
+    '''
+    docids: List[List[str]]
+    docs: Sequence[Sequence[str]]
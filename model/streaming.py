@@ -0,0 +1,95 @@
+from typing import Any, Callable, Dict
+
+class StreamedCompletion(object):
+    '''
+    Assembles the chunks of a streamed (multi-prompt) completion into the choices of a regular Completion API response.
+
+    Every chunk carries the next text and logprobs of some of the choices. A choice stops growing once it finishes or
+    once is_complete says its text holds everything needed, and the stream can be closed as soon as every choice has
+    stopped. Choices cut this way get the finish_reason 'length', as their text ends before the model stopped.
+
+    Args:
+        num_choices (int): The number of prompts of the request
+        is_complete (Callable[[int, str], bool]): Whether the text received for a choice is enough to stop it
+
+    Attributes:
+        done (List[bool]): Whether each choice stopped growing
+        cut (List[bool]): Whether each choice was stopped before the model finished it
+        num_tokens (int): The number of tokens received
+
+    '''
+    def __init__(
+        self,
+        num_choices: int,
+        is_complete: Callable[[int, str], bool],
+    ):
+
+        self.is_complete = is_complete
+
+        self._texts = [[] for _ in range(num_choices)]
+        self._tokens = [[] for _ in range(num_choices)]
+        self._token_logprobs = [[] for _ in range(num_choices)]
+        self._text_offset = [[] for _ in range(num_choices)]
+        self._finish_reason = [None for _ in range(num_choices)]
+
+        self.done = [False for _ in range(num_choices)]
+        self.cut = [False for _ in range(num_choices)]
+        self.num_tokens = 0
+
+    def add(self, chunk: Dict[str, Any]) -> bool:
+        '''Adds a chunk of the stream
+
+        Args:
+            chunk (Dict[str, Any]): A streamed response, holding the next text and logprobs of some choices
+
+        Returns:
+            done (bool): Whether every choice stopped, i.e. the stream can be closed
+        '''
+
+        for choice in chunk['choices']:
+
+            i = choice['index']
+
+            if self.done[i]:
+                continue
+
+            logprobs = choice.get('logprobs') or {}
+
+            self._texts[i].append(choice['text'])
+            self._tokens[i].extend(logprobs.get('tokens', []))
+            self._token_logprobs[i].extend(logprobs.get('token_logprobs', []))
+            self._text_offset[i].extend(logprobs.get('text_offset', []))
+            self.num_tokens += len(logprobs.get('tokens', []))
+
+            if choice.get('finish_reason') is not None:
+                self._finish_reason[i] = choice['finish_reason']
+                self.done[i] = True
+            elif self.is_complete(i, "".join(self._texts[i])):
+                self._finish_reason[i] = 'length'
+                self.done[i] = True
+                self.cut[i] = True
+
+        return all(self.done)
+
+    def response(self) -> Dict[str, Any]:
+        '''Builds the response the chunks add up to
+
+        Returns:
+            response (Dict[str, Any]): The response, shaped like a Completion API response without streaming
+        '''
+
+        choices = []
+
+        for i in range(len(self._texts)):
+            choices.append({
+                'index': i,
+                'text': "".join(self._texts[i]),
+                'logprobs': {
+                    'tokens': self._tokens[i],
+                    'token_logprobs': self._token_logprobs[i],
+                    'text_offset': self._text_offset[i],
+                },
+                'finish_reason': self._finish_reason[i] or 'length',
+            })
+
+        return {'choices': choices}
@@ -0,0 +1,202 @@
+from typing import Any, Dict, List
+import os
+import json
+import time
+import asyncio
+import threading
+import numpy as np
+
+class Span(object):
+    '''
+    A timed stage of the FLARE loop, used as a context manager. Attributes (batch sizes, token counts, ...) can be set
+    while the span is open with span["key"] = value. Attributes which are costly to compute should be set under
+    if tracer.enabled, as NullTracer drops them anyway.
+
+    Args:
+        tracer (Tracer): The tracer recording the span
+        name (str): The name of the stage
+        attrs (Dict[str, Any]): The attributes of the span
+
+    '''
+    __slots__ = ("tracer", "name", "attrs", "start", "track")
+
+    def __init__(
+        self,
+        tracer: 'Tracer',
+        name: str,
+        attrs: Dict[str, Any],
+    ):
+
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __setitem__(self, key, value):
+        self.attrs[key] = value
+
+    def __enter__(self):
+        self.track = _track()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer._record(self, time.perf_counter_ns())
+        return False
+
+class Tracer(object):
+    '''
+    Records the spans of the FLARE loop, to tell where the time of a run goes (LM, retrieval, sentence tokenization,
+    prompt building, ...).
+
+    Spans can be exported as JSONL, one span per line, and as a Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    where every thread, or asyncio task, is a track.
+
+    Attributes:
+        spans (List[Dict[str, Any]]): This stores the recorded spans, with their start and duration in microseconds
+
+    '''
+    enabled = True
+
+    def __init__(self):
+
+        self.spans: List[Dict[str, Any]] = []
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **attrs) -> Span:
+        '''Opens a span
+
+        Args:
+            name (str): The name of the stage
+            attrs: The attributes of the span
+
+        Returns:
+            span (Span): The span, to use in a with statement
+        '''
+
+        return Span(self, name, attrs)
+
+    def _record(self, span, end):
+
+        record = {
+            "name": span.name,
+            "start_us": (span.start - self._origin) / 1000,
+            "duration_us": (end - span.start) / 1000,
+            "track": span.track,
+            **span.attrs,
+        }
+
+        with self._lock:
+            self.spans.append(record)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        '''Summarizes the durations of every stage
+
+        Returns:
+            summary (Dict[str, Dict[str, float]]): The count, total, mean, p50 and p95 milliseconds of every stage
+        '''
+
+        durations = {}
+
+        for span in self.spans:
+            durations.setdefault(span["name"], []).append(span["duration_us"] / 1000)
+
+        return {
+            name: {
+                "count": len(ms),
+                "total_ms": float(np.sum(ms)),
+                "mean_ms": float(np.mean(ms)),
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+            }
+            for name, ms in durations.items()
+        }
+
+    def save_jsonl(self, path: str):
+        '''Writes the spans, one json object per line
+
+        Args:
+            path (str): The path of the .jsonl file
+
+        Returns:
+            None
+        '''
+
+        with open(path, 'w') as f:
+            for span in self.spans:
+                f.write(json.dumps(span) + "\n")
+
+    def save_chrome_trace(self, path: str):
+        '''Writes the spans in the Chrome trace event format
+
+        Args:
+            path (str): The path of the .json file
+
+        Returns:
+            None
+        '''
+
+        tracks = {}
+        events = []
+
+        for span in self.spans:
+            tid = tracks.setdefault(span["track"], len(tracks))
+            args = {key: value for key, value in span.items() if key not in ("name", "start_us", "duration_us", "track")}
+            events.append({
+                "name": span["name"],
+                "cat": "flare",
+                "ph": "X",
+                "ts": span["start_us"],
+                "dur": span["duration_us"],
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            })
+
+        for track, tid in tracks.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": track}})
+
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+class _NullSpan(object):
+    '''A span which does nothing, shared by every call of NullTracer.span'''
+
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class NullTracer(object):
+    '''
+    The tracer used when tracing is off, opening a span only costs a method call.
+    '''
+    enabled = False
+    spans = []
+
+    def span(self, name: str, **attrs) -> _NullSpan:
+        return _NULL_SPAN
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+def _track() -> str:
+    '''The track of the current span, the asyncio task if any or else the thread'''
+
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+
+    if task is not None:
+        return task.get_name()
+
+    return threading.current_thread().name
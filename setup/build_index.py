@@ -1,18 +1,19 @@
+import os
+import io
+import json
 import argparse
 import time
 import csv
 from tqdm import tqdm
+from multiprocessing import Pool
+from elasticsearch.helpers import streaming_bulk
 from beir.retrieval.search.lexical.elastic_search import ElasticSearch
 
-def build_elasticsearch(
-    beir_corpus_file_pattern: str,
-    index_name: str,
-):
+def make_config(index_name: str, hostname: str = 'localhost'):
+    '''The beir ElasticSearch configuration of the index'''
 
-    print(f'Building index for {beir_corpus_file_pattern}')
-    
-    config = {
-        'hostname': 'localhost',
+    return {
+        'hostname': hostname,
         'index_name': index_name,
         'keys': {'title': 'title', 'body': 'txt'},
         'timeout': 100,
@@ -21,41 +22,180 @@ def build_elasticsearch(
         'number_of_shards': 'default',
         'language': 'english',
     }
+
+def split_chunks(corpus_path: str, chunk_bytes: int):
+    '''Splits the corpus .tsv into byte ranges ending on line boundaries
+
+    The ranges are cut at newlines without parsing the quotes, so this assumes one record per line, i.e. no record
+    holds a newline inside a quoted field (true of the DPR psgs_w100.tsv). index_chunk checks every record of a range
+    has its 3 fields, and fails on a range cut inside a record.
+
+    Args:
+        corpus_path (str): Path to the corpus .tsv (id, text, title)
+        chunk_bytes (int): The approximate size of a chunk
+
+    Returns:
+        chunks (List[Tuple[int, int]]): The (start, end) byte offsets of every chunk, the header excluded
+    '''
+
+    size = os.path.getsize(corpus_path)
+    chunks = []
+
+    with open(corpus_path, 'rb') as f:
+
+        f.readline() # skip header
+        start = f.tell()
+
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline() # move to the end of the line
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+
+    return chunks
+
+def index_chunk(job):
+    '''Parses one byte range of the corpus and bulk indexes it, runs in a worker process
+
+    Args:
+        job (Tuple[str, Dict, int, int, int]): The corpus path, the ElasticSearch config, the byte range and the bulk size
+
+    Returns:
+        stats (Tuple[int, int, float, float]): The chunk start, the number of docs, and the parse and index seconds
+    '''
+
+    corpus_path, config, start, end, bulk_size = job
+
+    # Parse
+    parse_start = time.time()
+
+    with open(corpus_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+
+    actions = []
+
+    for row in csv.reader(io.StringIO(data), delimiter='\t'):
+
+        # A range cut inside a record (a quoted newline) leaves a broken row, see split_chunks
+        if len(row) != 3:
+            raise ValueError(f'Malformed record in the corpus chunk at byte {start}, expected one (id, text, title) record per line: {row[:3]}')
+
+        _id, text, title = row[0], row[1], row[2]
+        actions.append({
+            '_id': _id,
+            '_op_type': 'index',
+            config['keys']['title']: title,
+            config['keys']['body']: text,
+        })
+
+    parse_time = time.time() - parse_start
+
+    # Index, re-indexing a doc with the same _id overwrites it so an interrupted chunk can simply be redone
+    index_start = time.time()
     es = ElasticSearch(config)
 
-    # Create index (from BM25Search class)
-    print(f'Creating index {index_name}')
-    es.delete_index()
-    time.sleep(5)
-    es.create_index()
+    for ok, info in streaming_bulk(client=es.es, index=config['index_name'], actions=actions, chunk_size=bulk_size, max_retries=5):
+        pass
 
-    # Generator ( customized ElasticSearch.generate_actions() )
-    def generate_actions():
+    index_time = time.time() - index_start
 
-        with open(beir_corpus_file_pattern, 'r') as f:
+    return start, len(actions), parse_time, index_time
 
-            reader = csv.reader(f, delimiter='\t')
-            header = next(reader) # skip header
+def save_checkpoint(path, checkpoint):
+    '''Atomically writes the checkpoint'''
 
-            for row in reader:
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
 
-                _id, text, title = row[0], row[1], row[2]
-                es_doc = {
-                    '_id': _id,
-                    '_op_type': 'index',
-                    'refresh': 'wait_for',
-                    config['keys']['title']: title,
-                    config['keys']['body']: text,
-                }
+    os.replace(path + '.tmp', path)
 
-                yield es_doc
+def build_elasticsearch(
+    beir_corpus_file_pattern: str,
+    index_name: str,
+    num_workers: int = os.cpu_count(),
+    chunk_bytes: int = 64 * 2**20,
+    bulk_size: int = 2000,
+    resume: bool = False,
+):
+
+    print(f'Building index for {beir_corpus_file_pattern}')
+
+    config = make_config(index_name)
+    es = ElasticSearch(config)
+
+    # Completed chunks are checkpointed by byte offset next to the corpus
+    checkpoint_path = f'{beir_corpus_file_pattern}.{index_name}.checkpoint.json'
+
+    # Never recreate (delete) the index a resume was asked for
+    if resume and not os.path.exists(checkpoint_path):
+        raise FileNotFoundError(f'Cannot resume index {index_name}, no checkpoint at {checkpoint_path}. Check --datapath and --name, or drop --resume to rebuild the index from scratch')
+
+    if resume:
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        print(f'Resuming index {index_name}, {len(checkpoint["done"])} chunks already indexed')
+    else:
+        # Create index (from BM25Search class)
+        print(f'Creating index {index_name}')
+        es.delete_index()
+        time.sleep(5)
+        es.create_index()
+
+        settings = es.es.indices.get_settings(index=index_name)[index_name]['settings']['index']
+        checkpoint = {
+            'chunk_bytes': chunk_bytes,
+            'done': [],
+            # Settings to restore once loaded
+            'refresh_interval': settings.get('refresh_interval', '1s'),
+            'number_of_replicas': settings.get('number_of_replicas', '1'),
+        }
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    # No refreshes nor replicas while loading
+    es.es.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+
+    chunks = split_chunks(beir_corpus_file_pattern, checkpoint['chunk_bytes'])
+    done = set(checkpoint['done'])
+    jobs = [(beir_corpus_file_pattern, config, start, end, bulk_size) for start, end in chunks if start not in done]
+    print(f'Indexing {len(jobs)} / {len(chunks)} chunks with {num_workers} workers')
 
     # Index
     progress = tqdm(unit='docs')
+    num_docs = 0
+    parse_time = 0
+    index_time = 0
+    wall_start = time.time()
+
+    with Pool(num_workers) as pool:
+
+        for start, chunk_docs, chunk_parse_time, chunk_index_time in pool.imap_unordered(index_chunk, jobs):
+
+            checkpoint['done'].append(start)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            num_docs += chunk_docs
+            parse_time += chunk_parse_time
+            index_time += chunk_index_time
+            progress.update(chunk_docs)
+
+    progress.close()
+    wall_time = time.time() - wall_start
+
+    # Restore the settings, and make the documents searchable
+    es.es.indices.put_settings(index=index_name, body={'index': {
+        'refresh_interval': checkpoint['refresh_interval'],
+        'number_of_replicas': checkpoint['number_of_replicas'],
+    }})
+    es.es.indices.refresh(index=index_name)
+
+    os.remove(checkpoint_path)
 
-    es.bulk_add_to_index(
-        generate_actions=generate_actions(),
-        progress=progress)
+    # Per-stage throughput, each worker parses then indexes its chunk
+    print(f'Indexed {num_docs} docs in {wall_time:.0f}s ({num_docs / max(wall_time, 1e-9):.0f} docs/s overall)')
+    print(f'Parse: {num_docs / max(parse_time, 1e-9):.0f} docs/s per worker, {num_workers * num_docs / max(parse_time, 1e-9):.0f} docs/s total')
+    print(f'Index: {num_docs / max(index_time, 1e-9):.0f} docs/s per worker, {num_workers * num_docs / max(index_time, 1e-9):.0f} docs/s total')
 
 if __name__ == '__main__':
     # Need to know path to wikipedia data .tsv file
@@ -63,6 +203,10 @@ if __name__ == '__main__':
 
     parser.add_argument('--datapath', type=str, default=None, required=True, help='Path to corpus data')
     parser.add_argument('--name', type=str, default="wikipedia_dpr",  help='Name of the ElasticSearch index')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of parsing and bulk indexing processes')
+    parser.add_argument('--chunk_mb', type=int, default=64, help='Size of the corpus chunks handed to the workers, in MB')
+    parser.add_argument('--bulk_size', type=int, default=2000, help='Number of docs per bulk request')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted build from its checkpoint instead of recreating the index')
 
     args = parser.parse_args()
 
@@ -70,4 +214,11 @@ if __name__ == '__main__':
     beir_corpus_file_pattern = args.datapath
     index_name = args.name
 
-    build_elasticsearch(beir_corpus_file_pattern, index_name=index_name)
+    build_elasticsearch(
+        beir_corpus_file_pattern,
+        index_name=index_name,
+        num_workers=args.num_workers,
+        chunk_bytes=args.chunk_mb * 2**20,
+        bulk_size=args.bulk_size,
+        resume=args.resume,
+    )
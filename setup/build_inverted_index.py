@@ -0,0 +1,218 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+
+from tqdm import tqdm
+from collections import Counter
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from inverted_index import analyze, encode_varints
+from passage_store import PassageStoreWriter
+
+FIELDS = ['title', 'txt']
+
+def analyze_row(row):
+    '''Analyzes the fields of a corpus row into term counts
+
+    Args:
+        row (Tuple[str, str, str]): The id, text and title of a passage
+
+    Returns:
+        counts (Tuple[Counter, Counter]): The term counts of the title and the text
+    '''
+
+    _id, text, title = row
+
+    return Counter(analyze(title)), Counter(analyze(text))
+
+def read_chunks(corpus_path, chunk_size):
+    '''Reads the corpus .tsv in chunks of rows
+
+    Args:
+        corpus_path (str): Path to the corpus .tsv (id, text, title)
+        chunk_size (int): The number of rows per chunk
+
+    Returns:
+        chunks (Iterator[List[Tuple[str, str, str]]]): The chunks of rows
+    '''
+
+    with open(corpus_path, 'r') as f:
+
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader) # skip header
+
+        chunk = []
+
+        for row in reader:
+            chunk.append((row[0], row[1], row[2]))
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+def build_inverted_index(
+    corpus_path: str,
+    index_path: str,
+    chunk_size: int = 500000,
+    num_workers: int = os.cpu_count(),
+    num_buckets: int = 64,
+    k1: float = 1.2,
+    b: float = 0.75,
+):
+
+    print(f'Building inverted index for {corpus_path} in {index_path}')
+
+    tmp_path = os.path.join(index_path, 'tmp')
+    os.makedirs(tmp_path, exist_ok=True)
+
+    vocab = dict()
+    passages = PassageStoreWriter(index_path)
+    num_chunks = 0
+    num_docs = 0
+    nnz = {field: 0 for field in FIELDS}
+
+    # 1. Analyze the corpus chunk by chunk, writing each chunk's (term, doc, tf) postings sorted by term
+    build_start = time.time()
+    progress = tqdm(unit='docs', desc='analyze')
+
+    with Pool(num_workers) as pool:
+
+        for chunk in read_chunks(corpus_path, chunk_size):
+
+            analyzed = pool.map(analyze_row, chunk, chunksize=1000)
+
+            for field_idx, field in enumerate(FIELDS):
+
+                terms = []
+                docs = []
+                tfs = []
+                lengths = np.zeros(len(chunk), dtype=np.int32)
+
+                for row, counts in enumerate(analyzed):
+                    counts = counts[field_idx]
+                    lengths[row] = sum(counts.values())
+
+                    for term, tf in counts.items():
+                        terms.append(vocab.setdefault(term, len(vocab)))
+                        docs.append(num_docs + row)
+                        tfs.append(tf)
+
+                terms = np.array(terms, dtype=np.int32)
+                order = np.argsort(terms, kind='stable')
+
+                np.save(os.path.join(tmp_path, f'{field}.{num_chunks}.terms.npy'), terms[order])
+                np.save(os.path.join(tmp_path, f'{field}.{num_chunks}.docs.npy'), np.array(docs, dtype=np.int32)[order])
+                np.save(os.path.join(tmp_path, f'{field}.{num_chunks}.tfs.npy'), np.array(tfs, dtype=np.uint16)[order])
+                np.save(os.path.join(tmp_path, f'{field}.{num_chunks}.lengths.npy'), lengths)
+
+                nnz[field] += len(terms)
+
+            for _id, text, title in chunk:
+                passages.add(_id, text)
+
+            num_docs += len(chunk)
+            num_chunks += 1
+            progress.update(len(chunk))
+
+    progress.close()
+    passages.close()
+    print(f'Analyzed {num_docs} docs in {time.time() - build_start:.0f}s, vocabulary of {len(vocab)} terms')
+
+    with open(os.path.join(index_path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+
+    num_terms = len(vocab)
+    del vocab
+
+    # 2. Merge the chunks term-major, a bucket of term ids at a time to bound memory
+    meta = {'fields': FIELDS, 'num_docs': num_docs, 'postings': 'delta-varint', 'k1': k1, 'b': b, 'doc_count': {}, 'avgdl': {}}
+
+    for field in FIELDS:
+
+        lengths = np.concatenate([np.load(os.path.join(tmp_path, f'{field}.{c}.lengths.npy')) for c in range(num_chunks)])
+        doc_count = int(np.count_nonzero(lengths))
+        avgdl = float(lengths.sum() / max(doc_count, 1))
+        meta['doc_count'][field] = doc_count
+        meta['avgdl'][field] = avgdl
+
+        # Lucene's BM25 length normalization of every document
+        norms = (k1 * (1 - b + b * lengths / avgdl)).astype(np.float32)
+
+        chunk_terms = [np.load(os.path.join(tmp_path, f'{field}.{c}.terms.npy'), mmap_mode='r') for c in range(num_chunks)]
+        chunk_docs = [np.load(os.path.join(tmp_path, f'{field}.{c}.docs.npy'), mmap_mode='r') for c in range(num_chunks)]
+        chunk_tfs = [np.load(os.path.join(tmp_path, f'{field}.{c}.tfs.npy'), mmap_mode='r') for c in range(num_chunks)]
+
+        # The documents of every posting list as the varints of their gaps, whose total size is only known once written
+        out_docs = open(os.path.join(index_path, f'{field}.docs.bin'), 'wb')
+        out_impacts = np.lib.format.open_memmap(os.path.join(index_path, f'{field}.impacts.npy'), mode='w+', dtype=np.float16, shape=(nnz[field],))
+        df = np.zeros(num_terms, dtype=np.int64)
+        doc_bytes = np.zeros(num_terms, dtype=np.int64)
+        written = 0
+
+        bounds = np.linspace(0, num_terms, num_buckets + 1).astype(np.int64)
+
+        for lo, hi in tqdm(list(zip(bounds[:-1], bounds[1:])), desc=f'merge {field}'):
+
+            terms, docs, tfs = [], [], []
+
+            # Chunks are in document order, so a stable sort by term keeps every posting list sorted by document
+            for c in range(num_chunks):
+                start, end = np.searchsorted(chunk_terms[c], [lo, hi])
+                terms.append(chunk_terms[c][start:end])
+                docs.append(chunk_docs[c][start:end])
+                tfs.append(chunk_tfs[c][start:end])
+
+            terms = np.concatenate(terms)
+            order = np.argsort(terms, kind='stable')
+            terms = terms[order]
+            docs = np.concatenate(docs)[order]
+            tfs = np.concatenate(tfs)[order].astype(np.float32)
+
+            # The first posting of a term keeps its document, the others the gap to the previous one
+            gaps = docs.astype(np.int64)
+            same_term = terms[1:] == terms[:-1]
+            gaps[1:][same_term] -= docs[:-1][same_term]
+
+            data, num_bytes = encode_varints(gaps)
+            out_docs.write(data.tobytes())
+
+            out_impacts[written:written+len(docs)] = tfs / (tfs + norms[docs])
+            df[lo:hi] = np.bincount(terms - lo, minlength=hi - lo)
+            doc_bytes[lo:hi] = np.bincount(terms - lo, weights=num_bytes, minlength=hi - lo).astype(np.int64)
+            written += len(docs)
+
+        out_docs.close()
+        out_impacts.flush()
+        del out_docs, out_impacts, chunk_terms, chunk_docs, chunk_tfs
+
+        np.save(os.path.join(index_path, f'{field}.indptr.npy'), np.concatenate([[0], np.cumsum(df)]).astype(np.int64))
+        np.save(os.path.join(index_path, f'{field}.docptr.npy'), np.concatenate([[0], np.cumsum(doc_bytes)]).astype(np.int64))
+
+    with open(os.path.join(index_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    shutil.rmtree(tmp_path)
+    print(f'Built inverted index of {num_docs} docs in {time.time() - build_start:.0f}s')
+
+if __name__ == '__main__':
+    # Need to know path to wikipedia data .tsv file
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--datapath', type=str, default=None, required=True, help='Path to corpus data')
+    parser.add_argument('--index_path', type=str, default="dataset/dpr/inverted_index", help='Directory to write the inverted index to')
+    parser.add_argument('--chunk_size', type=int, default=500000, help='Number of passages analyzed per chunk')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of analyzer processes')
+
+    args = parser.parse_args()
+
+    build_inverted_index(args.datapath, args.index_path, chunk_size=args.chunk_size, num_workers=args.num_workers)
@@ -0,0 +1,48 @@
+import os
+import sys
+import csv
+import time
+import argparse
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
+
+from passage_store import PassageStoreWriter
+
+def build_passage_store(
+    corpus_path: str,
+    store_path: str,
+):
+
+    print(f'Building passage store for {corpus_path} in {store_path}')
+
+    start = time.time()
+    writer = PassageStoreWriter(store_path)
+    progress = tqdm(unit='docs')
+
+    with open(corpus_path, 'r') as f:
+
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader) # skip header
+
+        for row in reader:
+
+            _id, text = row[0], row[1]
+            writer.add(_id, text)
+            progress.update(1)
+
+    writer.close()
+    progress.close()
+
+    print(f'Built passage store of {progress.n} docs in {time.time() - start:.0f}s')
+
+if __name__ == '__main__':
+    # Need to know path to wikipedia data .tsv file
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--datapath', type=str, default=None, required=True, help='Path to corpus data')
+    parser.add_argument('--path', type=str, default="dataset/dpr/passages", help='Directory to write the passage store to')
+
+    args = parser.parse_args()
+
+    build_passage_store(args.datapath, args.path)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of model/ import each other by their flat names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model'))
@@ -0,0 +1,124 @@
+import asyncio
+
+from openai_api import QueryAgent
+from scheduler import ContinuousBatcher
+from mock_server import MockLM, MockCompletion
+from state import RetrievalResult
+
+QUESTIONS = [f"Who played character {i} in the film?" for i in range(8)]
+
+class FakeRetriever(object):
+    '''Returns made up passages depending on the query only'''
+
+    def retrieve(self, queries, topk=1):
+        docids = [[f"{abs(hash(query)) % 1000}-{j}" for j in range(topk)] for query in queries]
+        docs = [[f"Passage {j} about {query}" for j in range(topk)] for query in queries]
+        return RetrievalResult(docids, docs)
+
+def make_agent(mode):
+    return QueryAgent(
+        model="mock",
+        api_key="mock",
+        lm=MockCompletion(MockLM(seed=0, prob_alpha=2, prob_beta=1)),
+        retriever=FakeRetriever(),
+        retrieval_kwargs={"topk_retriever": 2, "look_ahead_filter_prob": 0.8, "look_ahead_mask_prob": 0.4, "mode": mode},
+    )
+
+def analytics(qa):
+    return qa._total_api_calls, qa._total_retrieval_calls, dict(qa._low_probability_tokens), dict(qa._masked_tokens)
+
+def test_respond_and_continuous_batching_count_alike():
+
+    for mode in ("implicit", "explicit"):
+
+        batched = make_agent(mode)
+        responses = batched.respond(QUESTIONS)
+
+        continuous = make_agent(mode)
+        answers = dict(ContinuousBatcher(continuous, num_slots=len(QUESTIONS)).run(enumerate(QUESTIONS)))
+
+        assert [answers[i] for i in range(len(QUESTIONS))] == responses
+        assert analytics(continuous) == analytics(batched)
+
+def test_continuous_batching_counts_alike_with_fewer_slots():
+
+    batched = make_agent("implicit")
+    batched.respond(QUESTIONS)
+
+    continuous = make_agent("implicit")
+    list(ContinuousBatcher(continuous, num_slots=3).run(enumerate(QUESTIONS)))
+
+    assert analytics(continuous) == analytics(batched)
+
+def test_arespond_counts_alike():
+
+    batched = make_agent("implicit")
+    responses = batched.respond(QUESTIONS)
+
+    concurrent = make_agent("implicit")
+    assert asyncio.run(concurrent.arespond(QUESTIONS)) == responses
+    assert analytics(concurrent) == analytics(batched)
+
+def test_analytics_checkpoint_resumes_the_counts(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    qa = make_agent("implicit")
+    qa.respond(QUESTIONS[:4])
+    qa._save_analytics("/analytics.json", answered=4)
+
+    resumed = make_agent("implicit")
+    assert resumed._load_analytics("/analytics.json") == 4
+    assert analytics(resumed) == analytics(qa)
+
+    # The rest of the questions, counted on top of the checkpoint
+    resumed.respond(QUESTIONS[4:])
+    qa.respond(QUESTIONS[4:])
+    assert analytics(resumed) == analytics(qa)
+
+    # Checkpoints saved before the answers were counted
+    qa._save_analytics("/analytics.json")
+    assert make_agent("implicit")._load_analytics("/analytics.json") is None
+
+class CountingCompletion(MockCompletion):
+    '''Records the largest number of requests in flight at once'''
+
+    def __init__(self, lm):
+        super().__init__(lm)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def acreate(self, stream=False, **params):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().acreate(stream=stream, **params)
+        finally:
+            self.in_flight -= 1
+
+def test_concurrent_arespond_calls_share_max_concurrency():
+
+    lm = CountingCompletion(MockLM(seed=0, prob_alpha=2, prob_beta=1, latency=0.01))
+    qa = QueryAgent(
+        model="mock",
+        api_key="mock",
+        lm=lm,
+        retriever=FakeRetriever(),
+        retrieval_kwargs={"topk_retriever": 2, "look_ahead_filter_prob": 0.8, "look_ahead_mask_prob": 0.4, "mode": "implicit"},
+        max_concurrency=2,
+    )
+
+    async def answer_later(questions):
+        await asyncio.sleep(0.005)
+        return await qa.arespond(questions)
+
+    # The second call starts while the requests of the first are in flight
+    async def answer_twice():
+        return await asyncio.gather(qa.arespond(QUESTIONS[:4]), answer_later(QUESTIONS[4:]))
+
+    asyncio.run(answer_twice())
+    assert lm.max_in_flight == 2
+
+    # A new event loop gets a semaphore of its own
+    asyncio.run(qa.arespond(QUESTIONS[:2]))
+    assert lm.max_in_flight == 2
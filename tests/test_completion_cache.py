@@ -0,0 +1,36 @@
+from openai_api import QueryAgent
+from mock_server import MockLM, MockCompletion
+
+from test_analytics import QUESTIONS, FakeRetriever
+
+def make_agent(cache_path=None, stream=False):
+    return QueryAgent(
+        model="mock",
+        api_key="mock",
+        lm=MockCompletion(MockLM(seed=0, prob_alpha=2, prob_beta=1)),
+        retriever=FakeRetriever(),
+        retrieval_kwargs={"topk_retriever": 2, "look_ahead_filter_prob": 0.8, "look_ahead_mask_prob": 0.4, "mode": "implicit"},
+        cache_path=cache_path,
+        stream=stream,
+    )
+
+def test_streamed_cuts_are_not_cached(tmp_path):
+
+    cache_path = str(tmp_path / "completions.db")
+    prompts = [f"Question: {question}\nAnswer:" for question in QUESTIONS]
+
+    streamed = make_agent(cache_path, stream=True)
+    streamed._create_completion(prompts, num_sents=[1 for _ in prompts], **streamed._completion_params())
+    assert streamed._stream_cuts > 0
+
+    # The same prompts without streaming get the full completions, not the ones cut for the streamed call
+    cached = make_agent(cache_path)
+    choices = cached._create_completion(prompts, **cached._completion_params())
+
+    uncached = make_agent()
+    assert choices == uncached._create_completion(prompts, **uncached._completion_params())
+
+    # And with streaming, the full completions now in the cache are enough
+    again = make_agent(cache_path, stream=True)
+    again._create_completion(prompts, num_sents=[1 for _ in prompts], **again._completion_params())
+    assert again.lm.lm.stats["prompts"] == 0
@@ -0,0 +1,23 @@
+from es_transport import AsyncMultiSearch
+
+def test_no_hedges_with_a_single_node():
+
+    transport = AsyncMultiSearch(hosts=["localhost:9200"])
+
+    assert transport.max_hedges == 0 and transport._hedge_delay() is None
+    transport.close()
+
+def test_hedge_delay_is_capped():
+
+    transport = AsyncMultiSearch(hosts=["localhost:9200", "localhost:9201"], hedge_after=0.5, hedge_max_delay=0.1, min_samples=2)
+    assert transport._hedge_delay() == 0.1
+
+    # Stalls beyond 100 - hedge_percentile percent of the requests no longer set the delay
+    transport._latencies.extend([0.01, 1.0, 1.0])
+    assert transport._hedge_delay() == 0.1
+
+    transport._latencies.clear()
+    transport._latencies.extend([0.02, 0.02])
+    assert transport._hedge_delay() == 0.02
+
+    transport.close()
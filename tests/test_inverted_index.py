@@ -0,0 +1,111 @@
+import os
+import sys
+import csv
+import math
+import random
+import numpy as np
+
+from collections import Counter
+
+from inverted_index import InvertedIndexBM25, analyze, encode_varints, decode_varints
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'setup'))
+
+from build_inverted_index import FIELDS, build_inverted_index
+
+WORDS = ["film", "actor", "actress", "played", "director", "bonnie", "clyde", "studio", "released", "award", "1967",
+         "3.5", "1,000", "sequel", "novel", "written", "starring", "role", "character", "music", "the", "of", "was"]
+
+def write_corpus(path, num_docs, seed=0):
+    rng = random.Random(seed)
+    rows = []
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(["id", "text", "title"])
+
+        for i in range(num_docs):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 3)))
+            rows.append((str(i + 1), text, title))
+            writer.writerow(rows[-1])
+
+    return rows
+
+def brute_force_bm25(rows, query, k1=1.2, b=0.75, tie_breaker=0.5):
+    '''The best_fields BM25 score of every document, term by term, document by document'''
+
+    fields = {"title": [Counter(analyze(title)) for _, _, title in rows], "txt": [Counter(analyze(text)) for _, text, _ in rows]}
+    query_terms = Counter(analyze(query))
+
+    field_scores = []
+
+    for field in FIELDS:
+        counts = fields[field]
+        lengths = [sum(count.values()) for count in counts]
+        doc_count = sum(1 for length in lengths if length > 0)
+        avgdl = sum(lengths) / doc_count
+
+        scores = np.zeros(len(rows))
+
+        for term, qtf in query_terms.items():
+            df = sum(1 for count in counts if term in count)
+            if df == 0:
+                continue
+
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+
+            for d, count in enumerate(counts):
+                tf = count.get(term, 0)
+                if tf:
+                    scores[d] += qtf * idf * tf / (tf + k1 * (1 - b + b * lengths[d] / avgdl))
+
+        field_scores.append(scores)
+
+    field_scores = np.array(field_scores)
+
+    return field_scores.max(axis=0) * (1 - tie_breaker) + field_scores.sum(axis=0) * tie_breaker
+
+def test_scores_match_brute_force_bm25(tmp_path):
+
+    corpus_path = str(tmp_path / "corpus.tsv")
+    index_path = str(tmp_path / "index")
+
+    rows = write_corpus(corpus_path, 2000)
+    build_inverted_index(corpus_path, index_path, chunk_size=300, num_workers=1, num_buckets=4)
+
+    index = InvertedIndexBM25(index_path)
+    queries = ["who played bonnie in the film", "clyde award 1967", "novel written by the director", "3.5 1,000 sequel", "of the"]
+
+    scores = index._score(queries).toarray()
+    docids, docs = index.retrieve(queries, topk=10)
+
+    for qid, query in enumerate(queries):
+        expected = brute_force_bm25(rows, query)
+
+        # The impacts are float16
+        assert np.allclose(scores[qid], expected, rtol=2e-3, atol=1e-4), query
+
+        # The topk are the best documents, up to ties within float16 precision
+        if expected.max() > 0:
+            retrieved = [int(docid) - 1 for docid in docids[qid]]
+            assert np.allclose(expected[retrieved], np.sort(expected)[::-1][:10], rtol=2e-3), query
+            assert docs[qid][0] == rows[retrieved[0]][1]
+        else:
+            assert all(docid.startswith('_') for docid in docids[qid])
+
+def test_analyze_joins_punctuation_like_the_standard_tokenizer():
+
+    assert analyze("It grossed 1,000 dollars in 3.5 weeks") == ["gross", "1,000", "dollar", "3.5", "week"]
+    assert analyze("bonnie,clyde and o'neill's film.") == ["bonni", "clyde", "o'neil", "film"]
+    assert analyze("Made in the U.S. as a T.V. film") == ["made", "u", "s", "t", "v", "film"]
+
+def test_varints_round_trip():
+
+    values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2**21, 2**28 - 1, 2**31 - 1, 5])
+    data, num_bytes = encode_varints(values)
+
+    assert num_bytes.tolist() == [1, 1, 1, 2, 2, 2, 3, 4, 4, 5, 1]
+    assert len(data) == num_bytes.sum()
+    assert decode_varints(data).tolist() == values.tolist()
+    assert decode_varints(encode_varints(np.zeros(0))[0]).tolist() == []
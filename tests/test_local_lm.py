@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+
+from local_lm import PrefixCache
+
+def make_past(num_tokens, num_layers=2, heads=2, head_dim=4):
+    '''past_key_values of num_tokens tokens, 2 * 2 * 2 * 4 float32 or 128 bytes per token'''
+
+    return tuple((torch.zeros(1, heads, num_tokens, head_dim), torch.zeros(1, heads, num_tokens, head_dim)) for _ in range(num_layers))
+
+def test_prefix_cache_is_bounded_by_bytes():
+
+    cache = PrefixCache(max_bytes=128 * 25)
+
+    cache.store(np.arange(10), make_past(10))
+    cache.store(np.arange(100, 110), make_past(10))
+    assert len(cache) == 2 and cache.num_bytes == 128 * 20
+
+    # The least recently used state is evicted first
+    assert cache.lookup(np.arange(12))[0] == 10
+    cache.store(np.arange(200, 210), make_past(10))
+    assert len(cache) == 2 and cache.num_bytes == 128 * 20
+    assert cache.lookup(np.arange(100, 112))[0] == 0
+    assert cache.lookup(np.arange(12))[0] == 10
+
+    # An extension replaces the state it extends
+    cache.store(np.arange(15), make_past(15))
+    assert len(cache) == 2 and cache.num_bytes == 128 * 25
+
+    # States over the bound are not cached
+    cache.store(np.arange(300, 330), make_past(30))
+    assert cache.lookup(np.arange(300, 331))[0] == 0
+    assert cache.num_bytes == 128 * 25
@@ -0,0 +1,73 @@
+import math
+
+from openai_api import QueryAgent
+from mock_server import MockLM, MockCompletion
+
+from test_analytics import QUESTIONS, FakeRetriever
+
+def make_agent(max_look_ahead_sents, prob_alpha=2):
+    return QueryAgent(
+        model="mock",
+        api_key="mock",
+        lm=MockCompletion(MockLM(seed=0, prob_alpha=prob_alpha, prob_beta=1)),
+        retriever=FakeRetriever(),
+        retrieval_kwargs={"topk_retriever": 2, "look_ahead_filter_prob": 0.8, "look_ahead_mask_prob": 0.4, "mode": "implicit", "max_look_ahead_sents": max_look_ahead_sents},
+    )
+
+def make_choice(sentences, finish_reason='stop'):
+    '''A choice of the Completion API from sentences of (token, probability) pairs'''
+
+    tokens = [(token, prob) for sentence in sentences for token, prob in sentence]
+    offsets = [100 + sum(len(token) for token, _ in tokens[:i]) for i in range(len(tokens))]
+
+    return {
+        'text': "".join(token for token, _ in tokens),
+        'logprobs': {'tokens': [token for token, _ in tokens], 'token_logprobs': [math.log(prob) for _, prob in tokens], 'text_offset': offsets},
+        'finish_reason': finish_reason,
+    }
+
+FIRST = [(" Bonnie", 0.9), (" was", 0.95), (" played", 0.9), (" by", 0.99), (" Faye", 0.9), (" Dunaway.", 0.9)]
+SECOND = [(" Clyde", 0.9), (" was", 0.95), (" Warren", 0.9), (" Beatty.", 0.9)]
+UNSURE = [(" It", 0.9), (" came", 0.9), (" out", 0.9), (" in", 0.9), (" 1968.", 0.3)]
+THIRD = [(" It", 0.9), (" came", 0.9), (" out", 0.9), (" in", 0.9), (" 1967.", 0.9)]
+
+def text(*sentences):
+    return "".join(token for sentence in sentences for token, _ in sentence)
+
+def test_confident_sentences_are_reused():
+
+    qa = make_agent(3)
+    completions, all_tok_probs, all_toks = qa._parse_choices([make_choice([FIRST, SECOND, THIRD, SECOND])], look_ahead=True)
+
+    # At most max_look_ahead_sents sentences, none of their tokens triggers retrieval
+    assert completions == [text(FIRST, SECOND, THIRD)]
+    assert len(all_toks[0]) == len(FIRST + SECOND + THIRD) and min(all_tok_probs[0]) >= qa.look_ahead_filter_prob
+    assert (qa._api_calls_saved, qa._total_api_calls) == (2, 1)
+
+def test_reuse_stops_at_retrieval():
+
+    qa = make_agent(3)
+    choices = [
+        make_choice([FIRST, UNSURE, SECOND]),     # the second sentence would trigger retrieval
+        make_choice([UNSURE, FIRST, SECOND]),     # the first sentence triggers retrieval
+        make_choice([FIRST, SECOND], 'length'),   # the last sentence may be cut off
+        make_choice([FIRST, SECOND, THIRD]),      # not reused, look_ahead off for this choice
+    ]
+    completions, _, _ = qa._parse_choices(choices, look_ahead=[True, True, True, False])
+
+    assert completions == [text(FIRST), text(UNSURE), text(FIRST), text(FIRST)]
+    assert (qa._api_calls_saved, qa._total_api_calls) == (0, 4)
+
+    # The sentence triggering retrieval is regenerated, the look-ahead is not consumed
+    next_sents, queries, activated_idxs = qa._prepare_retrieval(completions, *qa._parse_choices(choices, look_ahead=[True, True, True, False])[1:])
+    assert activated_idxs == [1] and next_sents[1] == ""
+
+def test_look_ahead_saves_api_calls():
+
+    # Confident enough for some sentences to follow each other without triggering retrieval
+    single, reused = make_agent(1, prob_alpha=20), make_agent(3, prob_alpha=20)
+    single.respond(QUESTIONS)
+    reused.respond(QUESTIONS)
+
+    assert single._api_calls_saved == 0 and reused._api_calls_saved > 0
+    assert reused._total_api_calls < single._total_api_calls
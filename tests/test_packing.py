@@ -0,0 +1,35 @@
+from packing import ContextPacker
+
+def test_exact_duplicates_and_empty_passages():
+
+    packer = ContextPacker(dedup=True, near_duplicate_threshold=None)
+    documents = ["Bonnie and Clyde (1967 film)", "", "bonnie and clyde: 1967 FILM!", "Faye Dunaway played Bonnie."]
+
+    assert packer.pack(documents) == ["Bonnie and Clyde (1967 film)", "Faye Dunaway played Bonnie."]
+    assert packer.stats == {"passages": 4, "kept": 2, "empty": 1, "duplicates": 1, "near_duplicates": 0, "seen": 0}
+
+def test_near_duplicate_threshold():
+
+    original = "Bonnie and Clyde is a 1967 American biographical crime film directed by Arthur Penn"
+    revision = "Bonnie and Clyde is a 1967 American biographical crime film directed by Arthur Penn and starring Warren Beatty"
+
+    # The 12 shingles of the original are 12 of the 16 of the revision, a Jaccard similarity of 0.75
+    assert ContextPacker(dedup=True, near_duplicate_threshold=0.75).pack([original, revision]) == [original]
+    assert ContextPacker(dedup=True, near_duplicate_threshold=0.8).pack([original, revision]) == [original, revision]
+
+def test_drop_seen_across_steps():
+
+    packer = ContextPacker(drop_seen=True)
+    seen = set()
+
+    assert packer.pack(["Faye Dunaway played Bonnie.", "", "Warren Beatty played Clyde."], seen) == ["Faye Dunaway played Bonnie.", "Warren Beatty played Clyde."]
+    assert packer.pack(["", "Warren Beatty played Clyde.", "The film was released in 1967."], seen) == ["The film was released in 1967."]
+
+    # Empty passages are dropped as empty at every step, never remembered as seen
+    assert hash("") not in seen
+    assert packer.stats == {"passages": 6, "kept": 3, "empty": 2, "duplicates": 0, "near_duplicates": 0, "seen": 1}
+
+def test_disabled_packer_keeps_everything():
+
+    documents = ["a passage", "", "a passage"]
+    assert ContextPacker().pack(documents) == documents
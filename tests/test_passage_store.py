@@ -0,0 +1,57 @@
+import os
+
+from passage_store import PassageStore, PassageStoreWriter
+
+def write_store(path, passages):
+    writer = PassageStoreWriter(path)
+    for docid, text in passages:
+        writer.add(docid, text)
+    writer.close()
+
+def test_rows_of_unsorted_ids(tmp_path):
+
+    passages = [("30", "thirty"), ("10", "ten"), ("20", "twenty")]
+    write_store(str(tmp_path), passages)
+
+    store = PassageStore(str(tmp_path))
+    rows = store.rows([["10", "30"], ["_dummy", "25"]])
+
+    assert rows.tolist() == [[1, 0], [-1, -1]]
+    assert store.lazy(rows)[0] == ["ten", "thirty"]
+
+    # Stores written before the sorted ids were saved sort them once when opened
+    os.remove(os.path.join(str(tmp_path), 'ids.sorted.npy'))
+    assert PassageStore(str(tmp_path)).rows([["20", "10"]]).tolist() == [[2, 1]]
+
+def test_sorted_ids_are_not_copied_per_call(tmp_path):
+
+    write_store(str(tmp_path), [("1", "one"), ("2", "two")])
+    store = PassageStore(str(tmp_path))
+
+    assert store._sorted_ids is store.ids
+    assert store.rows(["2", "3"]).tolist() == [1, -1]
+
+def test_retrieve_keeps_the_passages_lazy(tmp_path, monkeypatch):
+
+    from openai_api import QueryAgent
+    from passage_store import LazyPassages
+    from state import RetrievalResult
+
+    write_store(str(tmp_path), [(str(i), f"passage {i}") for i in range(10)])
+    store = PassageStore(str(tmp_path))
+
+    class StoreRetriever(object):
+        def retrieve(self, queries, topk=1):
+            docids = [[str(len(query) % 10), str((len(query) + 1) % 10)] for query in queries]
+            return RetrievalResult(docids, store.lazy(store.rows(docids)))
+
+    reads = []
+    monkeypatch.setattr(PassageStore, "__getitem__", lambda self, row: reads.append(row) or f"passage {self.ids[row]}")
+
+    qa = QueryAgent(model="mock", api_key="mock", lm=object(), retriever=StoreRetriever(), retrieval_kwargs={"topk_retriever": 2})
+    docids, docs = qa._retrieve(["a", "bcd", "a"])
+
+    # The duplicate query is searched once, and no text is read until a row is accessed
+    assert docids == [["1", "2"], ["3", "4"], ["1", "2"]]
+    assert isinstance(docs, LazyPassages) and reads == []
+    assert docs[2] == ["passage 1", "passage 2"]
@@ -0,0 +1,74 @@
+import numpy as np
+
+from test_analytics import make_agent, analytics
+
+def prepare_retrieval_loop(qa, sents, all_tok_probs, all_toks):
+    '''The per sentence loop _prepare_retrieval replaced, on the same analytics'''
+
+    next_sents, queries, activated_idxs = [], [], []
+
+    for i in range(len(sents)):
+        if sents[i] != "" and min(all_tok_probs[i]) < qa.look_ahead_filter_prob:
+
+            if qa.mode == "implicit":
+                mask = np.array(all_tok_probs[i]) < qa.look_ahead_mask_prob
+                query = "".join(np.where(mask, "", all_toks[i])).lstrip()
+                qa._masked_tokens.update(np.array(all_toks[i])[mask])
+            else:
+                query = ""
+
+            queries.append(query)
+            activated_idxs.append(i)
+            next_sents.append("")
+
+            qa._total_retrieval_calls += 1
+            qa._total_api_calls -= 1
+            qa._low_probability_tokens.update(np.array(all_toks[i])[np.array(all_tok_probs[i]) < qa.look_ahead_filter_prob])
+
+        else:
+            next_sents.append(sents[i])
+
+    return next_sents, queries, activated_idxs
+
+# The agents filter below 0.8 and mask below 0.4
+CONFIDENT = (" Bonnie was played by Faye.", [0.9, 0.95, 0.99, 0.9, 0.85, 0.9], [" Bon", "nie", " was", " played", " by", " Faye."])
+UNSURE = (" Clyde was Warren Beatty.", [0.3, 0.7, 0.2, 0.9, 0.5], [" Cly", "de", " was", " Warren", " Beatty."])
+PARTLY = (" It came out in 1967.", [0.9, 0.6, 0.9, 0.9, 0.35], [" It", " came", " out", " in", " 1967."])
+EMPTY = ("", [], [])
+EMPTY_UNSURE = ("", [0.1], [" ."])
+
+CASES = {
+    "none below": [CONFIDENT, CONFIDENT],
+    "all below": [UNSURE, PARTLY],
+    "empty sentence": [EMPTY, UNSURE, EMPTY_UNSURE],
+    "mixed": [CONFIDENT, UNSURE, EMPTY, PARTLY, CONFIDENT, EMPTY_UNSURE, UNSURE],
+    "empty batch": [],
+}
+
+def test_prepare_retrieval_matches_the_loop():
+
+    for mode in ("implicit", "explicit"):
+        for name, batch in CASES.items():
+
+            sents = [sent for sent, _, _ in batch]
+            all_tok_probs = [probs for _, probs, _ in batch]
+            all_toks = [toks for _, _, toks in batch]
+
+            vectorized, loop = make_agent(mode), make_agent(mode)
+
+            assert vectorized._prepare_retrieval(sents, all_tok_probs, all_toks) == prepare_retrieval_loop(loop, sents, all_tok_probs, all_toks), (mode, name)
+            assert analytics(vectorized) == analytics(loop), (mode, name)
+
+def test_prepare_retrieval_masks():
+
+    qa = make_agent("implicit")
+    next_sents, queries, activated_idxs = qa._prepare_retrieval(*map(list, zip(CONFIDENT, UNSURE, EMPTY, PARTLY)))
+
+    assert next_sents == [CONFIDENT[0], "", "", ""]
+    assert queries == ["de Warren Beatty.", "It came out in"]
+    assert activated_idxs == [1, 3]
+
+    api_calls, retrieval_calls, low_probability, masked = analytics(qa)
+    assert (api_calls, retrieval_calls) == (-2, 2)
+    assert masked == {" Cly": 1, " was": 1, " 1967.": 1}
+    assert low_probability == {" Cly": 1, "de": 1, " was": 1, " Beatty.": 1, " came": 1, " 1967.": 1}
@@ -0,0 +1,67 @@
+from prompt import PromptBuilder
+
+class CharTokenizer(object):
+    '''One token per character, so the tokens of a prompt are exactly the sum of the tokens of its segments'''
+
+    def encode(self, text):
+        return list(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+class Dataset(object):
+
+    def exemplars(self):
+        return [f"Question: exemplar {i}?\nAnswer: {'x' * 40}.\n\n" for i in range(4)]
+
+    def question_template(self, question):
+        return f"Question: {question}\nAnswer:"
+
+DOCUMENTS = ["Bonnie and Clyde is a 1967 American biographical crime film. " * 3, "Faye Dunaway played Bonnie Parker.", ""]
+
+def make_builder(**kwargs):
+    return PromptBuilder(Dataset(), tokenizer=CharTokenizer(), **kwargs)
+
+def test_unbudgeted_prompt_keeps_everything():
+
+    prompt = make_builder().build(DOCUMENTS, "Who played Bonnie?", " Faye")
+
+    assert prompt.startswith("".join(Dataset().exemplars()) + "Search results:\n[1] " + DOCUMENTS[0])
+    assert prompt.endswith("[3] \nQuestion: Who played Bonnie?\nAnswer: Faye")
+
+def test_prompt_fits_the_budget():
+
+    exemplars = Dataset().exemplars()
+    full = len(make_builder().build(DOCUMENTS, "Who played Bonnie?", " Faye"))
+
+    for max_input_tokens in range(full, 0, -7):
+        builder = make_builder(max_input_tokens=max_input_tokens, min_exemplars=1)
+        prompt = builder.build(DOCUMENTS, "Who played Bonnie?", " Faye")
+
+        num_exemplars = sum(1 for exemplar in exemplars if exemplar in prompt)
+        truncated = builder.stats["truncated_passages"]
+
+        # Within the budget, unless the last exemplar, the question and the response alone exceed it
+        assert len(prompt) <= max_input_tokens or num_exemplars == 1
+        assert builder.stats["prompt_tokens"] == len(prompt)
+
+        # Exemplars are dropped before any passage is cut
+        assert truncated == 0 or num_exemplars == 1
+        assert prompt.startswith("".join(exemplars[:num_exemplars]))
+        assert prompt.endswith("Question: Who played Bonnie?\nAnswer: Faye")
+
+    # Short of space, the passages are cut to a common cap, the shorter passages first kept whole
+    builder = make_builder(max_input_tokens=len(exemplars[0]) + 150, min_exemplars=1)
+    prompt = builder.build(DOCUMENTS, "Who played Bonnie?", " Faye")
+
+    assert len(prompt) <= len(exemplars[0]) + 150
+    assert "[2] Faye Dunaway played Bonnie Parker.\n" in prompt and DOCUMENTS[0] not in prompt
+    assert builder.stats["dropped_exemplars"] == 3 and builder.stats["truncated_passages"] == 1
+
+def test_passage_cap():
+
+    builder = make_builder(max_passage_tokens=20)
+    prompt = builder.build(DOCUMENTS, "Who played Bonnie?", " Faye")
+
+    assert f"[1] {DOCUMENTS[0][:20]}\n[2] {DOCUMENTS[1][:20]}\n[3] \n" in prompt
+    assert builder.stats["truncated_passages"] == 2 and builder.stats["dropped_exemplars"] == 0
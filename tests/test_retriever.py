@@ -0,0 +1,43 @@
+from retriever import BM25
+
+def hit(docid, text):
+    return {"_id": docid, "_score": 1.0, "_source": {"txt": text}}
+
+class FakeClient(object):
+    '''Answers msearch with the canned responses, recording the queries of every request'''
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def msearch(self, body, filter_path=None):
+        self.requests.append([line["query"]["multi_match"]["query"] for line in body[1::2]])
+        return self.responses.pop(0)
+
+def test_failed_searches_are_not_cached():
+
+    bm25 = BM25()
+    client = FakeClient([
+        {"responses": [
+            {"took": 1, "hits": {"hits": [hit("1", "first passage")]}},
+            {"error": {"type": "search_phase_execution_exception", "reason": "all shards failed"}, "status": 503},
+            {"took": 1, "hits": {"hits": []}},
+        ]},
+        {"responses": [
+            {"took": 1, "hits": {"hits": [hit("2", "second passage")]}},
+        ]},
+    ])
+    bm25.retriever.es.es = client
+
+    docids, docs = bm25.retrieve(["found", "failed", "no hits"], topk=1)
+
+    # The failed query gets a dummy doc for now
+    assert docids[0] == ["1"] and docs[0] == ["first passage"]
+    assert docs[1] == [""] and docids[1][0].startswith("_")
+    assert docs[2] == [""]
+
+    docids, docs = bm25.retrieve(["found", "failed", "no hits"], topk=1)
+
+    # Only the failed query is searched again, the empty result of the query without hits is a valid one
+    assert client.requests == [["found", "failed", "no hits"], ["failed"]]
+    assert docids[1] == ["2"] and docs[1] == ["second passage"]
@@ -0,0 +1,99 @@
+import re
+import itertools
+
+from sentences import SentenceSplitter, FOLLOWING_WORD
+from mock_server import MockLM
+
+TEXTS = [
+    " Bonnie and Clyde is a 1967 American film. It was directed by Arthur Penn. Faye Dunaway played Bonnie Parker. It won two Oscars.",
+    " Yes. The film was released by Warner Bros. in August 1967. Dr. Smith disagreed, e.g. in his review. Mr. Beatty produced it.",
+    " It grossed $70 million.\n\nThe film is considered a landmark of the New Hollywood era. The end",
+    " A short one",
+]
+
+def has_sentences_from_scratch(splitter, text, num_sents):
+    '''The streaming check before it was incremental, splitting the whole text at every chunk'''
+
+    _, break_at = splitter.first(text)
+    breaks = [break_at] + [end for end, _ in itertools.islice(splitter.ends(text, break_at), num_sents - 1)]
+
+    if len(breaks) < num_sents:
+        return False
+
+    return FOLLOWING_WORD.match(text[breaks[num_sents - 1]:].lstrip()) is not None
+
+def test_final_ends_cut_streams_like_splitting_from_scratch():
+
+    splitter = SentenceSplitter()
+
+    for text in TEXTS:
+        chunks = re.findall(r"\s*\S+", text)
+
+        for num_sents in (1, 2, 3):
+            ends = []
+
+            for n in range(1, len(chunks) + 1):
+                received = "".join(chunks[:n])
+                assert (len(splitter.final_ends(received, ends)) >= num_sents) == has_sentences_from_scratch(splitter, received, num_sents), (text, num_sents, n)
+
+            # The final ends are the ends of the whole text but its last sentence
+            _, first = splitter.first(text)
+            assert ends == ([first] + [end for end, last in splitter.ends(text, first) if not last] if first < len(text.rstrip()) else [])
+
+def loop_token_break(text_offset, break_at):
+    '''The token break before the bisect, a loop over the offsets'''
+
+    init_offset = text_offset[0]
+    trunc_at = 0
+
+    for j in range(len(text_offset)):
+        trunc_at += 1
+        if text_offset[j] - init_offset >= break_at:
+            trunc_at -= 1
+            break
+
+    return trunc_at
+
+def loop_ends(tokenizer, text, break_at=0):
+    '''The sentence ends before the lazy splitter, of every sentence starting at or after a character'''
+
+    return [len(text[:end].rstrip()) for start, end in tokenizer.span_tokenize(text) if start >= break_at]
+
+def loop_first(tokenizer, text, min_sent_len=5):
+    '''The first sentence before the lazy splitter, of at least min_sent_len characters'''
+
+    sents = [(text[s:e], s, e) for s, e in tokenizer.span_tokenize(text)]
+
+    break_at = 0
+    for sent, _, end_char in sents:
+        num_trail_spaces = len(sent) - len(sent.rstrip())
+        break_at = end_char - num_trail_spaces
+        if break_at >= min_sent_len:
+            break
+
+    return text[:break_at], break_at
+
+def sample_completions():
+    lm = MockLM(seed=0, min_answer_sents=1, max_answer_sents=12)
+    choices = [lm.choice(f"Question {i}\nAnswer:", 0, max_tokens=10000, logprobs=0) for i in range(20)]
+
+    return [(choice["text"], choice["logprobs"]["text_offset"]) for choice in choices] + [(text, [500 + 3 * i for i in range(len(text) // 3 + 1)]) for text in TEXTS]
+
+def test_token_break_and_ends_match_the_loops():
+
+    splitter = SentenceSplitter()
+
+    for text, offsets in sample_completions():
+
+        ends = loop_ends(splitter.tokenizer, text)
+        assert [end for end, _ in splitter.ends(text)] == ends
+        assert [last for _, last in splitter.ends(text)] == [False] * (len(ends) - 1) + [True]
+
+        # The sentences starting after each end
+        for end in ends:
+            assert [e for e, _ in splitter.ends(text, end)] == loop_ends(splitter.tokenizer, text, end)
+
+        for break_at in [0, 1, len(text) // 2, len(text), len(text) + 10] + ends:
+            assert splitter.token_break(offsets, break_at) == loop_token_break(offsets, break_at), (text, break_at)
+
+        assert splitter.first(text) == loop_first(splitter.tokenizer, text)
@@ -0,0 +1,13 @@
+import os
+import sys
+import subprocess
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+
+def test_import_does_not_load_openai():
+
+    # A fresh interpreter, the other tests may have imported openai already
+    code = f"import sys; sys.path.insert(0, {MODEL_DIR!r}); import openai_api; print('openai' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+
+    assert out.stdout.strip() == "False"
@@ -0,0 +1,27 @@
+from openai_api import QueryAgent
+from mock_server import MockLM, MockCompletion
+from test_analytics import QUESTIONS, FakeRetriever
+
+def make_agent(trace):
+    return QueryAgent(
+        model="mock",
+        api_key="mock",
+        lm=MockCompletion(MockLM(seed=0, prob_alpha=2, prob_beta=1)),
+        retriever=FakeRetriever(),
+        retrieval_kwargs={"topk_retriever": 2, "look_ahead_filter_prob": 0.8, "look_ahead_mask_prob": 0.4, "mode": "implicit"},
+        trace=trace,
+    )
+
+def test_traced_spans_record_the_costly_attributes():
+
+    traced = make_agent(trace=True)
+    responses = traced.respond(QUESTIONS)
+
+    completes = [span for span in traced.tracer.spans if span["name"] == "complete"]
+    assert completes
+    assert all(span["prompt_chars"] > 0 and span["completion_tokens"] >= 0 for span in completes)
+
+    # Not tracing answers alike and records nothing
+    untraced = make_agent(trace=False)
+    assert untraced.respond(QUESTIONS) == responses
+    assert untraced.tracer.spans == []